@@ -0,0 +1,208 @@
+import os
+import asyncio
+import argparse
+from contextlib import nullcontext
+
+from langchain_core.messages import AIMessage, SystemMessage
+
+from travel_graph import get_travel_graph, get_initial_state
+from common.human_io import UnattendedIO
+from common.tracing import tracer
+from common.metrics import manager_approvals, metrics_callbacks
+from flight_assistant.escalation_outbox import get_escalation_outbox
+
+
+# -----------------------------------------------------------------------------------
+# Approval service: resumes the booking sessions that were parked by a manager escalation, once the manager decides.
+#
+# When the flight flow ends with an escalation, the session's state only lives in the checkpoints (see
+# common/checkpoints.py), so a session waiting for the decision holds no memory or thread. The decisions are recorded in
+# the escalation outbox (POST /escalations/<id>/decision of server.py, or the command line below), and the service claims
+# the decided escalations in batches and resumes their sessions concurrently from the checkpoints: on approval the flight
+# graph purchases the tickets (the seats are assigned, since the user isn't there to select them), on rejection it tells
+# the user. The responses are added to the conversation, where the user finds them when they come back.
+# A session that fails to resume (e.g. the checkpoint store or the purchase systems are down) is left unresumed and tried
+# again once its claim expires; after APPROVAL_MAX_ATTEMPTS attempts it's recorded as failed, and the user is told in the
+# conversation instead.
+#   APPROVAL_BATCH_SIZE      decided escalations claimed at a time
+#   APPROVAL_CONCURRENCY     sessions resumed at the same time
+#   APPROVAL_POLL_INTERVAL   seconds between checks for decisions recorded by other processes (server.py)
+#   APPROVAL_MAX_ATTEMPTS    attempts to resume a session before giving up
+#
+# Usage:
+#   python approval_service.py                                   resumes the sessions of all decided escalations
+#   python approval_service.py --decide 12 --approve [--note ..] records the decision of escalation 12, then resumes
+
+APPROVAL_BATCH_SIZE = int(os.getenv("APPROVAL_BATCH_SIZE", 50))
+APPROVAL_CONCURRENCY = int(os.getenv("APPROVAL_CONCURRENCY", 8))
+APPROVAL_POLL_INTERVAL = float(os.getenv("APPROVAL_POLL_INTERVAL", 30))
+APPROVAL_MAX_ATTEMPTS = int(os.getenv("APPROVAL_MAX_ATTEMPTS", 5))
+
+
+class ApprovalService:
+    """Resumes the parked sessions of the decided escalations (see the notes above)."""
+
+    def __init__(self, travel_graph=None, outbox=None, assistant=None, batch_size=APPROVAL_BATCH_SIZE, concurrency=APPROVAL_CONCURRENCY, poll_interval=APPROVAL_POLL_INTERVAL, max_attempts=APPROVAL_MAX_ATTEMPTS):
+        self.travel_graph = travel_graph or get_travel_graph()
+        self.outbox = outbox or get_escalation_outbox()
+        # Host of the open sessions (AsyncTravelAssistant of main.py), so that a session isn't resumed while it runs a turn
+        self.assistant = assistant
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # Set to resume the decided sessions right away (e.g. after a decision is recorded)
+        self.wake = asyncio.Event()
+
+    def _session_lock(self, thread_id):
+        session = self.assistant.sessions.get(thread_id) if self.assistant is not None else None
+        return session["lock"] if session is not None else nullcontext()
+
+    def _config(self, escalation):
+        """Config of the escalation's session, which runs without its user, with the user and manager the escalation was made for."""
+        payload = escalation["payload"]
+        return {
+            "configurable": {
+                "thread_id": escalation["thread_id"],
+                "user": {**payload["user"], "manager": payload["manager"]},
+                "session_io": UnattendedIO(),
+            },
+            "callbacks": [*tracer.callbacks(), *metrics_callbacks()],
+        }
+
+    def _session_metadata(self, snapshot):
+        """Metadata of the conversation to record in the checkpoints of the resumed turn, from its latest checkpoint."""
+        metadata = snapshot.metadata or {}
+        return {key: metadata[key] for key in ("session_token_hash",) if key in metadata}
+
+    def _resume_input(self, escalation, state):
+        """Returns the travel graph input that resumes the session with the manager's decision, or None if the session has
+        moved on since the escalation (e.g. the user started another flight search)."""
+        flight_state = state.get("flight_state")
+        if not flight_state or flight_state["escalation_id"] != escalation["escalation_id"] or flight_state["approval_status"] != "pending":
+            return None
+
+        approved = escalation["status"] == "approved"
+        decision_message = (f"This is a system message indicating that the user's manager has {'approved' if approved else 'rejected'} the exception approval request for the selected flights" +
+                            (f", with the note: {escalation['decision_note']}" if escalation["decision_note"] else "") +
+                            (". The tickets are being purchased." if approved else ". The selections were discarded, help the user find flights that comply with the company policy if they want to."))
+
+        # Hand the session back to the flight assistant with the decision, which then acts on it (see route_flight_agent of flight_assistant/flight_graph.py)
+        resumed_flight_state = {**flight_state, "messages": flight_state["messages"] + [SystemMessage(content=decision_message)], "approval_status": escalation["status"], "flight_completed": False}
+        return {**get_initial_state(), **state, "messages": [], "intent": "flight", "new": False, "flight_state": resumed_flight_state}
+
+    async def aresume(self, escalation) -> str:
+        """Resumes the session of a decided escalation and returns the outcome (purchased, purchase_failed, rejected or superseded)."""
+        if escalation["thread_id"] is None:
+            return "superseded"
+
+        config = self._config(escalation)
+        async with self._session_lock(escalation["thread_id"]):
+            snapshot = await self.travel_graph.aget_state(config)
+            state = snapshot.values
+            # The checkpoints of the resumed turn keep the hash of the conversation's session token, so that its user can still reopen it (see server.py)
+            config["metadata"] = self._session_metadata(snapshot)
+            resume_input = self._resume_input(escalation, state)
+            if resume_input is None:
+                return "superseded"
+            final_state = await self.travel_graph.ainvoke(resume_input, config)
+
+        if escalation["status"] == "rejected":
+            return "rejected"
+        return "purchased" if final_state["flight_state"]["purchased_depart_ticket"] is not None else "purchase_failed"
+
+    async def areport_failure(self, escalation):
+        """Tells the user, in the conversation, that the session couldn't be resumed with the manager's decision, and stops
+        the session from waiting for it."""
+        if escalation["thread_id"] is None:
+            return
+
+        if escalation["status"] == "approved":
+            failure_message = "Yoneticiniz sectiginiz ucuslar icin istisna talebinizi onayladi, ancak biletlerinizi alirken bir sorun olustu ve biletleriniz alinamadi. Ucuslari tekrar aramak isterseniz yardimci olabilirim."
+        else:
+            failure_message = "Uzgunum, yoneticiniz sectiginiz ucuslar icin istisna talebinizi onaylamadi. Sirket politikasina uygun baska ucuslar aramak isterseniz yardimci olabilirim."
+
+        config = self._config(escalation)
+        async with self._session_lock(escalation["thread_id"]):
+            snapshot = await self.travel_graph.aget_state(config)
+            state = snapshot.values
+            config["metadata"] = self._session_metadata(snapshot)
+            update = {"messages": [AIMessage(content=failure_message)], "travel_messages": [AIMessage(content=failure_message)]}
+            # The session no longer waits for the decision, if it still did
+            flight_state = state.get("flight_state")
+            if flight_state and flight_state["escalation_id"] == escalation["escalation_id"] and flight_state["approval_status"] == "pending":
+                update["flight_state"] = {**flight_state, "approval_status": None}
+            await self.travel_graph.aupdate_state(config, update)
+
+    async def aprocess_decisions(self) -> dict[int, str]:
+        """Resumes the sessions of all decided escalations, a batch at a time with up to `concurrency` sessions at the same
+        time, and returns their outcomes by escalation id."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        outcomes = {}
+
+        async def resume(escalation):
+            async with semaphore:
+                try:
+                    outcome = await self.aresume(escalation)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    if escalation["resume_attempts"] < self.max_attempts:
+                        # Left unresumed, so that it's claimed and tried again once its lease expires
+                        self.outbox.record_resume_error(escalation["escalation_id"], error)
+                        manager_approvals.inc(outcome="retried")
+                        outcomes[escalation["escalation_id"]] = f"retried: {error}"
+                        return
+                    # Given up on: the user is told in the conversation instead (if even that fails, they find the session as it was)
+                    outcome = f"failed: {error}"
+                    try:
+                        await self.areport_failure(escalation)
+                    except Exception:
+                        pass
+            self.outbox.record_resumption(escalation["escalation_id"], outcome)
+            manager_approvals.inc(outcome=outcome.split(":")[0])
+            outcomes[escalation["escalation_id"]] = outcome
+
+        while True:
+            escalations = self.outbox.claim_decisions(self.batch_size)
+            if not escalations:
+                return outcomes
+            await asyncio.gather(*(resume(escalation) for escalation in escalations))
+
+    async def run(self):
+        """Resumes the decided sessions whenever `wake` is set, and every poll interval (for the decisions recorded by other processes)."""
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.aprocess_decisions()
+            except Exception:
+                # The claimed escalations are claimed again once their lease expires
+                pass
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Records a manager's decision on an escalation and resumes the parked sessions of the decided escalations.")
+    parser.add_argument("--decide", type=int, metavar="ESCALATION_ID", help="Escalation to record the decision on before resuming the sessions")
+    decision = parser.add_mutually_exclusive_group()
+    decision.add_argument("--approve", action="store_true", help="Approve the escalation")
+    decision.add_argument("--reject", action="store_true", help="Reject the escalation")
+    parser.add_argument("--note", help="Note of the manager on the decision")
+    args = parser.parse_args()
+
+    outbox = get_escalation_outbox()
+    if args.decide is not None:
+        if not (args.approve or args.reject):
+            parser.error("--decide needs --approve or --reject")
+        if outbox.record_decision(args.decide, args.approve, args.note) is None:
+            parser.exit(1, f"Escalation {args.decide} doesn't exist or isn't waiting for a decision\n")
+
+    outcomes = asyncio.run(ApprovalService(outbox=outbox).aprocess_decisions())
+    for escalation_id, outcome in outcomes.items():
+        print(f"Escalation {escalation_id}: {outcome}")
+    print(f"Resumed {len(outcomes)} session(s)")
@@ -0,0 +1,356 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+# The benchmark runs with the fake llm backend and without the simulated delays of the external systems by default,
+# so that it measures the overhead of the graphs (set LLM_FAKE_LATENCY to add model time)
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("SIMULATED_DELAY_SCALE", "0")
+# The small fixed-seed flight database (python flight_assistant/data/benchmark_flight_data.py) makes the search results,
+# and so the conversations, the same on every run
+BENCHMARK_DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flight_assistant", "data", "db", "benchmark_flight_database.db")
+if os.path.exists(BENCHMARK_DATABASE_PATH):
+    os.environ.setdefault("FLIGHT_DATABASE_PATH", os.path.abspath(BENCHMARK_DATABASE_PATH))
+# Every run books its seats, queues its escalations and stores its checkpoints in new databases, so that the flights of the
+# scenarios don't fill up and the escalations aren't deduplicated against earlier runs
+import tempfile
+BOOKING_DIRECTORY = tempfile.mkdtemp(prefix="benchmark_bookings_")
+os.environ.setdefault("SEAT_INVENTORY_PATH", os.path.join(BOOKING_DIRECTORY, "seat_inventory.db"))
+os.environ.setdefault("BOOKING_LEDGER_PATH", os.path.join(BOOKING_DIRECTORY, "booking_ledger.db"))
+os.environ.setdefault("ESCALATION_OUTBOX_PATH", os.path.join(BOOKING_DIRECTORY, "escalation_outbox.db"))
+os.environ.setdefault("ESCALATION_MAIL_PATH", os.path.join(BOOKING_DIRECTORY, "escalation_mails.jsonl"))
+os.environ.setdefault("CHECKPOINT_DIRECTORY", os.path.join(BOOKING_DIRECTORY, "checkpoints"))
+
+import re
+import json
+import random
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from main import AsyncTravelAssistant
+from travel_graph import get_travel_graph
+from common.checkpoints import thread_checkpoint_bytes
+
+
+SCENARIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios.json")
+USER_INFO = {"name": "Kaan", "id": 10987654321, "email": "kaan@langgraph.com", "manager": {"name": "Ali", "id": 12345678910, "email": "ali@langgraph.com"}}
+
+
+# -----------------------------------------------------------------------------------
+# Scripted user
+
+class ScriptedIO:
+    """User channel that answers the prompts of the graph with the scripted answers of a scenario.
+
+    Flight selections can be given as "@compliant" / "@violating" (the first listed option that complies with /
+    violates the company policy) or "@any" (the first option). If no listed option fits, the first one is selected
+    and the conversation is counted as a deviation from the scenario.
+
+    Seat selections can be given as "@seat": a random seat among the free seats listed in the prompt. If another
+    conversation takes the seat first, the prompt comes again and a new free seat is selected.
+    """
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.deviations = 0
+        self.seat_conflicts = 0
+        self._seat_taken = False
+
+    def _flight_options(self, prompt_text):
+        """Returns (option number, class, price) of the flights listed in a selection prompt."""
+        plain_text = re.sub(r"\x1b\[[0-9;]*m", "", prompt_text)
+        return [(number, cabin, int(price)) for number, cabin, price in re.findall(r"^(\d)- .*?Kabin: (\w+) .*?Fiyat: (\d+) TL", plain_text, re.MULTILINE)]
+
+    def _free_seats(self, prompt_text):
+        """Returns the seat numbers listed as free in a seat selection prompt."""
+        seats = []
+        for first, last in re.findall(r"(\d+)(?:-(\d+))?", prompt_text.rsplit("bos koltuklar:", 1)[-1]):
+            seats.extend(range(int(first), int(last or first) + 1))
+        return seats
+
+    def _resolve(self, answer, prompt_text):
+        if not answer.startswith("@"):
+            return answer
+        if answer == "@seat":
+            return str(random.choice(self._free_seats(prompt_text)))
+
+        options = self._flight_options(prompt_text)
+        if answer == "@compliant":
+            matching = [number for number, cabin, price in options if cabin == "Economy" and price <= 2000]
+        elif answer == "@violating":
+            matching = [number for number, cabin, price in options if cabin != "Economy" or price > 2000]
+        else:
+            matching = [number for number, _, _ in options]
+
+        if not matching:
+            self.deviations += 1
+            return "1"
+        return matching[0]
+
+    def ask(self, prompt_text):
+        # The seat selected for the last prompt was taken by another conversation, select another one
+        if self._seat_taken:
+            self._seat_taken = False
+            self.seat_conflicts += 1
+            return self._resolve("@seat", prompt_text)
+        if not self.answers:
+            raise RuntimeError(f"The scenario has no answer left for the prompt: {prompt_text.strip()[:100]!r}")
+        return self._resolve(self.answers.pop(0), prompt_text)
+
+    async def aask(self, prompt_text):
+        return self.ask(prompt_text)
+
+    def notify(self, text):
+        if "koltuk dolu" in text:
+            self._seat_taken = True
+
+    def send_message(self, text):
+        pass
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Measurements
+
+class NodeTimer(BaseCallbackHandler):
+    """Callback handler that measures the execution time of every graph node (including the nodes of the flight subgraph)."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._starts = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        # The run of a node has the node's name, other runs inside the node (llm chains, tools) inherit its metadata
+        name = kwargs.get("name")
+        if metadata and metadata.get("langgraph_node") == name:
+            with self._lock:
+                self._starts[run_id] = (name, time.perf_counter())
+
+    def _finish(self, run_id):
+        with self._lock:
+            if run_id in self._starts:
+                name, start_time = self._starts.pop(run_id)
+                self.durations[name].append(time.perf_counter() - start_time)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile."""
+    values = sorted(values)
+    return values[min(max(int(round(p / 100 * len(values) + 0.5)) - 1, 0), len(values) - 1)]
+
+def summarize_durations(seconds):
+    """Returns count, mean, p50/p95/p99 and max of durations in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    milliseconds = [1000 * value for value in seconds]
+    return {
+        "count": len(milliseconds),
+        "mean": round(sum(milliseconds) / len(milliseconds), 3),
+        "p50": round(percentile(milliseconds, 50), 3),
+        "p95": round(percentile(milliseconds, 95), 3),
+        "p99": round(percentile(milliseconds, 99), 3),
+        "max": round(max(milliseconds), 3),
+    }
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Runner
+
+async def run_conversation(host, scenario, thread_id, node_timer):
+    """Runs one scripted conversation and returns its measurements."""
+    session_io = ScriptedIO(scenario["answers"])
+    config = host.create_session(thread_id, USER_INFO, session_io=session_io)
+    config["callbacks"] = [*config.get("callbacks", []), node_timer]
+
+    turn_durations = []
+    error = None
+    start_time = time.perf_counter()
+    try:
+        for user_input in scenario["turns"]:
+            turn_start_time = time.perf_counter()
+            await host.send_message(thread_id, user_input)
+            turn_durations.append(time.perf_counter() - turn_start_time)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    conversation_duration = time.perf_counter() - start_time
+
+    checkpointer = host.travel_graph.checkpointer
+    result = {
+        "turn_durations": turn_durations,
+        "conversation_duration": conversation_duration,
+        "checkpoint_bytes": thread_checkpoint_bytes(checkpointer, thread_id),
+        "deviations": session_io.deviations + len(session_io.answers),
+        "seat_conflicts": session_io.seat_conflicts,
+        "error": error,
+    }
+
+    # Drop the conversation's checkpoints so that the store doesn't grow with the number of iterations
+    host.close_session(thread_id)
+    if hasattr(checkpointer, "delete_thread"):
+        checkpointer.delete_thread(thread_id)
+
+    return result
+
+async def run_benchmark(scenarios, iterations, concurrency, warmup):
+    host = AsyncTravelAssistant(get_travel_graph())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_limited(scenario, thread_id, node_timer):
+        async with semaphore:
+            return scenario["name"], await run_conversation(host, scenario, thread_id, node_timer)
+
+    # Warm-up conversations (imports, caches, database pages) are not measured
+    warmup_timer = NodeTimer()
+    for index in range(warmup):
+        for scenario in scenarios:
+            await run_conversation(host, scenario, f"warmup-{scenario['name']}-{index}", warmup_timer)
+
+    node_timer = NodeTimer()
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(run_limited(scenario, f"{scenario['name']}-{index}", node_timer) for index in range(iterations) for scenario in scenarios))
+    wall_time = time.perf_counter() - start_time
+
+    return results, node_timer, wall_time
+
+def build_report(scenarios, results, node_timer, wall_time, settings):
+    by_scenario = defaultdict(list)
+    for name, result in results:
+        by_scenario[name].append(result)
+
+    report_scenarios = {}
+    all_turn_durations = []
+    for scenario in scenarios:
+        scenario_results = by_scenario[scenario["name"]]
+        turn_durations = [duration for result in scenario_results for duration in result["turn_durations"]]
+        all_turn_durations.extend(turn_durations)
+        checkpoint_sizes = [result["checkpoint_bytes"] for result in scenario_results]
+        errors = [result["error"] for result in scenario_results if result["error"]]
+
+        report_scenarios[scenario["name"]] = {
+            "conversations": len(scenario_results),
+            "errors": len(errors),
+            "first_error": errors[0] if errors else None,
+            "deviations": sum(result["deviations"] for result in scenario_results),
+            "seat_conflicts": sum(result["seat_conflicts"] for result in scenario_results),
+            "turn_latency_ms": summarize_durations(turn_durations),
+            "conversation_ms": summarize_durations([result["conversation_duration"] for result in scenario_results]),
+            "checkpoint_bytes": {"mean": round(sum(checkpoint_sizes) / len(checkpoint_sizes)), "max": max(checkpoint_sizes)} if checkpoint_sizes else None,
+        }
+
+    nodes = {}
+    for name, durations in sorted(node_timer.durations.items()):
+        nodes[name] = {**summarize_durations(durations), "total": round(1000 * sum(durations), 3)}
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "settings": settings,
+        "overall": {
+            "turn_latency_ms": summarize_durations(all_turn_durations),
+            "wall_time_s": round(wall_time, 3),
+            "turns_per_s": round(len(all_turn_durations) / wall_time, 2) if wall_time else None,
+        },
+        "scenarios": report_scenarios,
+        "nodes_ms": nodes,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def compare_reports(baseline, report, max_regression):
+    """Prints the per-turn latency changes against a baseline report and returns whether any p50/p95 regressed beyond the limit."""
+    regressed = False
+    print(f"\n{'scenario':<30}{'metric':<8}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, scenario in report["scenarios"].items():
+        baseline_scenario = baseline.get("scenarios", {}).get(name)
+        if baseline_scenario is None or baseline_scenario["turn_latency_ms"].get("count", 0) == 0:
+            continue
+        for metric in ["p50", "p95", "p99"]:
+            before, after = baseline_scenario["turn_latency_ms"][metric], scenario["turn_latency_ms"].get(metric)
+            if after is None or before == 0:
+                continue
+            change = (after - before) / before
+            flag = ""
+            if metric in ("p50", "p95") and change > max_regression:
+                regressed = True
+                flag = "  <-- regression"
+            print(f"{name:<30}{metric:<8}{before:>12.3f}{after:>12.3f}{change:>+10.1%}{flag}")
+    return regressed
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replays scripted conversations through travel_graph and reports latency percentiles, per-node time, checkpoint size and peak memory.")
+    parser.add_argument("--scenarios", default=SCENARIOS_PATH, help="json file with the scenarios")
+    parser.add_argument("--only", nargs="*", help="names of the scenarios to run (all by default)")
+    parser.add_argument("--iterations", type=int, default=20, help="conversations per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="conversations running at the same time")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured conversations per scenario before the benchmark")
+    parser.add_argument("--output", help="path of the json report (printed if not given)")
+    parser.add_argument("--compare", help="baseline json report to compare with (exits with 1 on regression)")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative increase of p50/p95 turn latency against the baseline")
+    args = parser.parse_args()
+
+    with open(args.scenarios, encoding="utf-8") as file:
+        scenarios = json.load(file)["scenarios"]
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario["name"] in args.only]
+
+    settings = {
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "warmup": args.warmup,
+        "llm_provider": os.getenv("LLM_PROVIDER"),
+        "llm_fake_latency": os.getenv("LLM_FAKE_LATENCY", "none"),
+        "simulated_delay_scale": float(os.getenv("SIMULATED_DELAY_SCALE")),
+        "flight_database": os.path.basename(os.getenv("FLIGHT_DATABASE_PATH", "flight_database.db")),
+    }
+
+    results, node_timer, wall_time = asyncio.run(run_benchmark(scenarios, args.iterations, args.concurrency, args.warmup))
+    report = build_report(scenarios, results, node_timer, wall_time, settings)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare_reports(baseline, report, args.max_regression):
+            sys.exit(1)
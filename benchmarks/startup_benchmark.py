@@ -0,0 +1,167 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+import re
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timezone
+
+
+REPOSITORY_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Entry points whose cold start is measured (module imported by a fresh interpreter)
+TARGETS = {
+    "interpreter": None,
+    "travel_graph": "travel_graph",
+    "cli": "main",
+    "server": "server",
+    "approval_worker": "approval_service",
+}
+
+# Modules that shouldn't be imported at startup (they are imported when the first model client is created, see common/llm_provider.py)
+DEFERRED_MODULES = ["openai", "langchain_openai"]
+
+# Lines of `python -X importtime`: "import time: <self us> | <cumulative us> | <indentation><module>"
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+# -----------------------------------------------------------------------------------
+# Measurements
+
+def run_interpreter(module, options=()):
+    """Starts a fresh interpreter that imports the module, and returns its wall time (s) and stderr."""
+    command = [sys.executable, *options, "-c", f"import {module}" if module else "pass"]
+    start_time = time.perf_counter()
+    process = subprocess.run(command, cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True)
+    wall_time = time.perf_counter() - start_time
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    return wall_time, process.stderr
+
+def run_cold_start(module):
+    """Returns the wall time (s) of a cold start that imports the module, and the import times of another one run with
+    -X importtime (which slows down the imports, so its wall time isn't used)."""
+    wall_time, _ = run_interpreter(module)
+    _, importtime_output = run_interpreter(module, ["-X", "importtime"])
+
+    imports = []
+    for line in importtime_output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indentation, name = match.groups()
+            imports.append({"module": name, "self_us": int(self_us), "cumulative_us": int(cumulative_us), "level": len(indentation) // 2})
+    return wall_time, imports
+
+def summarize_times(values):
+    """Min / p50 / mean / max of the times in ms."""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "min": round(1000 * min(values), 3),
+        "p50": round(1000 * statistics.median(values), 3),
+        "mean": round(1000 * statistics.fmean(values), 3),
+        "max": round(1000 * max(values), 3),
+    }
+
+def measure_target(module, runs, top):
+    """Measures the cold start of a target over the runs, and returns its report."""
+    wall_times = []
+    import_times = []
+    package_self_us = defaultdict(int)
+    imported_modules = set()
+    for _ in range(runs):
+        wall_time, imports = run_cold_start(module)
+        wall_times.append(wall_time)
+        # Import time of the target is the cumulative time of its top level import
+        import_times.append(sum(entry["cumulative_us"] for entry in imports if entry["module"] == module and entry["level"] == 0) / 1e6)
+        for entry in imports:
+            package_self_us[entry["module"].split(".")[0]] += entry["self_us"]
+            imported_modules.add(entry["module"])
+
+    slowest_packages = sorted(package_self_us.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "module": module,
+        "wall_ms": summarize_times(wall_times),
+        "import_ms": summarize_times(import_times) if module else None,
+        "modules_imported": len(imported_modules),
+        "deferred_modules_imported": [name for name in DEFERRED_MODULES if name in imported_modules],
+        "slowest_packages_ms": {name: round(total / runs / 1000, 3) for name, total in slowest_packages},
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare_reports(baseline, report, max_regression):
+    """Prints the cold start changes against a baseline report and returns whether any p50 wall time regressed beyond the limit."""
+    regressed = False
+    print(f"\n{'target':<20}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, target in report["targets"].items():
+        baseline_target = baseline.get("targets", {}).get(name)
+        if baseline_target is None:
+            continue
+        before, after = baseline_target["wall_ms"]["p50"], target["wall_ms"]["p50"]
+        change = (after - before) / before
+        flag = ""
+        if change > max_regression:
+            regressed = True
+            flag = "  <-- regression"
+        print(f"{name:<20}{before:>12.3f}{after:>12.3f}{change:>+10.1%}{flag}")
+    return regressed
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measures the cold start of the entry points (fresh interpreters with -X importtime) and reports wall time, import time and the slowest packages.")
+    parser.add_argument("--only", nargs="*", choices=list(TARGETS), help="targets to measure (all by default)")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per target")
+    parser.add_argument("--top", type=int, default=10, help="number of the slowest packages (by self import time) to report per target")
+    parser.add_argument("--output", help="path of the json report (printed if not given)")
+    parser.add_argument("--compare", help="baseline json report to compare with (exits with 1 on regression)")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative increase of the p50 wall time against the baseline")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "settings": {"runs": args.runs},
+        "targets": {name: measure_target(module, args.runs, args.top) for name, module in TARGETS.items() if not args.only or name in args.only},
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    # Startup must not construct the model clients
+    failed = False
+    for name, target in report["targets"].items():
+        if target["deferred_modules_imported"]:
+            print(f"{name} imports {', '.join(target['deferred_modules_imported'])} at startup")
+            failed = True
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        failed = compare_reports(baseline, report, args.max_regression) or failed
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,100 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import asyncio
+import sqlite3
+
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from common.metrics import memory_saver_bytes
+
+
+# -----------------------------------------------------------------------------------
+# Checkpointers of the graphs. By default the checkpoints are stored in a SQLite database per graph, so that a
+# conversation that is parked (e.g. waiting for a manager's approval) holds no memory or thread of the process, survives
+# restarts, and can be resumed by another process (approval_service.py). CHECKPOINT_STORE=memory keeps them in memory.
+#   CHECKPOINT_STORE       "sqlite" or "memory"
+#   CHECKPOINT_DIRECTORY   directory of the databases (created on first use)
+
+CHECKPOINT_STORE = os.getenv("CHECKPOINT_STORE", "sqlite")
+CHECKPOINT_DIRECTORY = os.getenv("CHECKPOINT_DIRECTORY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "checkpoints"))
+
+
+class ThreadedSqliteSaver(SqliteSaver):
+    """SqliteSaver that also serves the graphs run with ainvoke/astream: the async methods run the sync ones in a worker
+    thread (the connection is shared by the threads, and the saver's lock lets one statement run at a time)."""
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        connection = sqlite3.connect(database_path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        super().__init__(connection)
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoints = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id):
+        """Deletes the checkpoints and pending writes of the thread."""
+        with self.cursor() as cursor:
+            cursor.execute("DELETE FROM checkpoints WHERE thread_id = ?", (str(thread_id),))
+            cursor.execute("DELETE FROM writes WHERE thread_id = ?", (str(thread_id),))
+
+    def thread_bytes(self, thread_id):
+        """Returns the number of serialized bytes stored for the thread (checkpoints and pending writes)."""
+        with self.cursor(transaction=False) as cursor:
+            checkpoints, = cursor.execute("SELECT COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) FROM checkpoints WHERE thread_id = ?", (str(thread_id),)).fetchone()
+            writes, = cursor.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM writes WHERE thread_id = ?", (str(thread_id),)).fetchone()
+        return checkpoints + writes
+
+    def store_bytes(self):
+        """Returns the size of the database files."""
+        return sum(os.path.getsize(path) for path in (self.database_path, self.database_path + "-wal") if os.path.exists(path))
+
+
+def create_checkpointer(graph_name, store=None):
+    """Returns a new checkpointer for the graph: a ThreadedSqliteSaver on <CHECKPOINT_DIRECTORY>/<graph_name>_checkpoints.db, or a MemorySaver."""
+    store = store or CHECKPOINT_STORE
+    if store == "memory":
+        return MemorySaver()
+    if store == "sqlite":
+        os.makedirs(CHECKPOINT_DIRECTORY, exist_ok=True)
+        return ThreadedSqliteSaver(os.path.join(CHECKPOINT_DIRECTORY, f"{graph_name}_checkpoints.db"))
+    raise ValueError(f"Unknown CHECKPOINT_STORE: {store}")
+
+
+def thread_checkpoint_bytes(checkpointer, thread_id):
+    """Returns the number of serialized bytes the checkpointer stores for a thread (checkpoints, channel values and pending writes)."""
+    if isinstance(checkpointer, ThreadedSqliteSaver):
+        return checkpointer.thread_bytes(thread_id)
+
+    total = 0
+    for checkpoints in checkpointer.storage.get(thread_id, {}).values():
+        for checkpoint, metadata, _ in checkpoints.values():
+            total += len(checkpoint[1]) + len(metadata)
+    for (blob_thread_id, *_), (_, value) in checkpointer.blobs.items():
+        if blob_thread_id == thread_id:
+            total += len(value)
+    for (write_thread_id, *_), writes in checkpointer.writes.items():
+        if write_thread_id == thread_id:
+            total += sum(len(value[1]) for _, _, value, _ in writes.values())
+    return total
+
+
+def checkpoint_store_size(checkpointer):
+    """Returns the size of everything the checkpointer stores (serialized bytes in memory, or the size of the database files)."""
+    if isinstance(checkpointer, ThreadedSqliteSaver):
+        return checkpointer.store_bytes()
+    return memory_saver_bytes(checkpointer)
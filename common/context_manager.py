@@ -0,0 +1,328 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import tiktoken
+from langchain_core.messages import SystemMessage, HumanMessage
+
+
+# -----------------------------------------------------------------------------------
+# Token counting
+
+# Cache of tiktoken encodings per model name (None means the encoding couldn't be loaded, e.g. no network access to download the BPE files)
+_encodings = {}
+
+def get_encoding(model):
+    """Returns the tiktoken encoding for the given model, or None if it can't be loaded."""
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Unknown model name, fall back to the encoding of the gpt-4o family
+            try:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                _encodings[model] = None
+        except Exception:
+            _encodings[model] = None
+
+    return _encodings[model]
+
+def count_text_tokens(text, model="gpt-4o-mini"):
+    """Counts the tokens of a string (approximated as 1 token per 4 characters if the encoding is unavailable)."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def message_text(message):
+    """Returns the plain text of a message (content parts and tool calls flattened to a single string)."""
+    content = message.content
+    if isinstance(content, list):
+        content = " ".join(part if isinstance(part, str) else str(part.get("text", "")) for part in content)
+
+    # Tool call arguments are also sent to the model, so they count towards the prompt
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        content += json.dumps([{"name": tool_call["name"], "args": tool_call["args"]} for tool_call in tool_calls], ensure_ascii=False, default=str)
+
+    return content
+
+def count_message_tokens(message, model="gpt-4o-mini"):
+    """Counts the tokens of a single chat message including the per-message overhead of the chat format."""
+    # Every message carries ~4 tokens of role/separator overhead in the OpenAI chat format
+    return 4 + count_text_tokens(message_text(message), model)
+
+def count_messages_tokens(messages, model="gpt-4o-mini"):
+    """Counts the tokens of a list of chat messages."""
+    return sum(count_message_tokens(message, model) for message in messages)
+
+def response_token_usage(response):
+    """Returns (input tokens, output tokens, estimated) of an llm result (LLMResult of a callback).
+
+    The usage reported by the provider is used if available. Otherwise (e.g. streamed responses, the fake backend)
+    the output tokens are counted locally and the input tokens are None.
+    """
+    generation = response.generations[0][0] if response.generations and response.generations[0] else None
+    message = getattr(generation, "message", None)
+
+    # Token usage reported by the provider (in the message, or in the llm output)
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens"), usage.get("output_tokens"), False
+    if response.llm_output and response.llm_output.get("token_usage"):
+        token_usage = response.llm_output["token_usage"]
+        return token_usage.get("prompt_tokens"), token_usage.get("completion_tokens"), False
+
+    if generation is None:
+        return None, None, True
+    return None, count_text_tokens(message_text(message) if message is not None else generation.text), True
+
+def response_cached_tokens(response):
+    """Returns the input tokens of an llm result that the provider served from its prompt cache, or None if not reported."""
+    generation = response.generations[0][0] if response.generations and response.generations[0] else None
+    usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+    if usage and usage.get("input_token_details", {}).get("cache_read") is not None:
+        return usage["input_token_details"]["cache_read"]
+    if response.llm_output and response.llm_output.get("token_usage"):
+        return (response.llm_output["token_usage"].get("prompt_tokens_details") or {}).get("cached_tokens")
+    return None
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Summarizers (callables that take the previous rolling summary and the newly evicted messages, and return the new summary;
+# the async ones are coroutine functions with the same arguments, used by the async nodes through `atrim`)
+
+summary_prompt = """You are summarizing the earlier part of a conversation between a user and a travel/flight booking assistant, so that the assistant can continue the conversation without seeing those messages again.
+
+Previous summary (may be empty):
+{previous_summary}
+
+New messages to fold into the summary:
+{transcript}
+
+Write an updated, concise summary (at most 8 short bullet points) that keeps every fact the assistant still needs: the user's trip details (cities, dates, one-way/two-way), selected or purchased flights and tickets, pending requests, and the user's stated preferences. Drop greetings and small talk. Write the summary in English."""
+
+def format_transcript(messages):
+    """Formats messages as a plain-text transcript (one line per message)."""
+    return "\n".join(f"{message.type}: {message_text(message)}" for message in messages)
+
+def make_llm_summarizer(llm):
+    """Creates a summarizer that asks the given chat model to fold the evicted messages into the rolling summary."""
+    def summarize(previous_summary, messages):
+        prompt = summary_prompt.format(previous_summary=previous_summary or "-", transcript=format_transcript(messages))
+        return llm.invoke([HumanMessage(content=prompt)]).content
+
+    return summarize
+
+def make_async_llm_summarizer(llm):
+    """Async counterpart of make_llm_summarizer, so that a summary doesn't block the event loop of the async nodes."""
+    async def asummarize(previous_summary, messages):
+        prompt = summary_prompt.format(previous_summary=previous_summary or "-", transcript=format_transcript(messages))
+        return (await llm.ainvoke([HumanMessage(content=prompt)])).content
+
+    return asummarize
+
+def extractive_summarizer(previous_summary, messages, max_chars=200, max_lines=12):
+    """Summarizer that doesn't call any model: keeps a truncated line for each of the latest evicted user/assistant/system messages."""
+    lines = previous_summary.split("\n") if previous_summary else []
+    for message in messages:
+        # Tool payloads are already reflected in the assistant messages that follow them
+        if message.type == "tool":
+            continue
+        text = message_text(message).strip().replace("\n", " ")
+        if text:
+            lines.append(f"- {message.type}: {text[:max_chars]}")
+
+    # Keep only the latest lines so that the summary itself stays bounded
+    return "\n".join(lines[-max_lines:])
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+class ContextManager:
+    """Keeps the prompt sent to an agent's llm within a token budget.
+
+    The leading system message(s) and the most recent turns are sent as they are, and the older turns are
+    replaced with a single rolling summary message. Summaries are cached by a hash of the evicted messages,
+    so each summary is generated once and then reused on every later call of the same conversation.
+    """
+
+    def __init__(self, name, max_tokens, summarizer=None, asummarizer=None, model="gpt-4o-mini", min_recent_messages=4, eviction_step=6, cache_size=256):
+        # Name of the agent (used in metrics)
+        self.name = name
+        # Token budget for the messages sent to the llm
+        self.max_tokens = max_tokens
+        # Function to produce the rolling summary, defaults to the extractive summarizer (no llm call)
+        self.summarizer = summarizer or extractive_summarizer
+        # Async summarizer used by `atrim` (without one, the summarizer runs in a worker thread so that it doesn't block the event loop)
+        self.asummarizer = asummarizer
+        self.model = model
+        # The most recent messages are never summarized away, even if they alone exceed the budget
+        self.min_recent_messages = min_recent_messages
+        # Messages are evicted in steps of this many messages, so that the split point (and therefore the cached
+        # summary) stays the same for several turns instead of changing (and requiring a new summary) on every call
+        self.eviction_step = eviction_step
+
+        # LRU cache of rolling summaries keyed by the hash of the evicted message prefix
+        self.cache_size = cache_size
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.stats = {"calls": 0, "trimmed_calls": 0, "tokens_in": 0, "tokens_out": 0, "tokens_saved": 0, "summary_cache_hits": 0, "summary_cache_misses": 0}
+
+    def _message_key(self, message):
+        """Returns a stable string identifying the message's role and content."""
+        return f"{message.type}\x1f{message_text(message)}"
+
+    def _prefix_hashes(self, messages):
+        """Returns the rolling hashes of every prefix of the message list (index i -> hash of messages[:i])."""
+        hashes = [hashlib.sha256(self.name.encode()).hexdigest()]
+        for message in messages:
+            hashes.append(hashlib.sha256((hashes[-1] + self._message_key(message)).encode()).hexdigest())
+
+        return hashes
+
+    def _cached_summary(self, evicted):
+        """Returns (prefix hashes, length of the longest prefix of the evicted messages that already has a summary, its summary)."""
+        hashes = self._prefix_hashes(evicted)
+
+        with self._lock:
+            for index in range(len(evicted), 0, -1):
+                if hashes[index] in self._summaries:
+                    self._summaries.move_to_end(hashes[index])
+                    return hashes, index, self._summaries[hashes[index]]
+
+        return hashes, 0, ""
+
+    def _store_summary(self, hashes, summary):
+        with self._lock:
+            self._summaries[hashes[-1]] = summary
+            # Evict the least recently used summaries
+            while len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+    def _get_summary(self, evicted):
+        """Returns the rolling summary of the evicted messages, reusing the longest cached prefix summary."""
+        hashes, cached_index, previous_summary = self._cached_summary(evicted)
+
+        # If the whole evicted part is already summarized, reuse it as it is
+        if cached_index == len(evicted):
+            self._record(summary_cache_hits=1)
+            return previous_summary
+
+        # Otherwise, fold the remaining evicted messages into the cached summary
+        self._record(summary_cache_misses=1)
+        summary = self.summarizer(previous_summary, evicted[cached_index:])
+        self._store_summary(hashes, summary)
+
+        return summary
+
+    async def _aget_summary(self, evicted):
+        """Async version of _get_summary."""
+        hashes, cached_index, previous_summary = self._cached_summary(evicted)
+
+        if cached_index == len(evicted):
+            self._record(summary_cache_hits=1)
+            return previous_summary
+
+        self._record(summary_cache_misses=1)
+        if self.asummarizer is not None:
+            summary = await self.asummarizer(previous_summary, evicted[cached_index:])
+        else:
+            summary = await asyncio.to_thread(self.summarizer, previous_summary, evicted[cached_index:])
+        self._store_summary(hashes, summary)
+
+        return summary
+
+    def _record(self, **increments):
+        """Increments the given metrics."""
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def get_stats(self):
+        """Returns a snapshot of the metrics."""
+        with self._lock:
+            return dict(self.stats)
+
+    def _split(self, messages):
+        """Decides which of the older messages to evict. Returns (head, body, split, token counts), where the first
+        `split` messages of the body are replaced with the rolling summary (none if split is 0)."""
+        # Separate the leading system message(s) (prompt) from the rest of the conversation
+        head_length = 0
+        while head_length < len(messages) and messages[head_length].type == "system":
+            head_length += 1
+        head, body = messages[:head_length], messages[head_length:]
+
+        # Count tokens of the whole history
+        head_tokens = count_messages_tokens(head, self.model)
+        body_tokens = [count_message_tokens(message, self.model) for message in body]
+        tokens_in = head_tokens + sum(body_tokens)
+
+        # If the whole history fits the budget, send it as it is
+        if tokens_in <= self.max_tokens:
+            return head, body, 0, (head_tokens, body_tokens, tokens_in)
+
+        # Find the minimum number of older messages to evict so that the rest fits the budget
+        max_split = max(len(body) - self.min_recent_messages, 0)
+        kept_tokens = head_tokens + sum(body_tokens)
+        split = 0
+        while split < max_split and kept_tokens > self.max_tokens:
+            kept_tokens -= body_tokens[split]
+            split += 1
+
+        # Round the split point up to the next eviction step
+        split = min(-(-split // self.eviction_step) * self.eviction_step, max_split)
+        # Never start the kept part with a tool message (its tool call would be evicted and the llm api rejects orphan tool responses)
+        while split < len(body) and body[split].type == "tool":
+            split += 1
+
+        # Nothing can be evicted (e.g. only the most recent messages are left) if split is 0
+        return head, body, split, (head_tokens, body_tokens, tokens_in)
+
+    def _trimmed(self, head, body, split, token_counts, summary):
+        """Returns the message list with the evicted messages replaced by the rolling summary, and records the metrics."""
+        head_tokens, body_tokens, tokens_in = token_counts
+        summary_message = SystemMessage(content=f"Summary of the earlier conversation with the user:\n{summary}")
+        trimmed = head + [summary_message] + body[split:]
+
+        tokens_out = head_tokens + count_message_tokens(summary_message, self.model) + sum(body_tokens[split:])
+        self._record(calls=1, trimmed_calls=1, tokens_in=tokens_in, tokens_out=tokens_out, tokens_saved=tokens_in - tokens_out)
+
+        return trimmed
+
+    def trim(self, messages):
+        """Returns the message list to send to the llm, with older turns replaced by a rolling summary if the budget is exceeded."""
+        messages = list(messages)
+        head, body, split, token_counts = self._split(messages)
+        if split == 0:
+            self._record(calls=1, tokens_in=token_counts[2], tokens_out=token_counts[2])
+            return messages
+
+        # Replace the evicted messages with the rolling summary
+        return self._trimmed(head, body, split, token_counts, self._get_summary(body[:split]))
+
+    async def atrim(self, messages):
+        """Async version of trim, for the async nodes (a summary that has to be generated doesn't block the event loop)."""
+        messages = list(messages)
+        head, body, split, token_counts = self._split(messages)
+        if split == 0:
+            self._record(calls=1, tokens_in=token_counts[2], tokens_out=token_counts[2])
+            return messages
+
+        return self._trimmed(head, body, split, token_counts, await self._aget_summary(body[:split]))
+# -----------------------------------------------------------------------------------
+
+
+# Helper to read the token budget of an agent from the environment (e.g. FLIGHT_CONTEXT_MAX_TOKENS=4000)
+def get_context_budget(agent_name, default):
+    """Returns the context token budget configured for the agent."""
+    return int(os.getenv(f"{agent_name.upper()}_CONTEXT_MAX_TOKENS", default))
@@ -0,0 +1,44 @@
+import os
+import hashlib
+from typing import Literal, get_args, get_origin, get_type_hints
+
+from langgraph.types import Command
+from langgraph.utils.runnable import RunnableCallable
+
+
+def node_destinations(func):
+    """Returns the node names in the `Command[Literal[...]]` return annotation of a node function."""
+    return_type = get_type_hints(func).get("return")
+    if get_origin(return_type) is Command and get_origin(get_args(return_type)[0]) is Literal:
+        return tuple(get_args(get_args(return_type)[0]))
+    return None
+
+def add_dual_node(builder, func, afunc):
+    """Adds a node with a sync implementation (used by invoke/stream) and an async one (used by ainvoke/astream) to the graph builder.
+
+    Both functions must have the same parameters. The node is named after the sync function, and its routing
+    destinations (for drawing the graph) are read from the sync function's return annotation.
+    """
+    node = RunnableCallable(func, afunc, name=func.__name__, trace=False)
+    builder.add_node(func.__name__, node, destinations=node_destinations(func))
+
+def draw_graph_image(graph, image_path):
+    """Renders the compiled graph to a png image, unless the image at the path was rendered from the same graph.
+
+    Rendering goes through the mermaid.ink api, so the hash of the graph's mermaid definition is kept next to the image
+    (<image_path>.sha256) and the image is only rendered again once the graph changes. Returns whether it was rendered.
+    """
+    from langchain_core.runnables.graph_mermaid import draw_mermaid_png
+
+    mermaid_syntax = graph.get_graph().draw_mermaid()
+    graph_hash = hashlib.sha256(mermaid_syntax.encode()).hexdigest()
+    hash_path = image_path + ".sha256"
+    if os.path.exists(image_path) and os.path.exists(hash_path):
+        with open(hash_path, encoding="utf-8") as file:
+            if file.read().strip() == graph_hash:
+                return False
+
+    draw_mermaid_png(mermaid_syntax=mermaid_syntax, output_file_path=image_path)
+    with open(hash_path, "w", encoding="utf-8") as file:
+        file.write(graph_hash + "\n")
+    return True
@@ -0,0 +1,182 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import asyncio
+import threading
+
+from common.tracing import tracer
+
+
+# -----------------------------------------------------------------------------------
+# Channels through which the graph nodes and tools talk to the user (prompts for approvals/selections and status notices).
+# The channel of a session is injected with the config ("session_io" key under "configurable"), and the terminal is used if none is given.
+
+class ConsoleIO:
+    """Talks to the user through the terminal (input/print)."""
+
+    def ask(self, prompt_text):
+        """Prompts the user and returns their answer."""
+        return input(prompt_text)
+
+    async def aask(self, prompt_text):
+        """Prompts the user without blocking the event loop (input() runs in a worker thread)."""
+        return await asyncio.to_thread(input, prompt_text)
+
+    def notify(self, text):
+        """Shows a status notice to the user."""
+        print(text)
+
+    def send_message(self, text):
+        """Shows an assistant response to the user."""
+        print(f"\nAssistant: {text}")
+
+
+class QueueIO:
+    """Talks to a remote user through an asyncio queue of outgoing events and answers delivered with `answer()`.
+
+    Events are (kind, text) tuples where kind is "notice" (status text), "question" (the user must answer it),
+    "token" (next piece of a response being generated) or "message" (assistant response). Nodes running on the
+    event loop await the answer without holding a thread, and sync nodes running in worker threads block only
+    their own thread until the answer arrives.
+    """
+
+    def __init__(self):
+        # The channel must be created on the event loop that runs the session
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self.events = asyncio.Queue()
+        self._pending_answer = None
+
+    def _in_loop_thread(self):
+        return threading.get_ident() == self._loop_thread_id
+
+    def _emit(self, kind, text):
+        """Puts an event on the outgoing queue (from the loop thread or from a worker thread)."""
+        if self._in_loop_thread():
+            self.events.put_nowait((kind, text))
+        else:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, text))
+
+    @property
+    def waiting_for_answer(self):
+        """Whether a question is waiting for the user's answer."""
+        return self._pending_answer is not None and not self._pending_answer.done()
+
+    def answer(self, text):
+        """Delivers the user's answer to the pending question. Returns False if no question is pending."""
+        if not self.waiting_for_answer:
+            return False
+        self._pending_answer.set_result(text)
+        return True
+
+    def cancel(self):
+        """Cancels the pending question (e.g. the session is closed), so that the node waiting for its answer stops."""
+        if self.waiting_for_answer:
+            self._pending_answer.cancel()
+
+    def clear(self):
+        """Drops the events that were never delivered to the user (e.g. left over from a disconnected client)."""
+        while not self.events.empty():
+            self.events.get_nowait()
+
+    async def aask(self, prompt_text):
+        """Sends the question to the user and waits for their answer."""
+        self._pending_answer = self.loop.create_future()
+        await self.events.put(("question", prompt_text))
+        try:
+            return await self._pending_answer
+        finally:
+            self._pending_answer = None
+
+    def ask(self, prompt_text):
+        """Sends the question to the user and blocks the calling worker thread until the answer arrives."""
+        return asyncio.run_coroutine_threadsafe(self.aask(prompt_text), self.loop).result()
+
+    def notify(self, text):
+        """Sends a status notice to the user."""
+        self._emit("notice", text)
+
+    def send_message(self, text):
+        """Sends an assistant response to the user."""
+        self._emit("message", text)
+
+    def send_token(self, text):
+        """Sends the next piece of an assistant response that is being generated."""
+        self._emit("token", text)
+
+
+class UnattendedIO:
+    """Channel of a session that runs without its user (e.g. resumed when a manager decides on an escalation, see
+    approval_service.py): the notices and responses are collected in `transcript`, and nothing can be asked."""
+
+    # Checked by the nodes and tools that can proceed without asking (see user_attached)
+    unattended = True
+
+    def __init__(self):
+        self.transcript = []
+
+    def ask(self, prompt_text):
+        raise RuntimeError(f"The session runs without its user, so the question can't be answered: {prompt_text.strip()}")
+
+    async def aask(self, prompt_text):
+        return self.ask(prompt_text)
+
+    def notify(self, text):
+        self.transcript.append(("notice", text))
+
+    def send_message(self, text):
+        self.transcript.append(("message", text))
+
+
+console_io = ConsoleIO()
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Helpers used by the nodes and tools
+
+def get_session_io(config):
+    """Returns the user channel injected in the config, or the terminal channel."""
+    if config is None:
+        return console_io
+    return config.get("configurable", {}).get("session_io") or console_io
+
+def user_attached(config):
+    """Returns False if the session runs without its user (so nothing can be asked)."""
+    return not getattr(get_session_io(config), "unattended", False)
+
+def ask_user(config, prompt_text):
+    """Prompts the user of the session and returns their answer."""
+    with tracer.span("human.answer", "human"):
+        return get_session_io(config).ask(prompt_text)
+
+async def aask_user(config, prompt_text):
+    """Prompts the user of the session and awaits their answer."""
+    with tracer.span("human.answer", "human"):
+        return await get_session_io(config).aask(prompt_text)
+
+def notify_user(config, text):
+    """Shows a status notice to the user of the session."""
+    get_session_io(config).notify(text)
+
+
+# Interactive steps are written once as generators that yield a prompt and receive the user's answer
+# (`user_choice = yield prompt_text`), and return the result at the end. These drivers run them in sync or async nodes.
+def run_interaction(steps, config):
+    """Runs interactive steps by prompting the user of the session synchronously."""
+    try:
+        prompt_text = next(steps)
+        while True:
+            prompt_text = steps.send(ask_user(config, prompt_text))
+    except StopIteration as stop:
+        return stop.value
+
+async def arun_interaction(steps, config):
+    """Runs interactive steps by awaiting the answers of the user of the session."""
+    try:
+        prompt_text = next(steps)
+        while True:
+            prompt_text = steps.send(await aask_user(config, prompt_text))
+    except StopIteration as stop:
+        return stop.value
+# -----------------------------------------------------------------------------------
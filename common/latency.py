@@ -0,0 +1,49 @@
+import math
+import random
+
+
+# -----------------------------------------------------------------------------------
+# Artificial latency distributions used by the fake llm backend
+#
+# A distribution is given as a "<name>:<parameters>" string (all values in seconds):
+#   "none"                     no delay
+#   "constant:0.3"             always 0.3
+#   "uniform:0.1,0.5"          uniformly between 0.1 and 0.5
+#   "normal:0.4,0.1"           normal with mean 0.4 and standard deviation 0.1 (clipped at 0)
+#   "lognormal:0.4,0.5"        lognormal with median 0.4 and shape (sigma of the log) 0.5, long tail like real api latencies
+#   "exponential:0.4"          exponential with mean 0.4
+
+class LatencyDistribution:
+    """Samples delays from a distribution given as a "<name>:<parameters>" string."""
+
+    def __init__(self, spec="none", seed=None):
+        self.spec = spec or "none"
+        name, _, parameters = self.spec.partition(":")
+        self.name = name.strip().lower()
+        self.parameters = [float(value) for value in parameters.split(",") if value.strip()]
+        self._random = random.Random(seed)
+
+        expected_parameters = {"none": 0, "constant": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+        if self.name not in expected_parameters:
+            raise ValueError(f"Unknown latency distribution: {self.spec}")
+        if len(self.parameters) != expected_parameters[self.name]:
+            raise ValueError(f"Latency distribution '{self.name}' takes {expected_parameters[self.name]} parameter(s): {self.spec}")
+
+    def sample(self):
+        """Returns a delay in seconds."""
+        if self.name == "none":
+            return 0.0
+        if self.name == "constant":
+            return self.parameters[0]
+        if self.name == "uniform":
+            return self._random.uniform(*self.parameters)
+        if self.name == "normal":
+            return max(0.0, self._random.gauss(*self.parameters))
+        if self.name == "lognormal":
+            median, sigma = self.parameters
+            return self._random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return self._random.expovariate(1 / self.parameters[0]) if self.parameters[0] > 0 else 0.0
+
+    def __repr__(self):
+        return f"LatencyDistribution({self.spec!r})"
+# -----------------------------------------------------------------------------------
@@ -0,0 +1,288 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import re
+import json
+import math
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.runnables import RunnableLambda
+
+from common.context_manager import message_text
+
+
+# -----------------------------------------------------------------------------------
+# Opt-in cache of llm responses, stored in a bounded local SQLite database
+#
+# Exact tier: the key is a hash of the normalized messages and the model parameters.
+# Semantic tier (optional): a response is reused if the conversation before the last user message is the same and the
+# last user message is similar enough (cosine similarity of the embeddings) to a cached one, e.g. "merhaba" / "merhabalar".
+
+# The cache is disabled unless LLM_CACHE_ENABLED=1 (kill switch), and can also be bypassed per run with config["configurable"]["llm_cache"] = False
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "0") == "1"
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "llm_cache.db"))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000))
+# The semantic tier is only used if LLM_CACHE_SEMANTIC=1 (it needs an embeddings model)
+SEMANTIC_ENABLED = os.getenv("LLM_CACHE_SEMANTIC", "0") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("LLM_CACHE_SIMILARITY_THRESHOLD", 0.95))
+# Maximum number of cached entries with the same context compared in the semantic tier
+SEMANTIC_MAX_CANDIDATES = 200
+
+
+def normalize_message_text(text):
+    """Normalizes a message text for the cache key (case and whitespace differences don't change the key)."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+def extract_messages(input):
+    """Returns the message list of a chain input (a list of messages, or a prompt input dictionary with a "messages" field)."""
+    if isinstance(input, dict):
+        return input.get("messages", [])
+    return input
+
+def serialize_response(response):
+    """Serializes a chain output (a message, or a json-like structured output) to store it in the cache."""
+    if isinstance(response, BaseMessage):
+        return json.dumps({"message": message_to_dict(response)}, ensure_ascii=False)
+    return json.dumps({"output": response}, ensure_ascii=False)
+
+def deserialize_response(data):
+    data = json.loads(data)
+    if "message" in data:
+        return messages_from_dict([data["message"]])[0]
+    return data["output"]
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class LLMResponseCache:
+    """SQLite cache of llm responses with least-recently-used eviction."""
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, embeddings=None, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        # Embeddings model for the semantic tier (None disables it)
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self._connection = None
+
+        # Metrics
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+
+    def _get_connection(self):
+        # The database is opened on first use, so that importing the agents doesn't create it when the cache is disabled
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    context_key TEXT NOT NULL,
+                    query_text TEXT NOT NULL,
+                    embedding TEXT,
+                    response TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_context ON llm_cache (namespace, context_key, last_used)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+            self._connection.commit()
+        return self._connection
+
+    def make_keys(self, namespace, params, messages):
+        """Returns (exact key, context key, last user message text) of the messages.
+
+        The context key covers everything except the last user message, so that the semantic tier only reuses
+        responses given in the same context.
+        """
+        parts = [f"{message.type}\x1f{normalize_message_text(message_text(message))}" for message in messages]
+        prefix = json.dumps({"namespace": namespace, "params": params}, sort_keys=True)
+
+        query_text = ""
+        if messages and messages[-1].type == "human":
+            query_text = normalize_message_text(message_text(messages[-1]))
+            context_parts = parts[:-1]
+        else:
+            context_parts = parts
+
+        exact_key = hashlib.sha256("\x1e".join([prefix] + parts).encode()).hexdigest()
+        context_key = hashlib.sha256("\x1e".join([prefix] + context_parts).encode()).hexdigest()
+        return exact_key, context_key, query_text
+
+    def lookup_exact(self, key):
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                connection.commit()
+        return None if row is None else deserialize_response(row[0])
+
+    def lookup_similar(self, namespace, context_key, embedding):
+        """Returns the cached response of the most similar user message in the same context, or None."""
+        with self._lock:
+            connection = self._get_connection()
+            rows = connection.execute(
+                "SELECT key, embedding, response FROM llm_cache WHERE namespace = ? AND context_key = ? AND embedding IS NOT NULL ORDER BY last_used DESC LIMIT ?",
+                (namespace, context_key, SEMANTIC_MAX_CANDIDATES)).fetchall()
+
+            best_key, best_response, best_similarity = None, None, self.similarity_threshold
+            for key, cached_embedding, response in rows:
+                similarity = cosine_similarity(embedding, json.loads(cached_embedding))
+                if similarity >= best_similarity:
+                    best_key, best_response, best_similarity = key, response, similarity
+
+            if best_key is not None:
+                connection.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), best_key))
+                connection.commit()
+        return None if best_key is None else deserialize_response(best_response)
+
+    def store(self, key, namespace, context_key, query_text, embedding, response):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, namespace, context_key, query_text, embedding, response, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, namespace, context_key, query_text, json.dumps(embedding) if embedding is not None else None, serialize_response(response), time.time()))
+
+            # Evict the least recently used entries beyond the size limit
+            count = connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.max_entries:
+                evicted = connection.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used ASC LIMIT ?)", (count - self.max_entries,)).rowcount
+                self.stats["evictions"] += evicted
+            connection.commit()
+
+    def record(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def get_stats(self):
+        """Returns a snapshot of the metrics."""
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else None
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._get_connection().execute("DELETE FROM llm_cache")
+            self._connection.commit()
+
+
+def fresh_ids(response):
+    """Gives a cached ai message and its tool calls new ids (message and tool call ids must stay unique, a message with
+    a repeated id would replace the earlier one in the graph state)."""
+    if getattr(response, "type", None) != "ai":
+        return response
+
+    update = {"id": f"run-{uuid.uuid4()}"}
+    if response.tool_calls:
+        update["tool_calls"] = [{**tool_call, "id": f"call_{uuid.uuid4().hex[:24]}"} for tool_call in response.tool_calls]
+        # The raw tool calls in the provider format carry the old ids
+        update["additional_kwargs"] = {key: value for key, value in response.additional_kwargs.items() if key != "tool_calls"}
+    return response.model_copy(update=update)
+
+def is_cacheable(messages):
+    """Whether a response to the messages may be served from the cache.
+
+    Messages that carry tool results depend on live data (flight search results), so their responses are never cached.
+    """
+    return len(messages) > 0 and not any(message.type == "tool" for message in messages)
+
+
+def with_response_cache(runnable, namespace, params, cache=None, enabled=CACHE_ENABLED):
+    """Wraps a chain (chat model or prompt | model) with the response cache. Returns the chain itself if the cache is disabled.
+
+    `params` are the model parameters that affect the response (model name, temperature etc.) and are part of the key.
+    """
+    if not enabled:
+        return runnable
+
+    cache = cache or get_default_cache()
+
+    def prepare(input, config):
+        """Returns the cache keys of the input, or None if the cache shouldn't be used for this call."""
+        if config.get("configurable", {}).get("llm_cache") is False:
+            cache.record(bypassed=1)
+            return None
+        messages = extract_messages(input)
+        if not is_cacheable(messages):
+            cache.record(bypassed=1)
+            return None
+        return cache.make_keys(namespace, params, messages)
+
+    def invoke(input, config):
+        keys = prepare(input, config)
+        if keys is None:
+            return runnable.invoke(input, config)
+        key, context_key, query_text = keys
+
+        response = cache.lookup_exact(key)
+        if response is not None:
+            cache.record(exact_hits=1)
+            return fresh_ids(response)
+
+        embedding = None
+        if cache.embeddings is not None and query_text:
+            embedding = cache.embeddings.embed_query(query_text)
+            response = cache.lookup_similar(namespace, context_key, embedding)
+            if response is not None:
+                cache.record(semantic_hits=1)
+                return fresh_ids(response)
+
+        cache.record(misses=1)
+        response = runnable.invoke(input, config)
+        cache.store(key, namespace, context_key, query_text, embedding, response)
+        return response
+
+    async def ainvoke(input, config):
+        keys = prepare(input, config)
+        if keys is None:
+            return await runnable.ainvoke(input, config)
+        key, context_key, query_text = keys
+
+        response = cache.lookup_exact(key)
+        if response is not None:
+            cache.record(exact_hits=1)
+            return fresh_ids(response)
+
+        embedding = None
+        if cache.embeddings is not None and query_text:
+            embedding = await cache.embeddings.aembed_query(query_text)
+            response = cache.lookup_similar(namespace, context_key, embedding)
+            if response is not None:
+                cache.record(semantic_hits=1)
+                return fresh_ids(response)
+
+        cache.record(misses=1)
+        response = await runnable.ainvoke(input, config)
+        cache.store(key, namespace, context_key, query_text, embedding, response)
+        return response
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f"{namespace}_cached_llm")
+# -----------------------------------------------------------------------------------
+
+
+# Cache shared by the agents (created on first use)
+_default_cache = None
+
+def get_default_cache():
+    global _default_cache
+    if _default_cache is None:
+        embeddings = None
+        if SEMANTIC_ENABLED:
+            from langchain_openai import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings(model=os.getenv("LLM_CACHE_EMBEDDING_MODEL", "text-embedding-3-small"))
+        _default_cache = LLMResponseCache(embeddings=embeddings)
+    return _default_cache
@@ -0,0 +1,283 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import re
+import time
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from common.metrics import llm_queue_wait, llm_rate_limited
+
+
+# -----------------------------------------------------------------------------------
+# HTTP clients of the model clients (see get_chat_model of common/llm_provider.py).
+#
+# All model clients send their requests through one pooled transport (one for the sync and one for the async calls), so
+# the agents reuse each other's keep-alive connections instead of opening (and TLS handshaking) their own pools. The
+# requests of every model go through its ModelLimiter on the way:
+# - at most LLM_MAX_CONCURRENCY requests of a model are sent at the same time (LLM_MAX_CONCURRENCY_<MODEL> for a single
+#   model, e.g. LLM_MAX_CONCURRENCY_GPT_4O_MINI), the others wait in a queue for up to LLM_QUEUE_TIMEOUT seconds
+# - once the provider answers with 429, the model's requests wait until the reset time the provider tells (Retry-After,
+#   x-ratelimit-reset-*), instead of each of them running into the limit and retrying on their own
+# The sync and the async requests are limited separately (a process serves its sessions with one of them).
+#   LLM_MAX_CONNECTIONS, LLM_MAX_KEEPALIVE_CONNECTIONS, LLM_KEEPALIVE_EXPIRY   connection pool of the shared transports
+#   LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT                                      timeouts of the requests in seconds
+#   LLM_RATE_LIMIT_BACKOFF                                                      wait after a 429 without a reset time
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 32))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 16))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 60))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 60))
+LLM_RATE_LIMIT_BACKOFF = float(os.getenv("LLM_RATE_LIMIT_BACKOFF", 1))
+
+# Timeout of the model requests (waiting for a connection of the pool is bounded by the queue timeout)
+LLM_TIMEOUT = httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT, pool=LLM_QUEUE_TIMEOUT)
+
+
+def parse_reset_time(value):
+    """Parses a reset time of the x-ratelimit-reset-* headers ("20ms", "1.5s", "6m0s") into seconds."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(amount) * units[unit] for amount, unit in parts) if parts else None
+
+def rate_limit_wait(headers):
+    """Returns the seconds to wait after a 429 response, read from its headers (or the default backoff)."""
+    waits = []
+    if "retry-after-ms" in headers:
+        try:
+            waits.append(float(headers["retry-after-ms"]) / 1000)
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            waits.append(float(headers["retry-after"]))
+        except ValueError:
+            # Retry-After can also be an http date
+            try:
+                waits.append(parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        if name in headers:
+            reset_time = parse_reset_time(headers[name])
+            if reset_time is not None:
+                waits.append(reset_time)
+
+    waits = [wait for wait in waits if wait > 0]
+    return max(waits) if waits else LLM_RATE_LIMIT_BACKOFF
+
+
+class ModelLimiter:
+    """Concurrency limit and rate limit cooldown of the requests of a model (see the notes above)."""
+
+    def __init__(self, model, max_concurrency=LLM_MAX_CONCURRENCY, queue_timeout=LLM_QUEUE_TIMEOUT):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # Created on first use, in the event loop of the async requests
+        self._async_slots = None
+        # Monotonic time until which the requests wait after a 429
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def cooldown(self):
+        """Returns the seconds left until the requests can be sent again after a 429."""
+        return max(0.0, self._blocked_until - time.monotonic())
+
+    def record_response(self, response):
+        """Starts a cooldown if the response is a 429."""
+        if response.status_code != 429:
+            return
+        llm_rate_limited.inc(model=self.model)
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + rate_limit_wait(response.headers))
+
+    def acquire(self, request):
+        """Waits for a free slot of the model (and the end of a cooldown), raises httpx.PoolTimeout after the queue timeout."""
+        start_time = time.perf_counter()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise httpx.PoolTimeout(f"No free slot for '{self.model}' requests within {self.queue_timeout}s", request=request)
+        time.sleep(self.cooldown())
+        llm_queue_wait.observe(time.perf_counter() - start_time, model=self.model)
+
+    def release(self):
+        self._slots.release()
+
+    async def aacquire(self, request):
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise httpx.PoolTimeout(f"No free slot for '{self.model}' requests within {self.queue_timeout}s", request=request) from None
+        await asyncio.sleep(self.cooldown())
+        llm_queue_wait.observe(time.perf_counter() - start_time, model=self.model)
+
+    def arelease(self):
+        self._async_slots.release()
+
+
+class ReleasingStream(httpx.SyncByteStream):
+    """Body of a response that releases the request's slot once it's closed (streamed responses hold it until then)."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+class AsyncReleasingStream(httpx.AsyncByteStream):
+    """Async counterpart of ReleasingStream."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class LimitedTransport(httpx.BaseTransport):
+    """Sends the requests of a model's client through the shared transport, within the model's limits."""
+
+    def __init__(self, transport, limiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    def handle_request(self, request):
+        self.limiter.acquire(request)
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self.limiter.record_response(response)
+        return httpx.Response(response.status_code, headers=response.headers, stream=ReleasingStream(response.stream, self.limiter.release), extensions=response.extensions)
+
+    def close(self):
+        # The shared transport outlives the clients
+        pass
+
+class AsyncLimitedTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of LimitedTransport."""
+
+    def __init__(self, transport, limiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request):
+        await self.limiter.aacquire(request)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.limiter.arelease()
+            raise
+        self.limiter.record_response(response)
+        return httpx.Response(response.status_code, headers=response.headers, stream=AsyncReleasingStream(response.stream, self.limiter.arelease), extensions=response.extensions)
+
+    async def aclose(self):
+        pass
+# -----------------------------------------------------------------------------------
+
+
+# Shared transports (created on first use) and the limiters by model
+_transports = None
+_limiters = {}
+_clients_lock = threading.Lock()
+
+def get_transports():
+    """Returns the pooled transports (sync, async) shared by all model clients."""
+    global _transports
+    with _clients_lock:
+        if _transports is None:
+            limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+            _transports = (httpx.HTTPTransport(limits=limits), httpx.AsyncHTTPTransport(limits=limits))
+    return _transports
+
+def model_limiter(model):
+    """Returns the limiter of the model's requests."""
+    with _clients_lock:
+        if model not in _limiters:
+            setting = "LLM_MAX_CONCURRENCY_" + re.sub(r"[^A-Z0-9]", "_", model.upper())
+            _limiters[model] = ModelLimiter(model, max_concurrency=int(os.getenv(setting, LLM_MAX_CONCURRENCY)))
+        return _limiters[model]
+
+def get_http_clients(model):
+    """Returns the (sync, async) http clients for a client of the model: the shared transports behind the model's limiter."""
+    transport, async_transport = get_transports()
+    limiter = model_limiter(model)
+    return (httpx.Client(transport=LimitedTransport(transport, limiter), timeout=LLM_TIMEOUT),
+            httpx.AsyncClient(transport=AsyncLimitedTransport(async_transport, limiter), timeout=LLM_TIMEOUT))
+
+
+
+
+if __name__ == "__main__":
+
+    # 6 concurrent requests of a model limited to 2 at a time, against a local server that rate limits the 3rd request
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        count = 0
+
+        def do_GET(self):
+            Handler.count += 1
+            limited = Handler.count == 3
+            time.sleep(0.2)
+            self.send_response(429 if limited else 200)
+            if limited:
+                self.send_header("retry-after-ms", "500")
+            self.send_header("content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"request": Handler.count}).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+
+    os.environ["LLM_MAX_CONCURRENCY_DEMO"] = "2"
+
+    async def main():
+        _, client = get_http_clients("demo")
+        start_time = time.perf_counter()
+
+        async def request(index):
+            response = await client.get(url)
+            print(f"request {index}: {response.status_code} after {time.perf_counter() - start_time:.2f}s")
+
+        await asyncio.gather(*(request(index) for index in range(6)))
+
+    asyncio.run(main())
+    server.shutdown()
@@ -0,0 +1,268 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import re
+import json
+import time
+import uuid
+import asyncio
+import threading
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+from pydantic import PrivateAttr
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from common.latency import LatencyDistribution
+from common.context_manager import message_text
+from common.metrics import registry, LLMMetricsCallback
+from common.retry import circuit_breaker, CircuitBreakerCallback
+
+
+# -----------------------------------------------------------------------------------
+# Factory of the chat models used by the agents
+#
+# LLM_PROVIDER=openai (default) -> ChatOpenAI
+# LLM_PROVIDER=fake             -> ScriptedChatModel, which replays responses from fixture files without any network access
+#                                  (to measure the overhead of the graphs separately from the model time, e.g. on a CI box)
+#
+# Settings of the fake backend:
+#   LLM_FIXTURES               fixture file(s) with the response rules, separated by commas (earlier files take precedence)
+#   LLM_FAKE_LATENCY           latency distribution of a response (see common/latency.py), e.g. "lognormal:0.4,0.5"
+#   LLM_FAKE_LATENCY_<AGENT>   latency distribution for a single agent (e.g. LLM_FAKE_LATENCY_POLICY)
+#   LLM_FAKE_TOKEN_LATENCY     delay between the streamed chunks of a response in seconds
+#   LLM_FAKE_SEED              seed of the latency samples
+#
+# With LLM_RECORD_FIXTURES=<path> the real models append every response to a jsonl fixture file that the fake backend can replay.
+
+# Load the api keys and the provider settings from the .env file (once, for all agents)
+load_dotenv()
+
+DEFAULT_FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "fake_llm_rules.json")
+
+
+def normalize_for_matching(text):
+    """Lowercases the text and replaces Turkish characters with their ASCII counterparts, so that the rules can be written in ASCII."""
+    text = text.replace("I", "ı").replace("İ", "i").lower()
+    return text.translate(str.maketrans("çğıöşüâîû", "cgiosuaiu"))
+
+def load_rules(paths):
+    """Loads the response rules from json files ({"rules": [...]}) or jsonl files (one rule per line, e.g. recordings)."""
+    rules = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            if path.endswith(".jsonl"):
+                rules.extend(json.loads(line) for line in file if line.strip())
+            else:
+                rules.extend(json.load(file)["rules"])
+    return rules
+
+def fill_template(value, groups):
+    """Fills the "{name}" placeholders in the strings of a rule's response with the named groups of its match."""
+    if isinstance(value, str):
+        # A string that is a single placeholder takes the group's value as it is (None if the group didn't match)
+        single = re.fullmatch(r"\{(\w+)\}", value)
+        if single and single.group(1) in groups:
+            return groups[single.group(1)]
+        return re.sub(r"\{(\w+)\}", lambda match: str(groups.get(match.group(1)) or ""), value)
+    if isinstance(value, dict):
+        return {key: fill_template(item, groups) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill_template(item, groups) for item in value]
+    return value
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Fake chat model that answers with the first matching rule of its fixtures, after an artificial delay.
+
+    A rule has the fields:
+    - "agent": name of the agent it applies to ("*" for all agents)
+    - "last_type": type of the last message it applies to ("human", "system", "tool" or "ai"), optional
+    - "match": regular expression searched in the last message (lowercased, ASCII), optional
+    - one response: "content" (text), "tool_call" ({"name", "args"}) or "structured" (output of with_structured_output)
+    Strings in the response can refer to the named groups of the match as "{name}".
+    Tool calling and structured output work as with the real model (bind_tools / with_structured_output).
+    """
+
+    agent: str
+    rules: list
+    latency: str = "none"
+    token_latency: float = 0.0
+    seed: Optional[int] = None
+    # Parameters of the model that is imitated (read by the other modules, e.g. for cache keys)
+    model_name: str = "scripted"
+    temperature: float = 0.0
+    max_tokens: Optional[int] = None
+
+    _latency: LatencyDistribution = PrivateAttr()
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def model_post_init(self, __context):
+        self._latency = LatencyDistribution(self.latency, self.seed)
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        if tool_choice is not None:
+            kwargs["tool_choice"] = tool_choice
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    # -------------------------------------------------------------------------------
+    # Responses
+
+    def _find_rule(self, messages):
+        last_message = messages[-1]
+        text = normalize_for_matching(message_text(last_message))
+        for rule in self.rules:
+            if rule.get("agent", "*") not in ("*", self.agent):
+                continue
+            if "last_type" in rule and rule["last_type"] != last_message.type:
+                continue
+            match = re.search(rule.get("match", ""), text, re.DOTALL)
+            if match:
+                return rule, match.groupdict()
+
+        raise ValueError(f"No fixture rule of agent '{self.agent}' matches the last {last_message.type} message: {text[:200]!r}")
+
+    def _respond(self, messages, kwargs):
+        """Returns the ai message of the first matching rule."""
+        rule, groups = self._find_rule(messages)
+
+        if "structured" in rule:
+            # with_structured_output binds the output schema as the only tool and parses the arguments of its call
+            tools = kwargs.get("tools") or []
+            if not tools:
+                raise ValueError(f"Rule with a structured response used without with_structured_output: {rule}")
+            tool_call = {"name": tools[0]["function"]["name"], "args": fill_template(rule["structured"], groups)}
+        elif "tool_call" in rule:
+            tool_call = fill_template(rule["tool_call"], groups)
+        else:
+            return AIMessage(content=fill_template(rule.get("content", ""), groups))
+
+        return AIMessage(content="", tool_calls=[{"name": tool_call["name"], "args": tool_call["args"], "id": f"call_{uuid.uuid4().hex[:24]}", "type": "tool_call"}])
+
+    def _sample_latency(self):
+        with self._lock:
+            return self._latency.sample()
+
+    def _chunks(self, message):
+        """Splits the response into the chunks of a stream (words of the content, or a single tool call chunk)."""
+        if message.tool_calls:
+            return [AIMessageChunk(content="", tool_call_chunks=[
+                {"name": tool_call["name"], "args": json.dumps(tool_call["args"], ensure_ascii=False), "id": tool_call["id"], "index": index}
+                for index, tool_call in enumerate(message.tool_calls)])]
+        return [AIMessageChunk(content=piece) for piece in re.findall(r"\S+\s*|\s+", message.content)] or [AIMessageChunk(content="")]
+    # -------------------------------------------------------------------------------
+
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs)
+        time.sleep(self._sample_latency() + self.token_latency * len(self._chunks(message)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs)
+        await asyncio.sleep(self._sample_latency() + self.token_latency * len(self._chunks(message)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs)
+        time.sleep(self._sample_latency())
+        for chunk in self._chunks(message):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, kwargs)
+        await asyncio.sleep(self._sample_latency())
+        for chunk in self._chunks(message):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=chunk)
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+class FixtureRecorder(BaseCallbackHandler):
+    """Callback handler that appends the responses of a real model to a jsonl fixture file, as rules that match the same last message."""
+
+    def __init__(self, agent, path):
+        self.agent = agent
+        self.path = path
+        self._last_messages = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        last_message = messages[0][-1]
+        structured = "response_format" in kwargs.get("invocation_params", {})
+        self._last_messages[run_id] = (last_message, structured)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        last_message, structured = self._last_messages.pop(run_id, (None, False))
+        if last_message is None:
+            return
+
+        message = response.generations[0][0].message
+        rule = {"agent": self.agent, "last_type": last_message.type, "match": "^" + re.escape(normalize_for_matching(message_text(last_message))) + "$"}
+        if message.tool_calls:
+            rule["tool_call"] = {"name": message.tool_calls[0]["name"], "args": message.tool_calls[0]["args"]}
+        elif structured:
+            rule["structured"] = json.loads(message.content)
+        else:
+            rule["content"] = message.content
+
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(rule, ensure_ascii=False) + "\n")
+# -----------------------------------------------------------------------------------
+
+
+def get_chat_model(agent, **params):
+    """Returns the chat model of an agent for the configured provider.
+
+    `params` are the ChatOpenAI parameters (model, temperature, max_tokens etc.), the fake backend only keeps the
+    ones that other modules read.
+    """
+    # Latency, status and tokens of the agent's calls are recorded in the metrics
+    if registry.enabled:
+        params = {**params, "callbacks": [*params.get("callbacks", []), LLMMetricsCallback(agent)]}
+
+    # The calls of all agents fail right away while the provider keeps failing (see common/retry.py)
+    params = {**params, "callbacks": [*params.get("callbacks", []), CircuitBreakerCallback(circuit_breaker("llm"))]}
+
+    # Read at call time, so that the settings can be changed after the import (e.g. by the benchmarks)
+    provider = os.getenv("LLM_PROVIDER", "openai").lower()
+    if provider == "fake":
+        fixture_paths = [path.strip() for path in os.getenv("LLM_FIXTURES", DEFAULT_FIXTURES_PATH).split(",") if path.strip()]
+        seed = os.getenv("LLM_FAKE_SEED")
+        return ScriptedChatModel(
+            agent=agent,
+            rules=load_rules(fixture_paths),
+            latency=os.getenv(f"LLM_FAKE_LATENCY_{agent.upper()}", os.getenv("LLM_FAKE_LATENCY", "none")),
+            token_latency=float(os.getenv("LLM_FAKE_TOKEN_LATENCY", 0)),
+            seed=int(seed) if seed is not None else None,
+            model_name=f"scripted-{params.get('model', 'model')}",
+            temperature=params.get("temperature", 0.0),
+            max_tokens=params.get("max_tokens"),
+            callbacks=params.get("callbacks"),
+        )
+
+    if provider != "openai":
+        raise ValueError(f"Unknown LLM_PROVIDER: {provider}")
+
+    from langchain_openai import ChatOpenAI
+    from common.llm_clients import get_http_clients, LLM_TIMEOUT
+
+    # The clients share one pooled transport, within the concurrency and rate limits of their model (see common/llm_clients.py)
+    http_client, http_async_client = get_http_clients(params.get("model", "gpt-3.5-turbo"))
+    params = {"timeout": LLM_TIMEOUT, **params, "http_client": http_client, "http_async_client": http_async_client}
+
+    record_path = os.getenv("LLM_RECORD_FIXTURES")
+    if record_path:
+        params = {**params, "callbacks": [*params.get("callbacks", []), FixtureRecorder(agent, record_path)]}
+    return ChatOpenAI(**params)
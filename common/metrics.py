@@ -0,0 +1,336 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from common.context_manager import count_messages_tokens, response_token_usage, response_cached_tokens
+
+
+# -----------------------------------------------------------------------------------
+# In-process metrics registry (counters, gauges and histograms with labels) rendered in the Prometheus text format.
+#
+# The metrics are served by the HTTP server at GET /metrics, and can also be written to a file periodically
+# (METRICS_DUMP_PATH, every METRICS_DUMP_INTERVAL seconds), e.g. for the node exporter's textfile collector.
+
+# The metrics can be disabled entirely (the recording calls then do nothing)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", 15))
+
+# Default histogram buckets in seconds (from fast local steps to slow llm calls)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """Base class of the metric types: a value per combination of label values."""
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), enabled=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.enabled = enabled
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Returns (name suffix, label values, extra labels, value) tuples of the current values."""
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value that only goes up (number of searches, purchases etc.)."""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down (active sessions, store size). It can also be computed on every read with `set_function`."""
+
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """Computes the value with `function()` whenever the metrics are read."""
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                # A failing gauge function mustn't break the whole metrics page
+                continue
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of observed values (latencies) in cumulative buckets, with their sum and count."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, enabled=True):
+        super().__init__(name, documentation, labelnames, enabled)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of a block of code in seconds."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, (("le", format_value(bound) if bound == float("inf") else repr(bound)),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._metrics = {}
+        self._dump_thread = None
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames, enabled=self.enabled))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames, enabled=self.enabled))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets, enabled=self.enabled))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+    def dump(self, path):
+        """Writes the metrics to a file (replaced atomically, so that readers never see a partial file)."""
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(temporary_path, path)
+
+    def start_file_dump(self, path=METRICS_DUMP_PATH, interval=METRICS_DUMP_INTERVAL):
+        """Writes the metrics to the file every `interval` seconds in a background thread (does nothing if no path is set)."""
+        if not path or not self.enabled or self._dump_thread is not None:
+            return
+
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError:
+                    pass
+
+        self._dump_thread = threading.Thread(target=dump_loop, name="metrics-dump", daemon=True)
+        self._dump_thread.start()
+
+
+registry = MetricsRegistry()
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Metrics of the assistant
+
+flight_searches = registry.counter("flight_searches_total", "Flight searches by trip type and outcome (found, empty, error).", ["trip_type", "outcome"])
+policy_checks = registry.counter("policy_checks_total", "Policy checks of the selected flights by result (pass, fail).", ["result"])
+manager_escalations = registry.counter("manager_escalations_total", "Exception approval requests sent to managers, by status (sent, failed).", ["status"])
+manager_approvals = registry.counter("manager_approvals_total", "Parked sessions resumed with the manager's decision on their escalation, by outcome (purchased, purchase_failed, rejected, superseded, retried, failed).", ["outcome"])
+ticket_purchases = registry.counter("ticket_purchases_total", "Ticket purchases by trip type and status (completed, failed).", ["trip_type", "status"])
+seat_holds = registry.counter("seat_holds_total", "Seat hold attempts by result (held, taken).", ["result"])
+escalation_outbox_messages = registry.counter("escalation_outbox_messages_total", "Manager escalations in the outbox by event (enqueued, deduplicated, delivered, retried, failed, approved, rejected, dispatch_error).", ["status"])
+
+llm_requests = registry.counter("llm_requests_total", "Llm calls by agent and status (ok, error).", ["agent", "status"])
+llm_latency = registry.histogram("llm_request_duration_seconds", "Duration of the llm calls by agent.", ["agent"])
+llm_tokens = registry.counter("llm_tokens_total", "Llm tokens by agent and direction (input, output); counted locally when the provider doesn't report them.", ["agent", "direction"])
+llm_cached_tokens = registry.counter("llm_cached_tokens_total", "Input tokens of the llm calls served from the provider's prompt cache, by agent (the cached ratio is this over the input llm_tokens_total).", ["agent"])
+llm_queue_wait = registry.histogram("llm_queue_wait_seconds", "Time the llm requests waited for a free slot of their model (and the end of a rate limit cooldown), by model.", ["model"])
+llm_rate_limited = registry.counter("llm_rate_limited_total", "Llm responses rate limited by the provider (429), by model.", ["model"])
+
+node_latency = registry.histogram("graph_node_duration_seconds", "Duration of the graph node executions (including waits for the user's answers) by node.", ["node"])
+active_sessions = registry.gauge("active_sessions", "Open chat sessions.")
+checkpoint_store_bytes = registry.gauge("checkpoint_store_bytes", "Size of the stored checkpoints (serialized bytes in memory, or the size of the database files), by graph.", ["graph"])
+node_retries = registry.counter("node_retries_total", "Failed attempts of the graph nodes that call external systems, by node and outcome (retried, exhausted).", ["node", "outcome"])
+prefetches = registry.counter("prefetches_total", "Speculative flight searches and policy checks started during the user's think time, by kind (search, policy) and outcome (started, used, failed, discarded, expired).", ["kind", "outcome"])
+flight_state_compactions = registry.counter("flight_state_compactions_total", "Compactions of the flight state, by reason (booking_completed, search_restart).", ["reason"])
+circuit_breaker_state = registry.gauge("circuit_breaker_state", "State of the circuit breakers by downstream system (0 closed, 1 half open, 2 open).", ["downstream"])
+
+
+def memory_saver_bytes(checkpointer):
+    """Returns the serialized size of everything an in-memory checkpointer (MemorySaver) holds."""
+    total = 0
+    for namespaces in list(checkpointer.storage.values()):
+        for checkpoints in list(namespaces.values()):
+            for checkpoint, metadata, _ in list(checkpoints.values()):
+                total += len(checkpoint[1]) + len(metadata)
+    total += sum(len(value) for _, value in list(checkpointer.blobs.values()))
+    for writes in list(checkpointer.writes.values()):
+        total += sum(len(value[1]) for _, _, value, _ in list(writes.values()))
+    return total
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Callback handler of an agent's chat model that records the latency, status and tokens of its calls."""
+
+    def __init__(self, agent):
+        self.agent = agent
+        # run_id -> (start time, estimated input tokens)
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._runs[run_id] = (time.perf_counter(), count_messages_tokens(messages[0]) if messages else 0)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start_time, estimated_input_tokens = self._runs.pop(run_id, (None, 0))
+        if start_time is None:
+            return
+        llm_latency.observe(time.perf_counter() - start_time, agent=self.agent)
+        llm_requests.inc(agent=self.agent, status="ok")
+
+        input_tokens, output_tokens, _ = response_token_usage(response)
+        llm_tokens.inc(input_tokens if input_tokens is not None else estimated_input_tokens, agent=self.agent, direction="input")
+        llm_tokens.inc(output_tokens or 0, agent=self.agent, direction="output")
+        llm_cached_tokens.inc(response_cached_tokens(response) or 0, agent=self.agent)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start_time, _ = self._runs.pop(run_id, (None, 0))
+        if start_time is not None:
+            llm_latency.observe(time.perf_counter() - start_time, agent=self.agent)
+        llm_requests.inc(agent=self.agent, status="error")
+
+
+class NodeMetricsCallback(BaseCallbackHandler):
+    """Callback handler of the graph runs that records the duration of the node executions (of both graphs)."""
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        # The run of a node has the node's name, the runs inside the node inherit its metadata
+        name = kwargs.get("name")
+        if metadata and metadata.get("langgraph_node") == name:
+            self._runs[run_id] = (name, time.perf_counter())
+
+    def _finish(self, run_id):
+        entry = self._runs.pop(run_id, None)
+        if entry is not None:
+            node_latency.observe(time.perf_counter() - entry[1], node=entry[0])
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+
+node_metrics_callback = NodeMetricsCallback()
+
+def metrics_callbacks():
+    """Callback handlers to put in the config of a graph run ("callbacks" key), empty if the metrics are disabled."""
+    return [node_metrics_callback] if registry.enabled else []
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    # Print the metrics page of a few recorded values
+    flight_searches.inc(trip_type="one-way", outcome="found")
+    policy_checks.inc(result="fail")
+    with llm_latency.time(agent="travel"):
+        time.sleep(0.02)
+    active_sessions.set(3)
+    print(registry.render())
@@ -0,0 +1,140 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import json
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+
+from langchain_core.messages import SystemMessage
+
+from common.context_manager import count_text_tokens
+
+
+# -----------------------------------------------------------------------------------
+# Registry of the static prompt prefixes of the agents.
+#
+# The provider caches the longest prompt prefix it has seen recently (from 1024 tokens on, for OpenAI), and bills and
+# serves the cached part faster. So the prompts are laid out as a static prefix that is the same for every call of an
+# agent (instructions, few-shot examples), followed by a small dynamic part (today's date) and the conversation, and
+# nothing that changes between the calls (like the date) is embedded in the prefix.
+#
+# Every prefix is registered with a version and the hash of its text. The versions are recorded in prompt_versions.json,
+# so that a prefix changed without a version bump is caught (python common/prompts.py --check), and the llm calls carry
+# the name, version and hash of their prefix in their metadata (traces, cache keys).
+
+PROMPT_VERSIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_versions.json")
+
+# Minimum prompt length the provider caches
+MIN_CACHEABLE_TOKENS = 1024
+
+
+class PromptPrefix:
+    """Static prefix of an agent's prompt with its version and hash."""
+
+    def __init__(self, name, version, text):
+        self.name = name
+        self.version = version
+        self.text = text
+        self.hash = hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    @property
+    def metadata(self):
+        """Metadata of the llm calls that send the prefix."""
+        return {"prompt": self.name, "prompt_version": self.version, "prompt_hash": self.hash}
+
+    def tokens(self):
+        return count_text_tokens(self.text)
+
+
+_prompts = {}
+_prompts_lock = threading.Lock()
+
+def register_prompt(name, version, text):
+    """Registers the static prefix of an agent's prompt and returns it."""
+    prefix = PromptPrefix(name, version, text)
+    with _prompts_lock:
+        _prompts[name] = prefix
+    return prefix
+
+def registered_prompts():
+    with _prompts_lock:
+        return dict(_prompts)
+
+
+def date_context(today=None):
+    """Dynamic part of the prompts: today's date and weekday (changes once a day, so it's kept out of the static prefixes)."""
+    today = today or datetime.now()
+    return f"Today's date (in YYYY-MM-DD format) and the corresponding weekday: {today.strftime('%Y-%m-%d %A')}"
+
+def with_dynamic_context(messages, text):
+    """Returns the messages with the dynamic part of the prompt inserted as a system message right after the static prompt
+    (the first message), so that everything before it stays the same for every call of the agent."""
+    messages = list(messages)
+    index = 1 if messages and messages[0].type == "system" else 0
+    return messages[:index] + [SystemMessage(content=text)] + messages[index:]
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Recorded versions
+
+def load_prompt_versions(path=PROMPT_VERSIONS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+def check_prompt_versions(prompts, recorded):
+    """Returns the problems of the registered prefixes against the recorded versions (empty if they all match)."""
+    problems = []
+    for name, prefix in sorted(prompts.items()):
+        entry = recorded.get(name)
+        if entry is None:
+            problems.append(f"{name}: not recorded")
+        elif entry["version"] == prefix.version and entry["hash"] != prefix.hash:
+            problems.append(f"{name}: the prefix changed without a version bump (version {prefix.version})")
+        elif entry["version"] != prefix.version:
+            problems.append(f"{name}: version {prefix.version} isn't recorded (recorded {entry['version']})")
+    return problems
+
+def write_prompt_versions(prompts, path=PROMPT_VERSIONS_PATH):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({name: {"version": prefix.version, "hash": prefix.hash} for name, prefix in sorted(prompts.items())}, file, indent=2)
+        file.write("\n")
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Lists the static prompt prefixes of the agents, and checks or records their versions.")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if a prefix changed without a version bump")
+    parser.add_argument("--update", action="store_true", help="record the current versions and hashes")
+    args = parser.parse_args()
+
+    # The agents register their prefixes on import, in the registry of the common.prompts module (not this script's)
+    import travel_agent
+    import flight_assistant.flight_agent
+    import policy_assistant.policy_agent
+    from common.prompts import registered_prompts
+
+    prompts = registered_prompts()
+    print(f"{'prompt':<10}{'version':>9}{'hash':>20}{'tokens':>9}  cached alone")
+    for name, prefix in sorted(prompts.items()):
+        tokens = prefix.tokens()
+        print(f"{name:<10}{prefix.version:>9}{prefix.hash:>20}{tokens:>9}  {'yes' if tokens >= MIN_CACHEABLE_TOKENS else 'no'}")
+    # A shorter prefix is still cached as the start of the longer prompts (tools, conversation) that it's sent with
+    print(f"\n(the provider caches prompts from {MIN_CACHEABLE_TOKENS} tokens on, shorter prefixes are cached with the conversation that follows them)")
+
+    if args.update:
+        write_prompt_versions(prompts)
+        print(f"\nVersions written to {PROMPT_VERSIONS_PATH}")
+    elif args.check:
+        problems = check_prompt_versions(prompts, load_prompt_versions())
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
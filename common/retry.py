@@ -0,0 +1,179 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import time
+import random
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from common.metrics import circuit_breaker_state
+
+
+# -----------------------------------------------------------------------------------
+# Bounded retries and circuit breakers for the graph nodes that call external systems.
+#
+# RetryPolicy: a node that fails is retried at most max_attempts times in total, waiting with an exponential backoff
+# (doubling from initial_delay up to max_delay, with random jitter so that many sessions don't retry in lockstep).
+# Once the budget is used up the node gives up and tells the user, instead of retrying forever.
+#
+# CircuitBreaker (one per downstream system: "llm", "flight_db", "airline", "corporate"): after failure_threshold
+# consecutive failures the circuit opens and the calls fail right away with CircuitOpenError for reset_timeout
+# seconds, then a single trial call is let through (half open) and closes the circuit again if it succeeds.
+#   RETRY_MAX_ATTEMPTS, RETRY_INITIAL_DELAY, RETRY_MAX_DELAY   retry policy of the nodes
+#   CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT           settings of the circuit breakers
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+RETRY_INITIAL_DELAY = float(os.getenv("RETRY_INITIAL_DELAY", 0.5))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 8))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+
+
+class RetryPolicy:
+    """Maximum attempts and jittered exponential backoff of a retried operation."""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, initial_delay=RETRY_INITIAL_DELAY, max_delay=RETRY_MAX_DELAY, multiplier=2.0, seed=None):
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self._random = random.Random(seed)
+
+    def exhausted(self, failed_attempts):
+        """Returns True if no attempt is left after the given number of failed attempts."""
+        return failed_attempts >= self.max_attempts
+
+    def backoff(self, failed_attempts):
+        """Returns the wait in seconds before the next attempt: half of the exponential delay plus a random part of the other half."""
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** (failed_attempts - 1))
+        return delay / 2 + self._random.uniform(0, delay / 2)
+
+    def sleep(self, failed_attempts):
+        time.sleep(self.backoff(failed_attempts))
+
+    async def asleep(self, failed_attempts):
+        await asyncio.sleep(self.backoff(failed_attempts))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a downstream system whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Stops calling a downstream system that keeps failing (see the notes above)."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._trial_running = False
+            return self._state
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call shouldn't be made (open circuit, or a trial call is already running)."""
+        state = self.state
+        with self._lock:
+            if state == self.OPEN or (state == self.HALF_OPEN and self._trial_running):
+                raise CircuitOpenError(f"The circuit of '{self.name}' is open after repeated failures")
+            if state == self.HALF_OPEN:
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        """Runs a call of the downstream system through the breaker (works around awaits too)."""
+        self.before_call()
+        try:
+            yield
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+
+
+class CircuitBreakerCallback(BaseCallbackHandler):
+    """Callback handler of a chat model that runs its calls through a circuit breaker."""
+
+    # Let the CircuitOpenError of an open circuit stop the call (callback errors are only logged otherwise)
+    raise_error = True
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.breaker.before_call()
+
+    def on_llm_end(self, response, **kwargs):
+        self.breaker.record_success()
+
+    def on_llm_error(self, error, **kwargs):
+        self.breaker.record_failure()
+# -----------------------------------------------------------------------------------
+
+
+# Circuit breakers by downstream name (created on first use) and the retry policy of the graph nodes
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def circuit_breaker(name):
+    """Returns the circuit breaker of the downstream system."""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            breaker = _circuit_breakers[name] = CircuitBreaker(name)
+            circuit_breaker_state.set_function(lambda: {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[breaker.state], downstream=name)
+        return _circuit_breakers[name]
+
+node_retry_policy = RetryPolicy()
+
+
+
+
+if __name__ == "__main__":
+
+    # A downstream that fails 6 times: the circuit opens after 3 failures and is tried again after the reset timeout
+    breaker = CircuitBreaker("demo", failure_threshold=3, reset_timeout=0.2)
+    failures = iter(range(6))
+
+    for call in range(12):
+        try:
+            with breaker.guard():
+                if next(failures, None) is not None:
+                    raise ConnectionError("downstream unavailable")
+            print(f"call {call}: ok")
+        except (ConnectionError, CircuitOpenError) as e:
+            print(f"call {call}: {type(e).__name__} ({breaker.state})")
+        time.sleep(0.1)
+
+    policy = RetryPolicy(max_attempts=5, seed=1)
+    print("backoffs:", [round(policy.backoff(attempt), 3) for attempt in range(1, 5)])
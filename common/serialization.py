@@ -0,0 +1,217 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import atexit
+import queue
+import threading
+import dataclasses
+
+import orjson
+from pydantic import BaseModel
+from langchain_core.messages import BaseMessage
+
+
+# -----------------------------------------------------------------------------------
+# Serialization of the graph states and other objects for the logs and the traces.
+#
+# Objects are converted to json-compatible values with type-specific encoders (messages, tool calls, flights, pydantic
+# models, dataclasses, other objects by their attributes) and written with orjson. A dump is bounded, so that dumping a
+# large state (e.g. on an error path) can't stall the process: strings, containers and the nesting depth are truncated,
+# and an object that contains itself is written once. The JSONL writer of the trace log writes in a background thread.
+#   DUMP_MAX_STRING   characters of a string kept in a dump
+#   DUMP_MAX_ITEMS    items of a list or dict kept in a dump
+#   DUMP_MAX_DEPTH    nesting depth kept in a dump
+
+DUMP_MAX_STRING = int(os.getenv("DUMP_MAX_STRING", 2000))
+DUMP_MAX_ITEMS = int(os.getenv("DUMP_MAX_ITEMS", 50))
+DUMP_MAX_DEPTH = int(os.getenv("DUMP_MAX_DEPTH", 12))
+
+
+def is_flight(value):
+    return isinstance(value, dict) and "flight_code" in value and "airline" in value
+
+def is_tool_call(value):
+    return isinstance(value, dict) and value.get("type") == "tool_call" and "name" in value
+
+
+def encode_flight(flight):
+    """A flight (search result, selection or ticket) as a single line, e.g. "TK802 THY 2025-06-10 Istanbul->Ankara 09:00-10:20 Economy 1500 TL"."""
+    route = f"{flight['from_city']}->{flight['to_city']}" if "from_city" in flight and "to_city" in flight else None
+    times = f"{flight['departure_time']}-{flight['arrival_time']}" if "departure_time" in flight and "arrival_time" in flight else None
+    price = f"{flight['price']} TL" if "price" in flight else None
+    seat = f"seat {flight['seat_number']}" if flight.get("seat_number") is not None else None
+    parts = [flight["flight_code"], flight["airline"], flight.get("date"), route, times, flight.get("class") or flight.get("flight_class"), price, seat, flight.get("pnr_number")]
+    return " ".join(str(part) for part in parts if part)
+
+def encode_tool_call(tool_call):
+    encoded = {"tool_call": tool_call["name"], "id": tool_call.get("id"), "args": tool_call.get("args")}
+    if "status" in tool_call:
+        encoded["status"] = tool_call["status"]
+    return encoded
+
+def encode_message(message):
+    """A message by its type, content and the fields that matter for debugging the graphs (tool calls, tool results)."""
+    encoded = {"type": message.type, "content": message.content}
+    if message.id:
+        encoded["id"] = message.id
+    if getattr(message, "tool_calls", None):
+        encoded["tool_calls"] = [encode_tool_call({**tool_call, "type": "tool_call"}) for tool_call in message.tool_calls]
+    if getattr(message, "invalid_tool_calls", None):
+        encoded["invalid_tool_calls"] = [{"name": tool_call.get("name"), "args": tool_call.get("args"), "error": tool_call.get("error")} for tool_call in message.invalid_tool_calls]
+    if message.type == "tool":
+        encoded["tool_call_id"] = message.tool_call_id
+        encoded["status"] = message.status
+    return encoded
+
+def encode_object(value):
+    """Encodes a value that isn't json-compatible itself into one that is (one level; the result may contain more objects)."""
+    if isinstance(value, BaseMessage):
+        return encode_message(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: getattr(value, field.name) for field in dataclasses.fields(value)}
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        return {key: item for key, item in vars(value).items() if not key.startswith("_")}
+    return repr(value)
+
+
+def to_jsonable(value, max_string=DUMP_MAX_STRING, max_items=DUMP_MAX_ITEMS, max_depth=DUMP_MAX_DEPTH):
+    """Converts a value into a bounded json-compatible value (see the notes above)."""
+    # Ids of the containers on the path to the current value (an object found inside itself is a cycle)
+    path = set()
+
+    def convert(value, depth):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, str):
+            return value if len(value) <= max_string else value[:max_string] + f"... <{len(value) - max_string} more characters>"
+        if is_flight(value):
+            return encode_flight(value)
+        if is_tool_call(value):
+            value = encode_tool_call(value)
+        if depth >= max_depth:
+            return f"<{type(value).__name__} at max depth>"
+        if id(value) in path:
+            return f"<cycle: {type(value).__name__}>"
+
+        path.add(id(value))
+        try:
+            if isinstance(value, dict):
+                items = list(value.items())
+                converted = {str(key): convert(item, depth + 1) for key, item in items[:max_items]}
+                if len(items) > max_items:
+                    converted["..."] = f"<{len(items) - max_items} more items>"
+                return converted
+            if isinstance(value, list):
+                converted = [convert(item, depth + 1) for item in value[:max_items]]
+                if len(value) > max_items:
+                    converted.append(f"<{len(value) - max_items} more items>")
+                return converted
+            return convert(encode_object(value), depth)
+        finally:
+            path.discard(id(value))
+
+    return convert(value, 0)
+
+
+def dumps(value, indent=False):
+    """Serializes a value into json bytes without bounding it (objects are encoded with encode_object)."""
+    return orjson.dumps(value, default=encode_object, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+
+def dump(value, indent=False):
+    """Serializes a bounded dump of a value into json bytes."""
+    return orjson.dumps(to_jsonable(value), option=orjson.OPT_INDENT_2 if indent else 0)
+
+def serialized_size(value):
+    """Size of a value in bytes in its json form (e.g. states and outputs in the traces)."""
+    try:
+        return len(dumps(value))
+    except (TypeError, orjson.JSONEncodeError):
+        # Cycles of plain containers, integers that don't fit 64 bits etc.
+        return len(dump(value))
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+class JsonlWriter:
+    """Appends records to a JSONL file from a background thread.
+
+    The records are serialized by the caller (so they are captured as they are), and the file is written and flushed by
+    the writer thread in batches, so that writing a large record doesn't block the caller. The queued records are
+    written before the process exits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        self.write_line(dumps(record))
+
+    def write_line(self, line):
+        """Queues a serialized record (json bytes)."""
+        with self._lock:
+            # The file and the thread are created on the first record, so that importing the modules doesn't create them
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put(line)
+
+    def _run(self):
+        with open(self.path, "ab") as file:
+            while True:
+                lines = [self._queue.get()]
+                # Write everything that's queued at once
+                while True:
+                    try:
+                        lines.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in lines
+                file.write(b"".join(line + b"\n" for line in lines if line is not None))
+                file.flush()
+                if stop:
+                    return
+
+    def flush(self):
+        """Waits until the queued records are written."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def close(self):
+        self.flush()
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    import time
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+    # A flight state with many messages and flights, a long string and a cycle
+    flights = [{"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500 + index, "flight_code": f"TK{800 + index}", "date": "2025-06-10"} for index in range(40)]
+    messages = [SystemMessage(content="prompt " * 2000)]
+    for index in range(200):
+        messages.append(HumanMessage(content=f"mesaj {index}"))
+        messages.append(AIMessage(content="", tool_calls=[{"name": "search_flights", "args": {"from_city": "Istanbul", "to_city": "Ankara"}, "id": f"call_{index}"}]))
+        messages.append(ToolMessage(content=str(flights), tool_call_id=f"call_{index}"))
+    state = {"messages": messages, "retrieved_depart_flights": flights, "selected_depart_flight": flights[0], "latest_tool_call": {"name": "search_flights", "args": {}, "id": "call_1", "type": "tool_call", "status": "pending"}}
+    state["self"] = state
+
+    start_time = time.perf_counter()
+    output = dump(state, indent=True)
+    print(f"Bounded dump: {len(output)} bytes in {1000 * (time.perf_counter() - start_time):.1f} ms")
+    print(output[:800].decode())
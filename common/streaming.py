@@ -0,0 +1,138 @@
+import time
+import threading
+
+from langchain_core.utils.json import parse_partial_json
+
+
+# -----------------------------------------------------------------------------------
+# Token-level streaming of the assistant responses (graph runs with stream_mode=["messages", "updates"])
+#
+# Only the llm calls whose output is a response to the user are streamed. They are tagged with one of the tags below
+# (the tags of a runnable's config are passed down to the chat model calls inside it, and show up in the metadata of the streamed chunks).
+
+# The output is a plain chat response (or a tool call, which isn't streamed)
+STREAM_TEXT_TAG = "stream_text"
+# The output is a structured (json) output, and only the "response" field of the object under "travel_output" is streamed
+STREAM_TRAVEL_OUTPUT_TAG = "stream_travel_output"
+
+
+def structured_response_text(raw_json):
+    """Returns the text of the response field in the (possibly incomplete) json of a TravelOutput, or None if it's not a chat response (yet)."""
+    try:
+        output = parse_partial_json(raw_json)
+    except Exception:
+        return None
+
+    if isinstance(output, dict) and isinstance(output.get("travel_output"), dict):
+        response = output["travel_output"].get("response")
+        if isinstance(response, str):
+            return response
+    return None
+
+
+class ResponseStreamer:
+    """Turns the message chunks of a graph stream into text deltas of the assistant responses for a single turn.
+
+    The complete responses also come with the node updates after the node finishes. `is_streamed()` tells whether
+    a complete response was already shown to the user token by token, so that it isn't shown a second time.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        # Text accumulated so far for each streamed llm call, keyed by the message (run) id of the chunks
+        self._raw = {}
+        self._text = {}
+        # Complete texts of the streamed responses, not yet matched with the node updates
+        self._streamed = []
+
+    def feed(self, chunk, metadata):
+        """Returns the new text of a response in the message chunk (None if the chunk isn't part of a streamed response)."""
+        tags = metadata.get("tags", [])
+        if STREAM_TEXT_TAG in tags:
+            structured = False
+        elif STREAM_TRAVEL_OUTPUT_TAG in tags:
+            structured = True
+        else:
+            return None
+
+        # Only the chunks generated by a chat model are streamed (not complete messages returned by a node)
+        if chunk.type != "AIMessageChunk":
+            return None
+
+        key = chunk.id
+        # The structured output may be generated as the message content (json schema) or as the arguments of a tool call (function calling)
+        piece = chunk.content if isinstance(chunk.content, str) else ""
+        if structured and not piece:
+            piece = "".join(tool_call_chunk.get("args") or "" for tool_call_chunk in chunk.tool_call_chunks)
+        if not piece:
+            return None
+
+        self._raw[key] = self._raw.get(key, "") + piece
+        if structured:
+            text = structured_response_text(self._raw[key])
+            if text is None:
+                return None
+        else:
+            text = self._raw[key]
+
+        # Emit only the part of the text that wasn't emitted before
+        previous_text = self._text.get(key, "")
+        if not text.startswith(previous_text) or len(text) == len(previous_text):
+            return None
+        self._text[key] = text
+
+        if previous_text == "":
+            self._streamed.append(key)
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+
+        return text[len(previous_text):]
+
+    def is_streamed(self, text):
+        """Whether the complete response text was already streamed to the user (each streamed response matches once)."""
+        for key in self._streamed:
+            if self._text[key].strip() == text.strip():
+                self._streamed.remove(key)
+                return True
+        return False
+
+    @property
+    def time_to_first_token(self):
+        """Seconds from the start of the turn to the first streamed token (None if nothing was streamed)."""
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+
+class StreamingStats:
+    """Collects the time to first token of the turns (the perceived latency of the assistant)."""
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def record(self, streamer):
+        if streamer.time_to_first_token is None:
+            return
+        with self._lock:
+            self._samples.append(streamer.time_to_first_token)
+            # Keep only the latest samples
+            del self._samples[:-self.max_samples]
+
+    def get_stats(self):
+        """Returns the number of samples and the mean/p50/p95 time to first token in seconds."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {"turns": 0}
+
+        def percentile(p):
+            return samples[min(int(p / 100 * len(samples)), len(samples) - 1)]
+
+        return {"turns": len(samples), "ttft_mean": sum(samples) / len(samples), "ttft_p50": percentile(50), "ttft_p95": percentile(95)}
+
+
+streaming_stats = StreamingStats()
+# -----------------------------------------------------------------------------------
@@ -0,0 +1,452 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import json
+import time
+import uuid
+import inspect
+import argparse
+import threading
+import functools
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import var_child_runnable_config
+
+from common.context_manager import count_messages_tokens, response_token_usage, response_cached_tokens
+from common.serialization import JsonlWriter, dumps, to_jsonable, serialized_size
+
+
+# -----------------------------------------------------------------------------------
+# Tracing of where the time of a turn goes (disabled unless TRACING_ENABLED=1)
+#
+# Spans are recorded for the graph runs, the nodes of both graphs, llm calls (with token counts), tool runs, and the
+# parts in between that aren't runnables: SQLite queries, the simulated airline/mail systems, waits for the user's
+# answers and checkpoint writes (with their serialized size). They are appended to a local JSONL file, one span per line,
+# with the fields of the OpenTelemetry span data model (trace_id, span_id, parent_span_id, name, kind, start/end time in
+# unix nanoseconds, attributes, status), and summarized offline with:
+#
+#   python common/tracing.py traces.jsonl
+#
+# Span kinds: "graph", "node", "llm", "tool", "db", "external", "human", "checkpoint", and "dump" for the states dumped on
+# the error paths (see Tracer.dump)
+#
+# The spans are serialized with orjson (common/serialization.py) and written to the file by a background thread, so
+# that a large span doesn't block the turn that records it.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"
+TRACE_PATH = os.getenv("TRACE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "traces.jsonl"))
+
+# Span of the code that is running (for the spans that aren't callback runs)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def payload_size(value):
+    """Approximate size of a state or an output in bytes (length of its json form)."""
+    return serialized_size(value)
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Span:
+    """A timed operation with attributes, written to the trace file when it ends."""
+
+    def __init__(self, name, kind, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self._start_counter = time.perf_counter_ns()
+        self.status = {"code": "OK"}
+
+    def set_error(self, error):
+        self.status = {"code": "ERROR", "message": f"{type(error).__name__}: {error}"}
+
+    def to_dict(self):
+        duration = time.perf_counter_ns() - self._start_counter
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time_unix_nano": self.start_time,
+            "end_time_unix_nano": self.start_time + duration,
+            "duration_ms": round(duration / 1e6, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class Tracer:
+    """Records spans to a JSONL file. Callback runs (graphs, nodes, llm calls, tools) are traced by `callback_handler`,
+    other code with `span()` / `traced()`, which are attached to the run or span they are called in."""
+
+    def __init__(self, path=TRACE_PATH, enabled=TRACING_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self.callback_handler = TracingCallbackHandler(self)
+        # The file is opened on the first span, so that importing the modules doesn't create it
+        self._writer = JsonlWriter(path)
+
+    def export(self, span):
+        record = span.to_dict()
+        try:
+            line = dumps(record)
+        except TypeError:
+            # Attributes that orjson can't write even with the encoders (e.g. integers beyond 64 bits)
+            line = dumps(to_jsonable(record))
+        self._writer.write_line(line)
+
+    def flush(self):
+        """Waits until the recorded spans are written to the file (done at exit anyway)."""
+        self._writer.flush()
+
+    def dump(self, name, value):
+        """Records a bounded dump of a value (e.g. the state on an error path) as a "dump" span of the running trace."""
+        if not self.enabled:
+            return
+        state = to_jsonable(value)
+        trace_id, parent_span_id = self._parent()
+        span = Span(name, "dump", trace_id, parent_span_id, {"state": state, "bytes": serialized_size(state)})
+        self.export(span)
+
+    def _parent(self, thread_id=None):
+        """Returns (trace_id, parent_span_id) for a span started in the current context."""
+        span = _current_span.get()
+        if span is not None:
+            return span.trace_id, span.span_id
+
+        # The innermost callback run (node, tool etc.) the code is running in
+        config = var_child_runnable_config.get()
+        parent_run_id = getattr((config or {}).get("callbacks"), "parent_run_id", None)
+        if parent_run_id is None and thread_id is not None:
+            # Code that runs outside of the runs (e.g. checkpoint writes of the graph loop) belongs to the running graph of the thread
+            return self.callback_handler.graph_span_context(thread_id)
+        return self.callback_handler.span_context(parent_run_id)
+
+    @contextmanager
+    def _span(self, name, kind, attributes):
+        trace_id, parent_span_id = self._parent(attributes.get("thread_id"))
+        span = Span(name, kind, trace_id, parent_span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.export(span)
+
+    def span(self, name, kind, **attributes):
+        """Context manager that records a span around a block of code (does nothing if tracing is disabled)."""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, kind, attributes)
+
+    def traced(self, name=None, kind="function"):
+        """Decorator that records a span for every call of a (sync or async) function."""
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(span_name, kind):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, kind):
+                    return func(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def callbacks(self):
+        """Callback handlers to put in the config of a graph run ("callbacks" key), empty if tracing is disabled."""
+        return [self.callback_handler] if self.enabled else []
+
+    def trace_checkpointer(self, checkpointer):
+        """Records a span for every checkpoint write of the checkpointer, with the number of serialized bytes."""
+        if not self.enabled:
+            return checkpointer
+
+        checkpointer.serde = _CountingSerializer(checkpointer.serde)
+        for method_name in ("put", "put_writes"):
+            method = getattr(checkpointer, method_name)
+            setattr(checkpointer, method_name, self._traced_checkpoint_method(method, f"checkpoint.{method_name}"))
+        for method_name in ("aput", "aput_writes"):
+            method = getattr(checkpointer, method_name)
+            setattr(checkpointer, method_name, self._traced_checkpoint_method(method, f"checkpoint.{method_name[1:]}", is_async=True))
+        return checkpointer
+
+    def _traced_checkpoint_method(self, method, name, is_async=False):
+        def span_for(config):
+            # The async methods of some checkpointers call the sync ones, which shouldn't be counted twice
+            current = _current_span.get()
+            if current is not None and current.kind == "checkpoint":
+                return nullcontext()
+            return self.span(name, "checkpoint", thread_id=str(config.get("configurable", {}).get("thread_id")), bytes=0)
+
+        if is_async:
+            @functools.wraps(method)
+            async def async_wrapper(config, *args, **kwargs):
+                with span_for(config):
+                    return await method(config, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(config, *args, **kwargs):
+            with span_for(config):
+                return method(config, *args, **kwargs)
+        return wrapper
+
+
+class _CountingSerializer:
+    """Serializer wrapper that adds the size of the serialized values to the current checkpoint span."""
+
+    def __init__(self, serde):
+        self.serde = serde
+
+    def dumps_typed(self, obj):
+        type_, data = self.serde.dumps_typed(obj)
+        span = _current_span.get()
+        if span is not None and span.kind == "checkpoint":
+            span.attributes["bytes"] = span.attributes.get("bytes", 0) + len(data)
+        return type_, data
+
+    def __getattr__(self, name):
+        return getattr(self.serde, name)
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records the graph runs, graph nodes, llm calls and tool runs as spans.
+
+    Runs that aren't recorded (the chains inside the nodes) are mapped to the span of their closest recorded ancestor,
+    so that the spans nest as the nodes, llm calls and tools do.
+    """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        # run_id -> (span, recorded) for the running runs
+        self._runs = {}
+        # thread_id -> span of the running graph run of the thread
+        self._graph_spans = {}
+        self._lock = threading.Lock()
+
+    def span_context(self, run_id):
+        """Returns (trace_id, span_id) of the span a run belongs to (a new trace if the run is unknown)."""
+        with self._lock:
+            entry = self._runs.get(run_id)
+        if entry is None:
+            return uuid.uuid4().hex, None
+        return entry[0].trace_id, entry[0].span_id
+
+    def graph_span_context(self, thread_id):
+        """Returns (trace_id, span_id) of the running graph run of a thread (a new trace if none is running)."""
+        with self._lock:
+            span = self._graph_spans.get(thread_id)
+        if span is None:
+            return uuid.uuid4().hex, None
+        return span.trace_id, span.span_id
+
+    def _start(self, run_id, parent_run_id, name, kind, attributes, recorded=True):
+        with self._lock:
+            parent = self._runs.get(parent_run_id)
+            if parent is None:
+                # A root run starts a new trace (the trace id is the id of the root run)
+                span = Span(name, kind, run_id.hex, None, attributes)
+                if "thread_id" in attributes:
+                    self._graph_spans[attributes["thread_id"]] = span
+            elif recorded:
+                span = Span(name, kind, parent[0].trace_id, parent[0].span_id, attributes)
+            else:
+                span = parent[0]
+            self._runs[run_id] = (span, recorded or parent is None)
+
+    def _end(self, run_id, error=None, **attributes):
+        with self._lock:
+            entry = self._runs.pop(run_id, None)
+            if entry is not None and entry[0].kind == "graph" and self._graph_spans.get(entry[0].attributes.get("thread_id")) is entry[0]:
+                del self._graph_spans[entry[0].attributes["thread_id"]]
+        if entry is None or not entry[1]:
+            return
+        span = entry[0]
+        span.attributes.update(attributes)
+        if error is not None:
+            span.set_error(error)
+        self.tracer.export(span)
+
+    # -------------------------------------------------------------------------------
+    # Graphs and nodes
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        name = kwargs.get("name") or "chain"
+        metadata = metadata or {}
+        attributes = {"thread_id": str(metadata.get("thread_id"))} if "thread_id" in metadata else {}
+
+        if parent_run_id is None:
+            self._start(run_id, parent_run_id, name, "graph", attributes)
+        elif metadata.get("langgraph_node") == name:
+            # The run of a node has the node's name, the runs inside the node inherit its metadata
+            attributes["step"] = metadata.get("langgraph_step")
+            attributes["state_bytes"] = payload_size(inputs)
+            self._start(run_id, parent_run_id, name, "node", attributes)
+        else:
+            self._start(run_id, parent_run_id, name, "chain", attributes, recorded=False)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        with self._lock:
+            entry = self._runs.get(run_id)
+        if entry is not None and entry[1] and entry[0].kind == "node":
+            self._end(run_id, output_bytes=payload_size(outputs))
+        else:
+            self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        # Interrupts and the commands of the nodes are exceptions too, but not failures
+        if type(error).__name__ in ("GraphInterrupt", "ParentCommand"):
+            self._end(run_id)
+        else:
+            self._end(run_id, error=error)
+    # -------------------------------------------------------------------------------
+
+    # -------------------------------------------------------------------------------
+    # Llm calls
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        invocation_params = kwargs.get("invocation_params") or {}
+        metadata = metadata or {}
+        model = invocation_params.get("model") or invocation_params.get("model_name") or metadata.get("ls_model_name")
+        attributes = {"model": model, "estimated_input_tokens": count_messages_tokens(messages[0]) if messages else 0}
+        # Static prompt prefix of the call (see common/prompts.py)
+        attributes.update({key: metadata[key] for key in ("prompt", "prompt_version", "prompt_hash") if key in metadata})
+        # Named after the node that calls the llm (e.g. "policy_control_node.llm"), which tells the agents apart
+        self._start(run_id, parent_run_id, f"{metadata.get('langgraph_node', 'chat_model')}.llm", "llm", attributes)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        input_tokens, output_tokens, estimated = response_token_usage(response)
+        if estimated:
+            self._end(run_id, estimated_output_tokens=output_tokens)
+        else:
+            self._end(run_id, input_tokens=input_tokens, output_tokens=output_tokens, cached_input_tokens=response_cached_tokens(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+    # -------------------------------------------------------------------------------
+
+    # -------------------------------------------------------------------------------
+    # Tools
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "tool"
+        self._start(run_id, parent_run_id, name, "tool", {"input_bytes": len(input_str.encode())})
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id, output_bytes=payload_size(output))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+    # -------------------------------------------------------------------------------
+# -----------------------------------------------------------------------------------
+
+
+tracer = Tracer()
+
+
+# -----------------------------------------------------------------------------------
+# Offline summary of a trace file
+
+def load_spans(path):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def summarize_spans(spans):
+    """Returns the time by span kind (self time, i.e. without the time of the child spans) and statistics by span name."""
+    children_time = defaultdict(float)
+    for span in spans:
+        if span["parent_span_id"] is not None:
+            children_time[span["parent_span_id"]] += span["duration_ms"]
+
+    by_kind = defaultdict(lambda: {"spans": 0, "total_ms": 0.0, "self_ms": 0.0})
+    by_name = defaultdict(list)
+    for span in spans:
+        kind = by_kind[span["kind"]]
+        kind["spans"] += 1
+        kind["total_ms"] += span["duration_ms"]
+        kind["self_ms"] += max(0.0, span["duration_ms"] - children_time[span["span_id"]])
+        by_name[(span["kind"], span["name"])].append(span)
+
+    names = {}
+    for (kind, name), group in sorted(by_name.items()):
+        durations = sorted(span["duration_ms"] for span in group)
+        attributes = [span["attributes"] for span in group]
+
+        def total(key):
+            values = [attribute[key] for attribute in attributes if attribute.get(key) is not None]
+            return sum(values) if values else None
+
+        names[f"{kind}:{name}"] = {
+            "count": len(group),
+            "errors": sum(span["status"]["code"] == "ERROR" for span in group),
+            "total_ms": round(sum(durations), 3),
+            "mean_ms": round(sum(durations) / len(durations), 3),
+            "p50_ms": durations[len(durations) // 2],
+            "p95_ms": durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+            "max_ms": durations[-1],
+            "input_tokens": total("input_tokens") or total("estimated_input_tokens"),
+            "output_tokens": total("output_tokens") or total("estimated_output_tokens"),
+            "cached_input_tokens": total("cached_input_tokens"),
+            "bytes": total("bytes") or total("state_bytes"),
+        }
+
+    return {"traces": len({span["trace_id"] for span in spans}), "spans": len(spans), "by_kind": dict(by_kind), "by_name": names}
+
+def print_summary(summary):
+    wall_time = sum(kind["self_ms"] for kind in summary["by_kind"].values())
+    print(f"{summary['traces']} traces, {summary['spans']} spans\n")
+
+    print(f"{'kind':<14}{'spans':>8}{'self ms':>14}{'share':>9}")
+    for kind, stats in sorted(summary["by_kind"].items(), key=lambda item: -item[1]["self_ms"]):
+        print(f"{kind:<14}{stats['spans']:>8}{stats['self_ms']:>14.1f}{stats['self_ms'] / wall_time if wall_time else 0:>9.1%}")
+
+    print(f"\n{'span':<48}{'count':>7}{'mean ms':>11}{'p50 ms':>11}{'p95 ms':>11}{'total ms':>12}{'tokens in/out':>16}{'cached':>8}{'bytes':>12}")
+    for name, stats in sorted(summary["by_name"].items(), key=lambda item: -item[1]["total_ms"]):
+        tokens = f"{stats['input_tokens'] or 0}/{stats['output_tokens'] or 0}" if stats["input_tokens"] or stats["output_tokens"] else ""
+        # Share of the input tokens served from the provider's prompt cache
+        cached = f"{stats['cached_input_tokens'] / stats['input_tokens']:.0%}" if stats["cached_input_tokens"] is not None and stats["input_tokens"] else ""
+        print(f"{name[:47]:<48}{stats['count']:>7}{stats['mean_ms']:>11.2f}{stats['p50_ms']:>11.2f}{stats['p95_ms']:>11.2f}{stats['total_ms']:>12.1f}{tokens:>16}{cached:>8}{stats['bytes'] or '':>12}")
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Summarizes a trace file: where the time goes by span kind, and statistics by span.")
+    parser.add_argument("path", nargs="?", default=TRACE_PATH, help="JSONL trace file")
+    parser.add_argument("--thread", help="only the traces of this thread id")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+
+    spans = load_spans(args.path)
+    if args.thread is not None:
+        trace_ids = {span["trace_id"] for span in spans if span["attributes"].get("thread_id") == args.thread}
+        spans = [span for span in spans if span["trace_id"] in trace_ids]
+
+    summary = summarize_spans(spans)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
@@ -0,0 +1,283 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import json
+import sqlite3
+import itertools
+import threading
+from datetime import datetime, timezone
+
+from typing import Any, Dict, List, Optional
+from typing_extensions import TypedDict
+
+from common.tracing import tracer
+
+
+# -----------------------------------------------------------------------------------
+# Booking ledger: every issued ticket is appended to a SQLite table (WAL mode, rows can't be updated or deleted),
+# keyed by the booking reference (PNR) and by an idempotency key + leg. The purchase tool uses the id of the tool call
+# the tickets are bought for as the idempotency key, so a retried purchase finds the legs that were already booked
+# instead of booking them again.
+#
+# The PNRs come from sharded counters in the same database: every shard hands out numbers congruent to its index
+# (shard + k * PNR_SHARDS) and reserves them in blocks, so that generating a PNR is usually an in-memory increment,
+# and concurrent generators only contend for the database when a block is used up. The numbers are scrambled with
+# a bijection and written in base 32, so that consecutive PNRs don't look sequential but can never collide.
+#
+# The ledger also keeps the archive of the completed booking conversations: once a booking is completed, the messages of
+# its conversation with the flight assistant are moved out of the session's state into the archive (see
+# flight_assistant/compaction.py), keyed by the thread and the summary message that replaces them in the state.
+#   BOOKING_LEDGER_PATH   path of the database (created on first use)
+
+BOOKING_LEDGER_PATH = os.getenv("BOOKING_LEDGER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db", "booking_ledger.db"))
+
+# PNR format: 6 characters of the Crockford base 32 alphabet (no I, L, O, U), i.e. 2^30 distinct PNRs
+PNR_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+PNR_LENGTH = 6
+PNR_SPACE = len(PNR_ALPHABET) ** PNR_LENGTH
+# Odd multiplier and mask of the scrambling bijection on [0, PNR_SPACE)
+PNR_MULTIPLIER = 0x2F5A3B47
+PNR_MASK = 0x1B5C3E9D
+PNR_SHARDS = 8
+PNR_BLOCK_SIZE = 64
+
+
+class Booking(TypedDict):
+    booking_id: int
+    pnr: str
+    idempotency_key: str
+    leg: str
+    user_id: str
+    flight_code: str
+    date: str
+    seat_number: int
+    ticket: Dict[str, Any]
+    created_at: str
+
+
+class ConversationArchive(TypedDict):
+    archive_id: int
+    thread_id: str
+    summary_id: str
+    user_id: str
+    outcome: str
+    summary: str
+    messages: List[Dict[str, Any]]
+    created_at: str
+
+
+def encode_pnr(number):
+    """Maps a number in [0, PNR_SPACE) to a PNR (distinct numbers always give distinct PNRs)."""
+    scrambled = ((number * PNR_MULTIPLIER) % PNR_SPACE) ^ PNR_MASK
+    characters = []
+    for _ in range(PNR_LENGTH):
+        scrambled, index = divmod(scrambled, len(PNR_ALPHABET))
+        characters.append(PNR_ALPHABET[index])
+    return "".join(reversed(characters))
+
+
+def connect(database_path):
+    """Opens a connection in autocommit mode with the ledger's settings."""
+    connection = sqlite3.connect(database_path, isolation_level=None, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class PnrGenerator:
+    """Collision-free PNR generator over sharded, block-allocated counters (see the notes above)."""
+
+    def __init__(self, database_path=BOOKING_LEDGER_PATH, shards=PNR_SHARDS, block_size=PNR_BLOCK_SIZE):
+        self.database_path = database_path
+        self.shards = shards
+        self.block_size = block_size
+        # Per shard: lock and the [next, end) range of its reserved block of counter values
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._blocks = [[0, 0] for _ in range(shards)]
+        self._local = threading.local()
+        self._thread_counter = itertools.count()
+
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS pnr_counters (shard INTEGER PRIMARY KEY, next_value INTEGER NOT NULL)")
+        connection.executemany("INSERT OR IGNORE INTO pnr_counters (shard, next_value) VALUES (?, 0)", [(shard,) for shard in range(shards)])
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = connect(self.database_path)
+        return connection
+
+    def _reserve_block(self, shard):
+        """Reserves the next block of counter values of the shard in the database (atomic for all processes)."""
+        end, = self._connection().execute("UPDATE pnr_counters SET next_value = next_value + ? WHERE shard = ? RETURNING next_value", (self.block_size, shard)).fetchone()
+        self._blocks[shard] = [end - self.block_size, end]
+
+    def next_pnr(self):
+        # The threads are spread over the shards round-robin, so they rarely wait for each other
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = next(self._thread_counter) % self.shards
+        with self._locks[shard]:
+            block = self._blocks[shard]
+            if block[0] >= block[1]:
+                self._reserve_block(shard)
+                block = self._blocks[shard]
+            value = block[0]
+            block[0] += 1
+
+        number = value * self.shards + shard
+        if number >= PNR_SPACE:
+            raise RuntimeError("The PNR space is exhausted")
+        return encode_pnr(number)
+
+
+class BookingLedger:
+    """Append-only record of the issued tickets (see the notes above)."""
+
+    def __init__(self, database_path=BOOKING_LEDGER_PATH):
+        self.database_path = database_path
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._create_tables()
+        self.pnr_generator = PnrGenerator(database_path)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = connect(self.database_path)
+        return connection
+
+    def _create_tables(self):
+        connection = self._connection()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS bookings (
+                booking_id INTEGER PRIMARY KEY,
+                pnr TEXT NOT NULL UNIQUE,
+                idempotency_key TEXT NOT NULL,
+                leg TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                flight_code TEXT NOT NULL,
+                date TEXT NOT NULL,
+                seat_number INTEGER NOT NULL,
+                ticket TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                UNIQUE (idempotency_key, leg)
+            );
+            CREATE INDEX IF NOT EXISTS bookings_by_user ON bookings (user_id, booking_id);
+
+            -- The ledger is append-only
+            CREATE TRIGGER IF NOT EXISTS bookings_no_update BEFORE UPDATE ON bookings
+            BEGIN SELECT RAISE(ABORT, 'bookings are append-only'); END;
+            CREATE TRIGGER IF NOT EXISTS bookings_no_delete BEFORE DELETE ON bookings
+            BEGIN SELECT RAISE(ABORT, 'bookings are append-only'); END;
+
+            -- Conversations of the completed bookings (messages as langchain message dicts)
+            CREATE TABLE IF NOT EXISTS conversation_archive (
+                archive_id INTEGER PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                summary_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                UNIQUE (thread_id, summary_id)
+            );
+            CREATE TRIGGER IF NOT EXISTS conversation_archive_no_update BEFORE UPDATE ON conversation_archive
+            BEGIN SELECT RAISE(ABORT, 'the conversation archive is append-only'); END;
+            CREATE TRIGGER IF NOT EXISTS conversation_archive_no_delete BEFORE DELETE ON conversation_archive
+            BEGIN SELECT RAISE(ABORT, 'the conversation archive is append-only'); END;
+        """)
+
+    def _to_booking(self, row) -> Booking:
+        booking_id, pnr, idempotency_key, leg, user_id, flight_code, date, seat_number, ticket, created_at = row
+        return {"booking_id": booking_id, "pnr": pnr, "idempotency_key": idempotency_key, "leg": leg, "user_id": user_id,
+                "flight_code": flight_code, "date": date, "seat_number": seat_number, "ticket": json.loads(ticket), "created_at": created_at}
+
+    def next_pnr(self):
+        """Returns a new PNR that was never handed out before."""
+        return self.pnr_generator.next_pnr()
+
+    @tracer.traced("booking_ledger.record", kind="db")
+    def record_booking(self, idempotency_key, leg, user_id, ticket) -> Booking:
+        """Appends the ticket of a leg, unless the leg was already recorded under the key. Returns the recorded booking
+        (the earlier one if the leg was already booked)."""
+        connection = self._connection()
+        connection.execute("""
+            INSERT INTO bookings (pnr, idempotency_key, leg, user_id, flight_code, date, seat_number, ticket, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (idempotency_key, leg) DO NOTHING
+        """, (ticket["pnr_number"], idempotency_key, leg, str(user_id), ticket["flight_code"], ticket["date"], ticket["seat_number"],
+              json.dumps(ticket, ensure_ascii=False), datetime.now(timezone.utc).isoformat(timespec="seconds")))
+        return self._to_booking(connection.execute("SELECT * FROM bookings WHERE idempotency_key = ? AND leg = ?", (idempotency_key, leg)).fetchone())
+
+    def get_bookings(self, idempotency_key) -> Dict[str, Booking]:
+        """Returns the bookings recorded under the idempotency key by leg."""
+        rows = self._connection().execute("SELECT * FROM bookings WHERE idempotency_key = ?", (idempotency_key,)).fetchall()
+        return {booking["leg"]: booking for booking in map(self._to_booking, rows)}
+
+    def find_by_pnr(self, pnr) -> Optional[Booking]:
+        row = self._connection().execute("SELECT * FROM bookings WHERE pnr = ?", (pnr.upper(),)).fetchone()
+        return self._to_booking(row) if row else None
+
+    def user_bookings(self, user_id, limit=100) -> List[Booking]:
+        """Returns the latest bookings of the user, newest first."""
+        rows = self._connection().execute("SELECT * FROM bookings WHERE user_id = ? ORDER BY booking_id DESC LIMIT ?", (str(user_id), limit)).fetchall()
+        return [self._to_booking(row) for row in rows]
+
+    @tracer.traced("booking_ledger.archive", kind="db")
+    def archive_conversation(self, thread_id, summary_id, user_id, outcome, summary, messages) -> None:
+        """Appends the messages (langchain message dicts) of a completed booking conversation, unless they were already
+        archived under the summary id (e.g. a retried node)."""
+        self._connection().execute("""
+            INSERT INTO conversation_archive (thread_id, summary_id, user_id, outcome, summary, messages, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (thread_id, summary_id) DO NOTHING
+        """, (thread_id, summary_id, str(user_id), outcome, summary, json.dumps(messages, ensure_ascii=False), datetime.now(timezone.utc).isoformat(timespec="seconds")))
+
+    def conversation_archives(self, thread_id) -> List[ConversationArchive]:
+        """Returns the archived booking conversations of a thread, oldest first."""
+        rows = self._connection().execute("SELECT * FROM conversation_archive WHERE thread_id = ? ORDER BY archive_id", (thread_id,)).fetchall()
+        columns = ["archive_id", "thread_id", "summary_id", "user_id", "outcome", "summary", "messages", "created_at"]
+        return [{**dict(zip(columns, row)), "messages": json.loads(row[6])} for row in rows]
+# -----------------------------------------------------------------------------------
+
+
+# Booking ledger shared by the tools and the airline gateway stub (created on first use)
+_booking_ledger = None
+_booking_ledger_lock = threading.Lock()
+
+def get_booking_ledger():
+    global _booking_ledger
+    with _booking_ledger_lock:
+        if _booking_ledger is None:
+            _booking_ledger = BookingLedger()
+    return _booking_ledger
+
+
+
+
+if __name__ == "__main__":
+
+    # Generate PNRs from many threads and check that none of them repeats
+    import time
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as directory:
+        ledger = BookingLedger(os.path.join(directory, "booking_ledger.db"))
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            pnrs = [pnr for batch in executor.map(lambda _: [ledger.next_pnr() for _ in range(10000)], range(16)) for pnr in batch]
+        elapsed = time.perf_counter() - start_time
+        print(f"Generated {len(pnrs):,} PNRs in {elapsed:.2f} s ({len(pnrs) / elapsed:,.0f}/s), duplicates: {len(pnrs) - len(set(pnrs))}, e.g. {pnrs[:5]}")
+
+        # A retried purchase finds the leg that was already booked
+        ticket = {"airline": "THY", "flight_code": "TK802", "date": "2025-06-10", "seat_number": 25, "pnr_number": ledger.next_pnr()}
+        first = ledger.record_booking("call_1", "depart", 10987654321, ticket)
+        retried = ledger.record_booking("call_1", "depart", 10987654321, {**ticket, "seat_number": 30, "pnr_number": ledger.next_pnr()})
+        print(f"Recorded: {first['pnr']} seat {first['seat_number']} | Retried: {retried['pnr']} seat {retried['seat_number']}")
+        print(f"By PNR: {ledger.find_by_pnr(first['pnr'])['flight_code']} | User bookings: {len(ledger.user_bookings(10987654321))}")
@@ -0,0 +1,140 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import uuid
+
+from langchain_core.messages import SystemMessage, ToolMessage, messages_to_dict
+from langchain_core.runnables.config import RunnableConfig
+
+from typing import Any
+
+from flight_assistant.booking_ledger import get_booking_ledger
+from common.serialization import encode_flight
+from common.metrics import flight_state_compactions
+
+
+# -----------------------------------------------------------------------------------
+# Compaction of the flight state, so that the state (and the checkpoints) of a long-lived session stay bounded.
+#
+# The flight state keeps the whole conversation with the flight assistant (including the tool messages of the searches)
+# and the retrieved flights, and the travel graph stores a copy of it in every checkpoint of the session:
+# - once a booking is completed (tickets purchased, or the selections escalated to the manager), the messages of its
+#   conversation are archived to the booking ledger and replaced with a short summary message, and the retrieved flights
+#   are dropped (the selected flights and tickets are small, and kept for the handover and the manager's decision)
+# - when the user restarts the search, the results of the earlier searches are replaced with a one-line note
+# The system prompt stays the first message, and only the latest COMPACTION_MAX_SUMMARIES booking summaries are kept
+# (all of them are in the ledger).
+#   COMPACTION_ENABLED         compact the flight state (1) or keep everything (0)
+#   COMPACTION_MAX_SUMMARIES   booking summaries kept in the state
+
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "1") == "1"
+COMPACTION_MAX_SUMMARIES = int(os.getenv("COMPACTION_MAX_SUMMARIES", 5))
+
+# Ids of the summary messages start with this prefix (followed by the id of the first message they replace)
+SUMMARY_ID_PREFIX = "booking-summary-"
+
+
+def is_booking_summary(message) -> bool:
+    return message.type == "system" and (message.id or "").startswith(SUMMARY_ID_PREFIX)
+
+def booking_outcome(flight_state) -> str:
+    return "purchased" if flight_state["purchased_depart_ticket"] is not None else "escalated"
+
+def booking_summary(flight_state) -> str:
+    """Short summary of a completed booking for the flight llm (the trip, and the tickets or the escalated selections)."""
+    if booking_outcome(flight_state) == "purchased":
+        status = "the tickets were purchased"
+        depart, return_ = flight_state["purchased_depart_ticket"], flight_state["purchased_return_ticket"]
+    else:
+        status = "the selected flights violate the company policy and were sent to the user's manager for approval"
+        depart, return_ = flight_state["selected_depart_flight"], flight_state["selected_return_flight"]
+
+    trip = flight_state["latest_tool_call"]["args"] if flight_state["latest_tool_call"] else None
+    lines = [f"This is a system message summarizing an earlier flight booking of the user in this conversation ({status}).", f"- Trip: {trip}", f"- Departure: {encode_flight(depart)}"]
+    if return_ is not None:
+        lines.append(f"- Return: {encode_flight(return_)}")
+    return "\n".join(lines)
+
+
+def compact_completed_booking(flight_state, config: RunnableConfig) -> Any:
+    """Returns the flight state of a completed booking with its conversation archived and replaced by a summary (see the notes above)."""
+    if not COMPACTION_ENABLED:
+        return flight_state
+
+    # The system prompt, the summaries of the earlier bookings, and the conversation of the completed booking
+    prompt, rest = flight_state["messages"][:1], flight_state["messages"][1:]
+    summaries = [message for message in rest if is_booking_summary(message)]
+    conversation = [message for message in rest if not is_booking_summary(message)]
+    if not conversation:
+        return flight_state
+
+    summary_id = SUMMARY_ID_PREFIX + (conversation[0].id or uuid.uuid4().hex)
+    summary = booking_summary(flight_state)
+    configurable = config.get("configurable", {})
+    try:
+        get_booking_ledger().archive_conversation(str(configurable.get("thread_id")), summary_id, (configurable.get("user") or {}).get("id"), booking_outcome(flight_state), summary, messages_to_dict(conversation))
+    except Exception:
+        # The booking itself is done, so the state is left as it is (and compacted with the next booking)
+        return flight_state
+
+    flight_state_compactions.inc(reason="booking_completed")
+    kept_summaries = summaries[max(0, len(summaries) - COMPACTION_MAX_SUMMARIES + 1):] if COMPACTION_MAX_SUMMARIES > 1 else []
+    return {**flight_state,
+            "messages": prompt + kept_summaries + [SystemMessage(id=summary_id, content=summary)],
+            "retrieved_depart_flights": None,
+            "retrieved_return_flights": None}
+
+
+def compact_search_results(messages) -> list[ToolMessage]:
+    """Returns the replacements (with the same ids) of the search results in the messages that weren't compacted yet, for
+    when the user restarts the search. Only the searched routes and dates of the results are kept."""
+    if not COMPACTION_ENABLED:
+        return []
+
+    replacements = []
+    for message in messages:
+        if message.type == "tool" and message.name in ("search_flights", "search_flights_multi") and message.status == "success" and not message.response_metadata.get("compacted"):
+            # The tables of the results start with a "<leg> flights <from> -> <to> on <date>:" line
+            searched = "; ".join(line[:-1] for line in message.content.splitlines() if line.endswith(":"))
+            content = f"Results of an earlier search ({searched}), no longer offered to the user since they wanted to search again."
+            replacements.append(ToolMessage(id=message.id, tool_call_id=message.tool_call_id, name=message.name, content=content, response_metadata={"compacted": True}))
+
+    if replacements:
+        flight_state_compactions.inc(reason="search_restart")
+    return replacements
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    # State sizes of a session with 20 completed bookings, with and without the compaction (ledger in a temporary directory)
+    import tempfile
+    from langchain_core.messages import AIMessage, HumanMessage
+    from flight_assistant.booking_ledger import BookingLedger
+    import flight_assistant.booking_ledger as booking_ledger
+    from flight_assistant.flight_agent import flight_prompt
+    from common.serialization import serialized_size
+
+    flights = [{"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500 + index, "flight_code": f"TK{800 + index}", "date": "2025-06-10"} for index in range(3)]
+    ticket = {**flights[0], "seat_number": 12, "pnr_number": "7Q2M4K"}
+
+    def booking_messages(index):
+        tool_call = {"name": "search_flights", "args": {"from_city": "Istanbul", "to_city": "Ankara", "flight_type": "one-way", "depart_date": "2025-06-10"}, "id": f"call_{index}"}
+        return [HumanMessage(id=f"human_{index}", content="Istanbul'dan Ankara'ya 10 Haziran'da ucus ariyorum."), AIMessage(id=f"ai_{index}", content="", tool_calls=[tool_call]),
+                ToolMessage(id=f"tool_{index}", tool_call_id=f"call_{index}", name="search_flights", content=str(flights) * 4), SystemMessage(id=f"system_{index}", content=f"Tickets purchased: {ticket}"), AIMessage(id=f"done_{index}", content="Biletleriniz alindi, iyi yolculuklar!")]
+
+    with tempfile.TemporaryDirectory() as directory:
+        booking_ledger._booking_ledger = BookingLedger(os.path.join(directory, "booking_ledger.db"))
+        config = {"configurable": {"thread_id": "demo", "user": {"id": 10987654321}}}
+
+        full = compacted = {"messages": [SystemMessage(id="prompt", content=flight_prompt)], "latest_tool_call": None, "retrieved_depart_flights": flights, "retrieved_return_flights": None,
+                            "selected_depart_flight": flights[0], "selected_return_flight": None, "purchased_depart_ticket": ticket, "purchased_return_ticket": None}
+        for index in range(20):
+            full = {**full, "messages": full["messages"] + booking_messages(index), "latest_tool_call": booking_messages(index)[1].tool_calls[0]}
+            compacted = compact_completed_booking({**compacted, "messages": compacted["messages"] + booking_messages(index), "latest_tool_call": booking_messages(index)[1].tool_calls[0], "retrieved_depart_flights": flights}, config)
+
+        print(f"Without compaction: {len(full['messages'])} messages, {serialized_size(full):,} bytes")
+        print(f"With compaction:    {len(compacted['messages'])} messages, {serialized_size(compacted):,} bytes, {len(get_booking_ledger().conversation_archives('demo'))} conversations archived")
+        print(f"\n{compacted['messages'][-1].content}")
@@ -0,0 +1,217 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+from langchain_core.tools import ToolException
+
+from setup_mock_flight_data import airlines
+from create_mock_flight_data import create_and_connect_database, flight_batch_generator, insert_batch_to_table
+from flight_assistant.tools.flight_search import FlightSearchTool
+
+
+# -----------------------------------------------------------------------------------
+# Micro-benchmarks of the flight data path:
+#   - flight search (FlightSearchTool._run): cold / warm, one-way / two-way, over random routes and dates
+#   - mock data generation (flight_batch_generator): rows per second
+#   - insertion (insert_batch_to_table): rows per second
+#
+# All of them run on a small database generated with a fixed seed, so that the numbers of different commits are
+# comparable. Storage or index changes should be measured against a baseline report (--output / --compare).
+
+# Cities and days of the benchmark database (the cities and dates of the conversation scenarios are included)
+BENCHMARK_CITIES = ["istanbul", "ankara", "izmir", "antalya", "trabzon", "adana", "bursa", "gaziantep", "kayseri", "konya", "diyarbakir", "erzurum", "samsun", "van", "mugla", "denizli"]
+BENCHMARK_START_DATE = datetime(2025, 6, 1)
+BENCHMARK_DAYS = 122
+BENCHMARK_SEED = 42
+BENCHMARK_DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db", "benchmark_flight_database.db")
+
+
+def benchmark_days(start_date=BENCHMARK_START_DATE, days=BENCHMARK_DAYS):
+    return [start_date + timedelta(days=offset) for offset in range(days)]
+
+def reset_generator_state(seed):
+    """Seeds the random generator and resets the flight code counters, so that the generated data is the same on every run."""
+    random.seed(seed)
+    for airline in airlines.values():
+        airline.flight_number = 101
+
+def build_benchmark_database(database_path=BENCHMARK_DATABASE_PATH, cities=BENCHMARK_CITIES, days=BENCHMARK_DAYS, seed=BENCHMARK_SEED):
+    """(Re)creates the small fixed-seed flight database and returns the number of generated flights."""
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+
+    reset_generator_state(seed)
+    connection = create_and_connect_database(database_path)
+    total = 0
+    for batch in flight_batch_generator(cities, benchmark_days(days=days)):
+        insert_batch_to_table(connection, batch)
+        total += len(batch)
+    connection.close()
+
+    return total
+
+
+# -----------------------------------------------------------------------------------
+# Measurements
+
+def summarize(seconds, items_per_repetition=1):
+    """Returns the statistics of the measured durations in milliseconds (and the throughput in items per second)."""
+    milliseconds = sorted(1000 * value for value in seconds)
+    p95_index = min(len(milliseconds) - 1, max(0, round(0.95 * len(milliseconds) + 0.5) - 1))
+    return {
+        "repetitions": len(milliseconds),
+        "min_ms": round(milliseconds[0], 4),
+        "median_ms": round(statistics.median(milliseconds), 4),
+        "mean_ms": round(statistics.fmean(milliseconds), 4),
+        "p95_ms": round(milliseconds[p95_index], 4),
+        "per_s": round(1000 * items_per_repetition / statistics.median(milliseconds), 1) if milliseconds[len(milliseconds) // 2] > 0 else None,
+    }
+
+def measure(function, repetitions, warmup=0):
+    """Calls the function `warmup` times without measuring, then `repetitions` times, and returns the durations in seconds."""
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+def random_searches(count, cities, days, seed):
+    """Returns random (from_city, to_city, depart_date, return_date) searches within the benchmark database."""
+    rng = random.Random(seed)
+    searches = []
+    for _ in range(count):
+        from_city, to_city = rng.sample(cities, 2)
+        depart_offset = rng.randrange(days - 7)
+        depart_date = BENCHMARK_START_DATE + timedelta(days=depart_offset)
+        return_date = depart_date + timedelta(days=rng.randint(1, 7))
+        searches.append((from_city, to_city, depart_date.strftime("%Y-%m-%d"), return_date.strftime("%Y-%m-%d")))
+    return searches
+
+
+def benchmark_search(database_path, flight_type, repetitions, warmup, cities, days, seed):
+    """Measures FlightSearchTool._run on random routes and dates.
+
+    cold: every repetition searches a route and date that wasn't searched before in the process
+    warm: every repetition repeats a single search that was already made (warmup) before
+    """
+    tool = FlightSearchTool(database_path=database_path)
+    two_way = flight_type == "two-way"
+
+    def search(from_city, to_city, depart_date, return_date):
+        try:
+            tool._run(from_city=from_city, to_city=to_city, flight_type=flight_type, depart_date=depart_date, return_date=return_date if two_way else None)
+        except ToolException as e:
+            raise RuntimeError(f"Flight search failed: {e}")
+
+    # The seed differs per flight type so that the two-way searches are also cold
+    cold_searches = iter(random_searches(repetitions, cities, days, seed + (1 if two_way else 0)))
+    cold = measure(lambda: search(*next(cold_searches)), repetitions)
+
+    warm_search = random_searches(1, cities, days, seed + 100)[0]
+    warm = measure(lambda: search(*warm_search), repetitions, warmup=max(warmup, 1))
+
+    return {f"search_{flight_type}_cold": summarize(cold), f"search_{flight_type}_warm": summarize(warm)}
+
+def benchmark_generation(repetitions, warmup, cities, days, seed):
+    """Measures flight_batch_generator by generating the flights of the benchmark cities for a number of days."""
+    rows = []
+
+    def generate():
+        reset_generator_state(seed)
+        rows.append(sum(len(batch) for batch in flight_batch_generator(cities, benchmark_days(days=days))))
+
+    durations = measure(generate, repetitions, warmup)
+    return {"generate_batches": {**summarize(durations, rows[-1]), "rows": rows[-1]}}
+
+def benchmark_insertion(repetitions, warmup, cities, days, seed):
+    """Measures insert_batch_to_table by inserting pre-generated batches into a new database file each time."""
+    reset_generator_state(seed)
+    batches = list(flight_batch_generator(cities, benchmark_days(days=days)))
+    rows = sum(len(batch) for batch in batches)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = iter(os.path.join(directory, f"insert_{index}.db") for index in range(warmup + repetitions))
+
+        def insert():
+            connection = create_and_connect_database(next(paths))
+            for batch in batches:
+                insert_batch_to_table(connection, batch)
+            connection.close()
+
+        durations = measure(insert, repetitions, warmup)
+
+    return {"insert_batches": {**summarize(durations, rows), "rows": rows}}
+# -----------------------------------------------------------------------------------
+
+
+def print_table(results, baseline=None):
+    """Prints the results as a table (with the change of the median against the baseline if given)."""
+    header = f"{'benchmark':<26}{'reps':>6}{'min ms':>12}{'median ms':>12}{'p95 ms':>12}{'per s':>14}"
+    if baseline:
+        header += f"{'vs baseline':>14}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        line = f"{name:<26}{result['repetitions']:>6}{result['min_ms']:>12.3f}{result['median_ms']:>12.3f}{result['p95_ms']:>12.3f}{result['per_s'] or 0:>14,.1f}"
+        if baseline and name in baseline:
+            change = (result["median_ms"] - baseline[name]["median_ms"]) / baseline[name]["median_ms"]
+            line += f"{change:>+14.1%}"
+        print(line)
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of flight search and mock data generation on a small fixed-seed database.")
+    parser.add_argument("--repetitions", type=int, default=200, help="measured repetitions of each search benchmark")
+    parser.add_argument("--data-repetitions", type=int, default=5, help="measured repetitions of the generation and insertion benchmarks")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured repetitions before the warm search benchmarks")
+    parser.add_argument("--seed", type=int, default=BENCHMARK_SEED)
+    parser.add_argument("--database", default=BENCHMARK_DATABASE_PATH, help="path of the benchmark database")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate the benchmark database even if it exists")
+    parser.add_argument("--generation-days", type=int, default=10, help="days of flights generated / inserted per repetition")
+    parser.add_argument("--output", help="path of the json results")
+    parser.add_argument("--compare", help="json results of a baseline run to compare with")
+    args = parser.parse_args()
+
+    if args.rebuild or not os.path.exists(args.database):
+        start_time = time.perf_counter()
+        total = build_benchmark_database(args.database, seed=args.seed)
+        print(f"Built the benchmark database with {total:,} flights in {time.perf_counter() - start_time:.1f} seconds ({args.database})\n")
+
+    results = {}
+    for flight_type in ("one-way", "two-way"):
+        results.update(benchmark_search(args.database, flight_type, args.repetitions, args.warmup, BENCHMARK_CITIES, BENCHMARK_DAYS, args.seed))
+    results.update(benchmark_generation(args.data_repetitions, 1, BENCHMARK_CITIES, args.generation_days, args.seed))
+    results.update(benchmark_insertion(args.data_repetitions, 1, BENCHMARK_CITIES, args.generation_days, args.seed))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+    print_table(results, baseline)
+
+    if args.output:
+        report = {
+            "meta": {"timestamp": datetime.now().isoformat(timespec="seconds"), "sqlite": sqlite3.sqlite_version, "python": sys.version.split()[0]},
+            "settings": {"repetitions": args.repetitions, "data_repetitions": args.data_repetitions, "warmup": args.warmup, "seed": args.seed, "generation_days": args.generation_days},
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {args.output}")
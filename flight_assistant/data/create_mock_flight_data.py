@@ -54,21 +54,26 @@ def create_and_connect_database(database_path):
 
 # Function to generate a batch of flights to be inserted into the database
 # Since around 5 million flights will be generated, we will insert them in batches for performance/memory reasons
-def flight_batch_generator():
+# (the cities and the days can be limited, e.g. to generate a small database for the benchmarks)
+def flight_batch_generator(cities=None, days=None):
     # Assign a different id to each flight object, to be used as the primary key in the database
     flight_id = 0
 
+    # All cities and the whole date range by default
+    cities = normalized_cities if cities is None else cities
+    days = day_generator() if days is None else days
+
     # Start creating sythetic flight objects (for each city pair, create 3 flights per day)
     # For each day
-    for date in day_generator():
+    for date in days:
         # Initialize a new empty list (a new batch for each day)
         flight_objects_batch = []
 
         # From each city
-        for from_city in normalized_cities:
+        for from_city in cities:
             
             # To every other city
-            for to_city in normalized_cities:
+            for to_city in cities:
                 
                 # Don't create flights from a city to itself
                 if from_city == to_city:
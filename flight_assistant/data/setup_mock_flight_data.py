@@ -1,3 +1,4 @@
+import math
 import unicodedata
 from datetime import datetime, timedelta
 
@@ -39,6 +40,55 @@ def normalize_city_name(city):
 normalized_cities = [normalize_city_name(city) for city in cities]
 
 
+# ---COORDINATES---
+
+# Approximate coordinates (latitude, longitude in degrees) of the city centers, for finding the cities around a city
+# (e.g. searching flights "from Istanbul or any city within 150 km")
+city_coordinates = {
+    "Adana": (37.00, 35.32), "Adıyaman": (37.76, 38.28), "Ağrı": (39.72, 43.05), "Aksaray": (38.37, 34.03),
+    "Amasya": (40.65, 35.83), "Ankara": (39.93, 32.86), "Antalya": (36.90, 30.70), "Ardahan": (41.11, 42.70),
+    "Artvin": (41.18, 41.82), "Balıkesir": (39.65, 27.88), "Bartın": (41.64, 32.34), "Batman": (37.88, 41.13),
+    "Bayburt": (40.26, 40.23), "Bilecik": (40.14, 29.98), "Bingöl": (38.88, 40.50), "Bitlis": (38.40, 42.11),
+    "Bolu": (40.74, 31.61), "Burdur": (37.72, 30.29), "Bursa": (40.19, 29.06), "Çanakkale": (40.15, 26.41),
+    "Çankırı": (40.60, 33.62), "Çorum": (40.55, 34.96), "Denizli": (37.78, 29.09), "Diyarbakır": (37.91, 40.23),
+    "Düzce": (40.84, 31.16), "Edirne": (41.68, 26.56), "Elazığ": (38.68, 39.22), "Erzincan": (39.75, 39.49),
+    "Erzurum": (39.90, 41.27), "Eskişehir": (39.78, 30.52), "Gaziantep": (37.07, 37.38), "Giresun": (40.91, 38.39),
+    "Gümüşhane": (40.46, 39.48), "Hakkâri": (37.57, 43.74), "Hatay": (36.20, 36.16), "Iğdır": (39.92, 44.05),
+    "Isparta": (37.76, 30.55), "İstanbul": (41.01, 28.98), "İzmir": (38.42, 27.14), "Kahramanmaraş": (37.58, 36.94),
+    "Karabük": (41.20, 32.63), "Karaman": (37.18, 33.22), "Kars": (40.60, 43.10), "Kastamonu": (41.39, 33.78),
+    "Kayseri": (38.73, 35.49), "Kırıkkale": (39.85, 33.51), "Kırklareli": (41.74, 27.23), "Kırşehir": (39.15, 34.17),
+    "Kocaeli": (40.77, 29.92), "Konya": (37.87, 32.48), "Kütahya": (39.42, 29.98), "Malatya": (38.36, 38.31),
+    "Manisa": (38.61, 27.43), "Mardin": (37.31, 40.74), "Mersin": (36.81, 34.64), "Muğla": (37.22, 28.36),
+    "Muş": (38.74, 41.51), "Nevşehir": (38.62, 34.71), "Niğde": (37.97, 34.68), "Ordu": (40.98, 37.88),
+    "Osmaniye": (37.07, 36.25), "Rize": (41.02, 40.52), "Sakarya": (40.78, 30.40), "Samsun": (41.29, 36.33),
+    "Siirt": (37.93, 41.94), "Sinop": (42.03, 35.15), "Sivas": (39.75, 37.02), "Şanlıurfa": (37.17, 38.79),
+    "Şırnak": (37.52, 42.46), "Tekirdağ": (40.98, 27.51), "Tokat": (40.31, 36.55), "Trabzon": (41.00, 39.72),
+    "Tunceli": (39.11, 39.55), "Uşak": (38.68, 29.41), "Van": (38.49, 43.38), "Yalova": (40.66, 29.27),
+    "Yozgat": (39.82, 34.81), "Zonguldak": (41.46, 31.79)
+}
+
+# Same coordinates by the normalized city names (the names used in the database)
+normalized_city_coordinates = {normalize_city_name(city): coordinates for city, coordinates in city_coordinates.items()}
+
+# Helper function to get the great-circle (haversine) distance in km between two cities (by their names, in any form)
+def distance_km(city_a, city_b):
+    lat_a, lon_a = map(math.radians, normalized_city_coordinates[normalize_city_name(city_a)])
+    lat_b, lon_b = map(math.radians, normalized_city_coordinates[normalize_city_name(city_b)])
+
+    a = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+# Helper function to get the (normalized) names of the cities within a radius of a city, the city itself first, then
+# the others by their distance (e.g. "Istanbul", 100 --> ['istanbul', 'yalova', 'kocaeli'...]). Unknown cities have no neighbours.
+def nearby_cities(city, radius_km):
+    city = normalize_city_name(city)
+    if city not in normalized_city_coordinates:
+        return [city]
+
+    distances = {other: distance_km(city, other) for other in normalized_city_coordinates if other != city}
+    return [city] + sorted((other for other, distance in distances.items() if distance <= radius_km), key=distances.get)
+
+
 
 # ---AIRLINES---
 
@@ -0,0 +1,399 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import json
+import time
+import sqlite3
+import hashlib
+import secrets
+import asyncio
+import threading
+from datetime import datetime, timezone
+
+from typing import Any, Dict, List, Optional
+from typing_extensions import TypedDict
+
+from common.tracing import tracer
+from common.metrics import escalation_outbox_messages
+from common.retry import RetryPolicy, circuit_breaker
+from flight_assistant.gateway import get_corporate_gateway
+
+
+# -----------------------------------------------------------------------------------
+# Outbox of the manager escalations: the escalation tool only inserts the request into a SQLite table and returns,
+# and a background dispatcher thread delivers the pending requests in batches through a transport:
+#   "file"      appends the mails to a JSONL file (ESCALATION_MAIL_PATH), a stand-in for an SMTP server
+#   "gateway"   sends them with the mail call of the company systems (flight_assistant/gateway.py)
+#
+# A request is stored once per user and selected flights while it's in flight (asking again for the same flights
+# before the manager decides returns the stored request; once it's decided or failed, a new request can be made), and
+# moves through the states
+#   pending -> sending -> delivered -> approved / rejected
+# where a failed delivery goes back to pending after a backoff, and to "failed" after OUTBOX_MAX_ATTEMPTS deliveries.
+# Every request gets a random decision token, which is sent to the manager in the mail and has to be presented to read
+# the request or record the decision through the server (besides the admin token APPROVAL_API_TOKEN of server.py).
+# The managers' decisions come back with `record_decision` (POST /escalations/<id>/decision of server.py), and the
+# approval service (approval_service.py) claims the decided requests to resume the parked sessions they came from
+# (stored by thread_id), recording when and with what outcome each one was resumed. A resumption that fails is tried
+# again once its claim expires, up to APPROVAL_MAX_ATTEMPTS times (see approval_service.py).
+#   ESCALATION_OUTBOX_PATH                          path of the database (created on first use)
+#   ESCALATION_TRANSPORT, ESCALATION_MAIL_PATH      transport of the mails
+#   OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL         requests per delivery batch, seconds between checks for due requests
+#   OUTBOX_MAX_ATTEMPTS                             deliveries of a request before it's marked as failed
+
+ESCALATION_OUTBOX_PATH = os.getenv("ESCALATION_OUTBOX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db", "escalation_outbox.db"))
+ESCALATION_TRANSPORT = os.getenv("ESCALATION_TRANSPORT", "file")
+ESCALATION_MAIL_PATH = os.getenv("ESCALATION_MAIL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db", "escalation_mails.jsonl"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+
+# Seconds a claimed batch may take before its requests are claimed again (e.g. after a crash of the dispatcher)
+LEASE_DURATION = 60
+
+
+class Escalation(TypedDict):
+    escalation_id: int
+    dedup_key: str
+    user_id: str
+    sender: str
+    recipient: str
+    subject: str
+    body: str
+    payload: Dict[str, Any]
+    status: str
+    attempts: int
+    last_error: Optional[str]
+    created_at: str
+    delivered_at: Optional[str]
+    decided_at: Optional[str]
+    decision_note: Optional[str]
+    decision_token: Optional[str]
+    thread_id: Optional[str]
+    resumed_at: Optional[str]
+    resume_outcome: Optional[str]
+    resume_attempts: int
+
+
+def dedup_key(user_id, depart_flight, return_flight=None):
+    """Returns the key that identifies an escalation of the user for the selected flights."""
+    flights = [depart_flight] + ([return_flight] if return_flight else [])
+    identity = [str(user_id)] + [f"{flight['flight_code']}@{flight.get('date', '')}" for flight in flights]
+    return hashlib.sha256("|".join(identity).encode()).hexdigest()[:32]
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+def mail_body(escalation):
+    """Body of the mail sent to the manager: the user's message, and how to decide on the request with its token."""
+    return (f"{escalation['body']}\n\n"
+            f"Karariniz icin: POST /escalations/{escalation['escalation_id']}/decision {{\"approved\": true/false, \"note\": \"...\"}}\n"
+            f"Authorization: Bearer {escalation['decision_token']}")
+
+
+# -----------------------------------------------------------------------------------
+# Transports (send_batch returns, per message, None if it was delivered or the error message if it wasn't)
+
+class FileTransport:
+    """Appends the mails to a JSONL file, one line per mail (a local stand-in for an SMTP server)."""
+
+    def __init__(self, path=ESCALATION_MAIL_PATH):
+        self.path = path
+
+    def send_batch(self, escalations: List[Escalation]) -> List[Optional[str]]:
+        lines = "".join(json.dumps({"escalation_id": escalation["escalation_id"], "from": escalation["sender"], "to": escalation["recipient"], "subject": escalation["subject"], "body": mail_body(escalation), "sent_at": utc_now()}, ensure_ascii=False) + "\n" for escalation in escalations)
+        # One write per batch
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+        return [None] * len(escalations)
+
+
+class GatewayTransport:
+    """Sends the mails with the company systems' mail call, all mails of a batch at the same time."""
+
+    def __init__(self, corporate_gateway=None):
+        self.corporate_gateway = corporate_gateway or get_corporate_gateway()
+
+    async def _send(self, escalation):
+        with circuit_breaker("corporate").guard():
+            await self.corporate_gateway.send_mail(escalation["sender"], escalation["recipient"], escalation["subject"], mail_body(escalation))
+
+    def send_batch(self, escalations: List[Escalation]) -> List[Optional[str]]:
+        async def send_all():
+            return await asyncio.gather(*(self._send(escalation) for escalation in escalations), return_exceptions=True)
+        return [f"{type(result).__name__}: {result}" if isinstance(result, BaseException) else None for result in asyncio.run(send_all())]
+
+
+def get_transport(name=ESCALATION_TRANSPORT):
+    if name == "file":
+        return FileTransport()
+    if name == "gateway":
+        return GatewayTransport()
+    raise ValueError(f"Unknown ESCALATION_TRANSPORT: {name}")
+# -----------------------------------------------------------------------------------
+
+
+class EscalationOutbox:
+    """Durable queue of the escalation mails and their delivery / decision states (see the notes above)."""
+
+    def __init__(self, database_path=ESCALATION_OUTBOX_PATH, transport=None, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.database_path = database_path
+        self.transport = transport
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts, initial_delay=poll_interval, max_delay=10 * poll_interval)
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+        # Error of the last delivery round of the dispatcher that failed as a whole (e.g. the database was locked)
+        self.last_dispatch_error = None
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS escalations (
+                escalation_id INTEGER PRIMARY KEY,
+                dedup_key TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                delivered_at TEXT,
+                decided_at TEXT,
+                decision_note TEXT,
+                decision_token TEXT,
+                thread_id TEXT,
+                resumed_at TEXT,
+                resume_outcome TEXT,
+                resume_attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS escalations_due ON escalations (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS escalations_by_user ON escalations (user_id, escalation_id);
+            -- At most one request in flight per user and flights
+            CREATE UNIQUE INDEX IF NOT EXISTS escalations_in_flight ON escalations (dedup_key) WHERE status IN ('pending', 'sending', 'delivered');
+        """)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _to_escalation(self, row) -> Escalation:
+        (escalation_id, key, user_id, sender, recipient, subject, body, payload, status, attempts, _,
+         last_error, created_at, delivered_at, decided_at, decision_note, decision_token,
+         thread_id, resumed_at, resume_outcome, resume_attempts) = row
+        return {"escalation_id": escalation_id, "dedup_key": key, "user_id": user_id, "sender": sender, "recipient": recipient,
+                "subject": subject, "body": body, "payload": json.loads(payload), "status": status, "attempts": attempts,
+                "last_error": last_error, "created_at": created_at, "delivered_at": delivered_at, "decided_at": decided_at, "decision_note": decision_note,
+                "decision_token": decision_token, "thread_id": thread_id, "resumed_at": resumed_at, "resume_outcome": resume_outcome,
+                "resume_attempts": resume_attempts}
+
+    @tracer.traced("escalation_outbox.enqueue", kind="db")
+    def enqueue(self, user_info, manager_info, depart_flight, return_flight, subject, body, thread_id=None) -> tuple[Escalation, bool]:
+        """Stores the escalation (and the thread_id of the session it came from) for delivery and wakes up the dispatcher.
+        Returns (escalation, True if it's new), or the stored escalation and False if a request of the user for the same
+        flights is still in flight."""
+        key = dedup_key(user_info["id"], depart_flight, return_flight)
+        payload = {"user": {field: user_info[field] for field in ("name", "id", "email")}, "manager": manager_info, "depart_flight": depart_flight, "return_flight": return_flight}
+
+        connection = self._connection()
+        while True:
+            row = connection.execute("""
+                INSERT INTO escalations (dedup_key, user_id, sender, recipient, subject, body, payload, status, next_attempt_at, created_at, decision_token, thread_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)
+                ON CONFLICT (dedup_key) WHERE status IN ('pending', 'sending', 'delivered') DO NOTHING
+                RETURNING *
+            """, (key, str(user_info["id"]), user_info["email"], manager_info["email"], subject, body, json.dumps(payload, ensure_ascii=False), utc_now(),
+                  secrets.token_urlsafe(32), None if thread_id is None else str(thread_id))).fetchone()
+            created = row is not None
+            if not created:
+                row = connection.execute("SELECT * FROM escalations WHERE dedup_key = ? AND status IN ('pending', 'sending', 'delivered')", (key,)).fetchone()
+            # Otherwise the request in flight was decided in the meantime, and a new one can be stored
+            if row is not None:
+                break
+        escalation = self._to_escalation(row)
+
+        escalation_outbox_messages.inc(status="enqueued" if created else "deduplicated")
+        if created:
+            self.start_dispatcher()
+            self._wake.set()
+        return escalation, created
+
+    def get(self, escalation_id) -> Optional[Escalation]:
+        row = self._connection().execute("SELECT * FROM escalations WHERE escalation_id = ?", (escalation_id,)).fetchone()
+        return self._to_escalation(row) if row else None
+
+    def user_escalations(self, user_id, limit=100) -> List[Escalation]:
+        """Returns the latest escalations of the user, newest first."""
+        rows = self._connection().execute("SELECT * FROM escalations WHERE user_id = ? ORDER BY escalation_id DESC LIMIT ?", (str(user_id), limit)).fetchall()
+        return [self._to_escalation(row) for row in rows]
+
+    def record_decision(self, escalation_id, approved, note=None) -> Optional[Escalation]:
+        """Records the manager's decision on a delivered escalation. Returns the escalation, or None if it doesn't exist or
+        isn't waiting for a decision."""
+        cursor = self._connection().execute("""
+            UPDATE escalations SET status = ?, decided_at = ?, decision_note = ?, next_attempt_at = 0
+            WHERE escalation_id = ? AND status = 'delivered'
+        """, ("approved" if approved else "rejected", utc_now(), note, escalation_id))
+        if cursor.rowcount != 1:
+            return None
+        escalation_outbox_messages.inc(status="approved" if approved else "rejected")
+        return self.get(escalation_id)
+
+    def claim_decisions(self, limit=None) -> List[Escalation]:
+        """Claims the next decided requests whose sessions weren't resumed yet (for LEASE_DURATION seconds, so that concurrent
+        approval services don't resume the same session, and a failed attempt is tried again afterwards) and returns them."""
+        now = time.time()
+        rows = self._connection().execute("""
+            UPDATE escalations SET next_attempt_at = ?, resume_attempts = resume_attempts + 1
+            WHERE escalation_id IN (
+                SELECT escalation_id FROM escalations
+                WHERE status IN ('approved', 'rejected') AND resumed_at IS NULL AND next_attempt_at <= ?
+                ORDER BY escalation_id LIMIT ?
+            )
+            RETURNING *
+        """, (now + LEASE_DURATION, now, limit or self.batch_size)).fetchall()
+        return [self._to_escalation(row) for row in rows]
+
+    def record_resumption(self, escalation_id, outcome) -> Optional[Escalation]:
+        """Records that the session of the decided request was resumed, and the outcome (e.g. "purchased", "rejected")."""
+        self._connection().execute("UPDATE escalations SET resumed_at = ?, resume_outcome = ? WHERE escalation_id = ?", (utc_now(), outcome, escalation_id))
+        return self.get(escalation_id)
+
+    def record_resume_error(self, escalation_id, error) -> Optional[Escalation]:
+        """Records why an attempt to resume the session of the decided request failed. The request stays claimed until its
+        lease expires, and is claimed again afterwards."""
+        self._connection().execute("UPDATE escalations SET last_error = ? WHERE escalation_id = ?", (error, escalation_id))
+        return self.get(escalation_id)
+
+    # -------------------------------------------------------------------------------
+    # Delivery
+
+    def _claim_batch(self) -> List[Escalation]:
+        """Marks the next due requests as being sent (for LEASE_DURATION seconds) and returns them."""
+        now = time.time()
+        rows = self._connection().execute("""
+            UPDATE escalations SET status = 'sending', next_attempt_at = ?, attempts = attempts + 1
+            WHERE escalation_id IN (
+                SELECT escalation_id FROM escalations
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                ORDER BY escalation_id LIMIT ?
+            )
+            RETURNING *
+        """, (now + LEASE_DURATION, now, self.batch_size)).fetchall()
+        return [self._to_escalation(row) for row in rows]
+
+    @tracer.traced("escalation_outbox.deliver", kind="external")
+    def deliver_batch(self) -> int:
+        """Delivers the next batch of due requests and returns its size (0 if nothing was due)."""
+        escalations = self._claim_batch()
+        if not escalations:
+            return 0
+
+        transport = self.transport or get_transport()
+        try:
+            errors = transport.send_batch(escalations)
+        except Exception as e:
+            errors = [f"{type(e).__name__}: {e}"] * len(escalations)
+
+        connection = self._connection()
+        for escalation, error in zip(escalations, errors):
+            if error is None:
+                connection.execute("UPDATE escalations SET status = 'delivered', delivered_at = ?, last_error = NULL WHERE escalation_id = ? AND status = 'sending'", (utc_now(), escalation["escalation_id"]))
+                escalation_outbox_messages.inc(status="delivered")
+            elif escalation["attempts"] >= self.max_attempts:
+                connection.execute("UPDATE escalations SET status = 'failed', last_error = ? WHERE escalation_id = ? AND status = 'sending'", (error, escalation["escalation_id"]))
+                escalation_outbox_messages.inc(status="failed")
+            else:
+                # Try again after a backoff
+                connection.execute("UPDATE escalations SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE escalation_id = ? AND status = 'sending'", (time.time() + self.retry_policy.backoff(escalation["attempts"]), error, escalation["escalation_id"]))
+                escalation_outbox_messages.inc(status="retried")
+        return len(escalations)
+
+    def deliver_all(self):
+        """Delivers batches until no request is due."""
+        while self.deliver_batch() == self.batch_size:
+            pass
+
+    def start_dispatcher(self):
+        """Starts the background thread that delivers the requests (once per process)."""
+        with self._dispatcher_lock:
+            if self._dispatcher is not None:
+                return
+
+            def dispatch_loop():
+                while True:
+                    # Woken up by new requests, otherwise checks for due retries every poll interval
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    try:
+                        self.deliver_all()
+                    except Exception as e:
+                        # The requests stay in the outbox and are delivered in the next round (the failure is counted, and
+                        # kept for inspection)
+                        self.last_dispatch_error = f"{type(e).__name__}: {e}"
+                        escalation_outbox_messages.inc(status="dispatch_error")
+
+            self._dispatcher = threading.Thread(target=dispatch_loop, name="escalation-outbox", daemon=True)
+            self._dispatcher.start()
+        # Deliver what was left over by an earlier run
+        self._wake.set()
+# -----------------------------------------------------------------------------------
+
+
+# Outbox shared by the escalation tool, the approval service and the server (created on first use)
+_escalation_outbox = None
+_escalation_outbox_lock = threading.Lock()
+
+def get_escalation_outbox():
+    global _escalation_outbox
+    with _escalation_outbox_lock:
+        if _escalation_outbox is None:
+            _escalation_outbox = EscalationOutbox()
+    return _escalation_outbox
+
+
+
+
+if __name__ == "__main__":
+
+    # Enqueue escalations from many threads and let the dispatcher deliver them in batches to a file
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as directory:
+        mail_path = os.path.join(directory, "mails.jsonl")
+        outbox = EscalationOutbox(os.path.join(directory, "outbox.db"), transport=FileTransport(mail_path), poll_interval=0.05)
+        manager_info = {"name": "Ali", "id": 12345678910, "email": "ali@langgraph.com"}
+
+        def escalate(index):
+            user_info = {"name": f"User {index % 100}", "id": index % 100, "email": f"user{index % 100}@langgraph.com"}
+            flight = {"flight_code": f"TK{800 + index % 300}", "date": "2025-06-10"}
+            start_time = time.perf_counter()
+            outbox.enqueue(user_info, manager_info, flight, None, f"{flight['flight_code']} kodlu ucus icin onay talebi", "Musteri toplantisi")
+            return time.perf_counter() - start_time
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            durations = sorted(executor.map(escalate, range(1000)))
+        time.sleep(0.5)
+
+        with open(mail_path, encoding="utf-8") as file:
+            mails = file.readlines()
+        print(f"Enqueued 1000 escalations (median {1000 * durations[500]:.2f} ms, p99 {1000 * durations[990]:.2f} ms), {len(mails)} unique mails delivered")
+
+        escalation = outbox.record_decision(1, approved=True, note="Onaylandi")
+        print(f"Escalation 1: {escalation['status']} ({escalation['decision_note']})")
@@ -2,32 +2,63 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
 
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from datetime import datetime
+import threading
 
-from flight_assistant.tools.flight_search import FlightSearchTool
+from flight_assistant.tools.flight_search import FlightSearchTool, MultiFlightSearchTool
+from common.llm_provider import get_chat_model
+from common.context_manager import ContextManager, get_context_budget, make_llm_summarizer, make_async_llm_summarizer
+from common.streaming import STREAM_TEXT_TAG
+from common.llm_cache import with_response_cache
+from common.prompts import register_prompt
 
 
-# Load api key from .env file
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
+# -----------------------------------------------------------------------------------
+# The model, the chain and the context manager are created on first use (see travel_agent.py)
 
-# Initialize gpt-4o-mini model
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.2,
-    max_tokens=200,
-    timeout=None,
-    max_retries=2,
-    openai_api_key=openai_api_key
-    )
+def create_flight_agent():
+    """Creates the flight llm (bound to the flight search tools) and its context manager."""
+    # Initialize gpt-4o-mini model (or the fake model of the configured llm provider)
+    llm = get_chat_model(
+        "flight",
+        model="gpt-4o-mini",
+        temperature=0.2,
+        max_tokens=200,
+        max_retries=2,
+        openai_api_key=os.getenv("OPENAI_API_KEY")
+        )
 
-# Bind the flight search tool to the language model
-flight_llm = llm.bind_tools([FlightSearchTool()], parallel_tool_calls=False)
+    # Bind the flight search tools (a single route, or several departure and arrival cities at once) to the language model (tagged so that its chat responses are streamed to the user token by token)
+    search_tools = [FlightSearchTool(), MultiFlightSearchTool()]
+    flight_llm = llm.bind_tools(search_tools, parallel_tool_calls=False).with_config(tags=[STREAM_TEXT_TAG], metadata=flight_prefix.metadata)
+    # Serve repeated conversations from the response cache if enabled (only before the first flight search, responses after tool results are never cached)
+    flight_llm = with_response_cache(flight_llm, namespace="flight", params={"model": llm.model_name, "temperature": llm.temperature, "max_tokens": llm.max_tokens, "tools": [tool.name for tool in search_tools]})
 
-# Define the system prompt
-system_prompt=f"""You are a flight booking assistant. Your main responsibility is to collect the required information about the user's intended trip and use this information to search available flight options for the user. The required information for searching flights are:
+    # Context manager that keeps the flight message history sent to flight_llm within the token budget (older turns are replaced with a rolling summary)
+    flight_context = ContextManager(name="flight", max_tokens=get_context_budget("flight", 4000), summarizer=make_llm_summarizer(llm), asummarizer=make_async_llm_summarizer(llm))
+
+    return flight_llm, flight_context
+
+
+_flight_agent = None
+_flight_agent_lock = threading.Lock()
+
+def _get_flight_agent():
+    global _flight_agent
+    with _flight_agent_lock:
+        if _flight_agent is None:
+            _flight_agent = create_flight_agent()
+    return _flight_agent
+
+def get_flight_llm():
+    return _get_flight_agent()[0]
+
+def get_flight_context():
+    return _get_flight_agent()[1]
+# -----------------------------------------------------------------------------------
+
+# Define the system prompts (static, so that the provider can cache them as the prefix of every call; today's date is
+# added after them on every call, see common/prompts.py)
+system_prompt="""You are a flight booking assistant. Your main responsibility is to collect the required information about the user's intended trip and use this information to search available flight options for the user. The required information for searching flights are:
 - Is trip one-way or two-way
 - The departure and arrival locations (cities) for the trip
 - The preferred depart and return dates for the trip (return date is only required for two-way trips)
@@ -38,11 +69,11 @@ Besides your main responsibility, you should also follow these guidelines:
 - If the user asks/tells you anything about another/off-topic subject that is irrelevant to their trip/flight, state that you can only help with booking flight tickets and turn the conversation back to gathering required flight info from the user.
 - Assume the users are Turkish. So please give your help/answers in Turkish.
 - Try to be immune to user typos. For example, the users may not type the city names exactly and correctly. So, when they provide names for locations/cities and if those names don't make any sense at all (not a real place on Earth), please make a deduction from the user input and match it with a real city and "provide it back to the user"/"check it with the user" accordingly.
-- Also, the user might state their preferred dates in an implied manner (e.g. "tomorow", "next Thursday", "second Friday of the next month" etc.). In such cases, you should be able to deduce the exact date correctly based on today's date. Here is today's date (in YYYY-MM-DD format) and the corresponding weekday: {datetime.today().strftime("%Y-%m-%d %A")}
+- Also, the user might state their preferred dates in an implied manner (e.g. "tomorow", "next Thursday", "second Friday of the next month" etc.). In such cases, you should be able to deduce the exact date correctly based on today's date, which is given in the system message that follows this one.
 
 Begin assisting the user."""
 
-flight_prompt=f"""You are a flight booking assistant whose main responsibility is to helps users to search and book flights.
+flight_prompt="""You are a flight booking assistant whose main responsibility is to helps users to search and book flights.
 
 Besides your main responsibility, you should also follow these guidelines:
 - Keep the conversation in a natural, human-like manner and be polite.
@@ -51,7 +82,8 @@ Besides your main responsibility, you should also follow these guidelines:
 - Assume the users are Turkish. So please give your help/answers in Turkish.
 - Try to be immune to user typos. For example, the users may not type the city names exactly and correctly. In those cases, use your reasoning to make a deduction from the user input and match it with real city/location names.
 - If the user input looks like complete gibberish and doesn't make any sense at all such that it's impossible make guesses on it, don't be shy to ask user for verifications or corrections. If the user insists on the same input, then accept it as it is and proceed with it.
-- Also, the user might state their preferred dates in an implied manner (e.g. "tomorow", "next Thursday", "second Friday of the next month" etc.). In such cases, you should be able to deduce the exact date correctly based on today's date. Here is today's date (in YYYY-MM-DD format) and the corresponding weekday: {datetime.today().strftime("%Y-%m-%d %A")}
+- Also, the user might state their preferred dates in an implied manner (e.g. "tomorow", "next Thursday", "second Friday of the next month" etc.). In such cases, you should be able to deduce the exact date correctly based on today's date, which is given in the system message that follows this one.
 
 Begin assisting the user."""
 
+flight_prefix = register_prompt("flight", 2, flight_prompt)
@@ -1,9 +1,13 @@
 import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
-import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
 
-from langchain_core.messages import ToolMessage, HumanMessage, SystemMessage
+from langchain_core.messages import ToolMessage, HumanMessage, SystemMessage, AIMessage
 from langchain_core.runnables.config import RunnableConfig
 
 from typing import Annotated, Any, Optional, List
@@ -11,23 +15,35 @@ from typing_extensions import TypedDict, Literal
 
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.types import Command
 from langgraph.pregel.io import AddableValuesDict
 
-from flight_assistant.tools.flight_search import FlightSearchTool
+from flight_assistant.tools.flight_search import FlightSearchTool, MultiFlightSearchTool
 from flight_assistant.tools.ticket_purchase import TicketPurchaseTool
 from flight_assistant.tools.manager_escalation import ManagerEscalationTool
-from flight_assistant.flight_agent import flight_llm, flight_prompt
+from flight_assistant.flight_agent import get_flight_llm, get_flight_context, flight_prompt
 from flight_assistant.utils import pretty_print_object
-from policy_assistant.policy_agent import policy_llm
+from flight_assistant.compaction import compact_search_results
+from flight_assistant.prefetch import prefetcher, flight_key, SEARCH_PREFETCH_ENABLED, POLICY_PREFETCH_ENABLED
+from policy_assistant.policy_agent import get_policy_llm
+from common.prompts import date_context, with_dynamic_context
+from common.human_io import notify_user, run_interaction, arun_interaction
+from common.graph_utils import add_dual_node, draw_graph_image
+from common.tracing import tracer
+from common.metrics import policy_checks, manager_escalations, ticket_purchases, node_retries, checkpoint_store_bytes
+from common.checkpoints import create_checkpointer, checkpoint_store_size
+from common.retry import node_retry_policy, CircuitOpenError
 
 
 # -----------------------------------------------------------------------------------
 # Create tool instances
 flight_search_tool = FlightSearchTool()
+multi_flight_search_tool = MultiFlightSearchTool()
 ticket_purchase_tool = TicketPurchaseTool()
 manager_escalation_tool = ManagerEscalationTool()
+
+# The flight search tools the flight llm is bound to, by name (both return the flights in the same form)
+search_tools = {tool.name: tool for tool in [flight_search_tool, multi_flight_search_tool]}
 # -----------------------------------------------------------------------------------
 
 
@@ -56,38 +72,48 @@ class FlightState(TypedDict):
     purchased_return_ticket: Optional[dict[str, Any]]
     # Variable to mark the end of the flight agent pipeline
     flight_completed: bool
+    # Number of failed attempts of the current tool node (ticket purchase or manager escalation), reset once it succeeds
+    failed_attempts: int
+    # Id of the manager escalation of the selected flights in the outbox, and the state of the manager's approval: "pending" while
+    # the session is parked, then "approved" or "rejected" when approval_service.py resumes the session to act on the decision
+    escalation_id: Optional[int]
+    approval_status: Optional[Literal["pending", "approved", "rejected"]]
 # -----------------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------------
-def flight_search_node(state: FlightState) -> Command[Literal["flight_agent", "human_tool_reviewer"]]:
+def prepare_flight_search_call(state: FlightState) -> dict[str, Any]:
     # Get the latest tool call from the state
     latest_tool_call = state["latest_tool_call"]
     # Assert the tool name and status of the tool call
-    assert latest_tool_call["name"] == "search_flights"
+    assert latest_tool_call["name"] in search_tools
     assert latest_tool_call["status"] == "approved"
 
-    # Inject the tool_call_id (InjectedToolArg) in addition to the existing arguments of the tool call
-    latest_tool_call["args"] = {"tool_call_id": latest_tool_call["id"], **latest_tool_call["args"]}
-
-    # Invoke the tool with constructed arguments and get the tool response
-    tool_response = flight_search_tool.invoke(latest_tool_call)
+    return latest_tool_call
 
+def flight_search_command(latest_tool_call: dict[str, Any], tool_response: ToolMessage, config: RunnableConfig) -> Command[Literal["flight_agent", "human_tool_reviewer"]]:
     # If tool returned a successful response
     if tool_response.status == "success":
-        # Convert the content (string) of the tool response to a dictionary
-        results = json.loads(tool_response.content)
-        # Get the retrieved flight details from the tool response
+        # Get the retrieved flight details from the artifact of the tool response (its content holds them as compact tables for the llm)
+        results = tool_response.artifact
         retrieved_depart_flights = results["depart_flights"]
         retrieved_return_flights = results["return_flights"]
+        # The flights are kept in the retrieved flight fields, so the message in the conversation doesn't carry them twice
+        tool_response = tool_response.model_copy(update={"artifact": None})
 
         # Mark latest tool call status as completed
         latest_tool_call["status"] = "completed"
 
-        print("\nTesekkurler. Simdi sizin icin ucuslari listeleyecegim. Lutfen secenekleri inceleyin ve size en uygun ucusu secin.")
+        # Check the retrieved flights against the policy while the user selects (see flight_assistant/prefetch.py)
+        if POLICY_PREFETCH_ENABLED:
+            policy_llm = get_policy_llm()
+            for flight in retrieved_depart_flights + retrieved_return_flights:
+                prefetcher.start(latest_tool_call["id"], "policy", policy_llm.invoke, {"input": flight}, item=flight_key(flight))
+
+        notify_user(config, "\nTesekkurler. Simdi sizin icin ucuslari listeleyecegim. Lutfen secenekleri inceleyin ve size en uygun ucusu secin.")
 
         # Update the state with tool response, latest tool call, the retrieved flight details and next action set as ticket purchase. Route back to the human tool reviewer to continue with the ticket selection and purchase process.
         return Command(update={"messages": [tool_response], "latest_tool_call": latest_tool_call, "retrieved_depart_flights": retrieved_depart_flights, "retrieved_return_flights": retrieved_return_flights, "next_action": "ticket_purchase"}, goto="human_tool_reviewer")
-    
+
     # If tool returned an unsuccessful response
     else:
         # Assert that tool response status is "error"
@@ -98,117 +124,227 @@ def flight_search_node(state: FlightState) -> Command[Literal["flight_agent", "h
 
         # Update the state with the tool response and latest tool call, and route back to the flight agent for llm to take further action upon tool error
         return Command(update={"messages": [tool_response], "latest_tool_call": latest_tool_call}, goto="flight_agent")
+
+def speculative_search(tool_call: dict[str, Any]) -> Optional[ToolMessage]:
+    """Runs the search of a tool call before it's approved (see flight_assistant/prefetch.py). Unsuccessful searches are
+    done again once approved, as their cause may be transient."""
+    tool_response = search_tools[tool_call["name"]].invoke(tool_call)
+    return tool_response if tool_response.status == "success" else None
+
+def flight_search_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "human_tool_reviewer"]]:
+    latest_tool_call = prepare_flight_search_call(state)
+
+    # Take the results of the search started while the user reviewed its parameters, or invoke the tool with the arguments of the tool call
+    tool_response = prefetcher.take(latest_tool_call["id"], "search") or search_tools[latest_tool_call["name"]].invoke(latest_tool_call)
+
+    return flight_search_command(latest_tool_call, tool_response, config)
+
+async def aflight_search_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "human_tool_reviewer"]]:
+    latest_tool_call = prepare_flight_search_call(state)
+
+    # Take the prefetched results, or invoke the tool without blocking the event loop (the database query runs in a worker thread)
+    tool_response = await prefetcher.atake(latest_tool_call["id"], "search") or await search_tools[latest_tool_call["name"]].ainvoke(latest_tool_call)
+
+    return flight_search_command(latest_tool_call, tool_response, config)
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Bounded retries of the nodes that call external systems (see common/retry.py)
+
+# (error message shown to the user before a retry, message shown once the node gives up, note to the flight agent llm) of the nodes
+PURCHASE_FAILURE = (
+    "Bilet satin alma islemi sirasinda bir hata olustu",
+    "Uzgunum, bilet satin alma islemi su anda tamamlanamiyor. Lutfen bir sure sonra tekrar deneyin.",
+    "This is a system message indicating that the ticket purchase failed repeatedly because of a system error, so the user's flight selections were discarded. If the user wants to try again, start over with a new flight search.",
+)
+ESCALATION_FAILURE = (
+    "Onay talebi sirasinda bir hata olustu",
+    "Uzgunum, onay talebiniz su anda yoneticinize iletilemiyor. Lutfen bir sure sonra tekrar deneyin.",
+    "This is a system message indicating that sending the exception approval request to the user's manager failed repeatedly because of a system error, so the user's flight selections were discarded. If the user wants to try again, start over with a new flight search.",
+)
+
+def failed_attempt_command(state: FlightState, config: RunnableConfig, node: str, error: Exception, failure: tuple[str, str, str]) -> tuple[Command, float]:
+    """Returns the command after a failed attempt of the node and the seconds to wait before it: another attempt of the node,
+    or (once the retry budget is used up or the downstream system's circuit is open) a failure message to the user."""
+    error_message, give_up_message, llm_note = failure
+    failed_attempts = state["failed_attempts"] + 1
+
+    if node_retry_policy.exhausted(failed_attempts) or isinstance(error, CircuitOpenError):
+        node_retries.inc(node=node, outcome="exhausted")
+        notify_user(config, f"\n{error_message}: {str(error)}.")
+        # Discard the selections and end the turn with the failure message (the user can start over in the next turn)
+        return Command(update={"messages": [SystemMessage(content=llm_note), AIMessage(content=give_up_message)], "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search", "failed_attempts": 0}, goto="flight_agent"), 0.0
+
+    node_retries.inc(node=node, outcome="retried")
+    notify_user(config, f"\n{error_message}: {str(error)}. \nTekrar deneniyor ({failed_attempts}/{node_retry_policy.max_attempts - 1})...")
+    return Command(update={"failed_attempts": failed_attempts}, goto=node), node_retry_policy.backoff(failed_attempts)
 # -----------------------------------------------------------------------------------
 
 
 # -----------------------------------------------------------------------------------
+def ticket_purchase_command(state: FlightState, result: dict[str, Any]) -> Command[Literal["flight_agent"]]:
+    # Get the selected depart and return flight details from the state
+    selected_depart_flight = state["selected_depart_flight"]
+    selected_return_flight = state["selected_return_flight"]
+
+    # Construct a system message to deliver back to flight_llm on the completion and details of the flight booking
+    completion_message = (f"This is a system message indicating that the user has successfully completed their flight booking process." +
+                        f"\n\nBelow are the details of the trip and the tickets they've purchased:" +
+                        f"\n- Trip information: {state['latest_tool_call']['args']}" +
+                        f"\n- Departure ticket: {selected_depart_flight}" +
+                        f"\n- Return ticket: {selected_return_flight}" +
+                        f"\n\nIf the user has additional travel plans and wishes to book more flights, continue assisting them accordingly.")
+
+    ticket_purchases.inc(trip_type="two-way" if selected_return_flight is not None else "one-way", status="completed")
+
+    # If the ticket purchase carried out, save purchased tickets to the state
+    # Then, mark the flight pipeline as completed and route back to the flight agent node
+    return Command(update={"messages": [SystemMessage(content=completion_message)], "purchased_depart_ticket": result["depart_ticket"], "purchased_return_ticket": result["return_ticket"], "flight_completed": True, "failed_attempts": 0}, goto="flight_agent")
+
 def ticket_purchase_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "ticket_purchase_node"]]:
 
     # Purchase tickets for the user based on the selected flight details
     try:
-        # Get the selected depart and return flight details from the state
-        selected_depart_flight = state["selected_depart_flight"]
-        selected_return_flight = state["selected_return_flight"]
-
         # Invoke the ticket purchase tool with the selected flight details and the configuration dictionary (which may contain additional runtime information like user or session info etc.)
-        result = ticket_purchase_tool.invoke({"config": config, "depart_flight": selected_depart_flight, "return_flight": selected_return_flight})
-
-        # Construct a system message to deliver back to flight_llm on the completion and details of the flight booking
-        completion_message = (f"This is a system message indicating that the user has successfully completed their flight booking process." +
-                            f"\n\nBelow are the details of the trip and the tickets they've purchased:" +
-                            f"\n- Trip information: {state['latest_tool_call']['args']}" +
-                            f"\n- Departure ticket: {selected_depart_flight}" +
-                            f"\n- Return ticket: {selected_return_flight}" +
-                            f"\n\nIf the user has additional travel plans and wishes to book more flights, continue assisting them accordingly.")
-
-        # If the ticket purchase carried out, save purchased tickets to the state
-        # Then, mark the flight pipeline as completed and route back to the flight agent node
-        return Command(update={"messages": [SystemMessage(content=completion_message)], "purchased_depart_ticket": result["depart_ticket"], "purchased_return_ticket": result["return_ticket"], "flight_completed": True}, goto="flight_agent")
-    
+        result = ticket_purchase_tool.invoke({"config": config, "depart_flight": state["selected_depart_flight"], "return_flight": state["selected_return_flight"], "tool_call_id": state["latest_tool_call"]["id"]})
+
+        return ticket_purchase_command(state, result)
+
     except Exception as e:
-        # Inform user
-        print(f"\nBilet satin alma islemi sirasinda bir hata olustu: {str(e)}. \nTekrar deneniyor...")
+        ticket_purchases.inc(trip_type="two-way" if state["selected_return_flight"] is not None else "one-way", status="failed")
 
-        # And try again by routing back to this node with the same state
-        return Command(goto="ticket_purchase_node")
+        # Try again after a backoff by routing back to this node, or give up once the retry budget is used up
+        command, delay = failed_attempt_command(state, config, "ticket_purchase_node", e, PURCHASE_FAILURE)
+        time.sleep(delay)
+        return command
+
+async def aticket_purchase_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "ticket_purchase_node"]]:
+
+    # Purchase tickets for the user based on the selected flight details
+    try:
+        result = await ticket_purchase_tool.ainvoke({"config": config, "depart_flight": state["selected_depart_flight"], "return_flight": state["selected_return_flight"], "tool_call_id": state["latest_tool_call"]["id"]})
+
+        return ticket_purchase_command(state, result)
+
+    except Exception as e:
+        ticket_purchases.inc(trip_type="two-way" if state["selected_return_flight"] is not None else "one-way", status="failed")
+
+        # Try again after a backoff by routing back to this node, or give up once the retry budget is used up
+        command, delay = failed_attempt_command(state, config, "ticket_purchase_node", e, PURCHASE_FAILURE)
+        await asyncio.sleep(delay)
+        return command
 # -----------------------------------------------------------------------------------
 
 
 # -----------------------------------------------------------------------------------
+def manager_escalation_command(state: FlightState, escalation: dict[str, Any], config: RunnableConfig) -> Command[Literal["flight_agent"]]:
+    # Get the selected depart and return flight details from the state
+    selected_depart_flight = state["selected_depart_flight"]
+    selected_return_flight = state["selected_return_flight"]
+
+    manager_escalations.inc(status="sent")
+
+    # The escalation may be an earlier request of the user for the same flights (see flight_assistant/escalation_outbox.py),
+    # which may have been decided already, or be waiting for the decision in another session of the user
+    if escalation["status"] in ["approved", "rejected"]:
+        # Act on the decision right away (see route_flight_agent), rather than waiting for a decision that already came
+        return Command(update={"failed_attempts": 0, "escalation_id": escalation["escalation_id"], "approval_status": escalation["status"]}, goto="flight_agent")
+
+    thread_id = config["configurable"].get("thread_id")
+    parked = escalation["thread_id"] is not None and escalation["thread_id"] == str(thread_id)
+
+    # Construct a system message to deliver back to flight_llm on the completion and details of the flight booking
+    completion_message = (f"This is a system message indicating that the user has completed their flight booking process." +
+                        f"\n\nBelow are the details of the trip and the tickets they've selected:" +
+                        f"\n- Trip information: {state['latest_tool_call']['args']}" +
+                        f"\n- Departure ticket: {selected_depart_flight}" +
+                        f"\n- Return ticket: {selected_return_flight}" +
+                        ("" if parked else "\n\nThe user had already asked their manager for approval of the same flights in another conversation, so the manager's decision will be delivered there, not in this conversation.") +
+                        f"\n\nIf the user has additional travel plans and wishes to book more flights, continue assisting them accordingly.")
+
+    # Once it's complete, mark the flight pipeline as completed and route back to the flight agent node
+    if parked:
+        # The session is parked until the manager decides on the escalation (see approval_service.py)
+        return Command(update={"messages": [SystemMessage(content=completion_message)], "flight_completed": True, "failed_attempts": 0, "escalation_id": escalation["escalation_id"], "approval_status": "pending"}, goto="flight_agent")
+
+    # The escalation belongs to another session, which is resumed with the decision, so this one isn't parked
+    notify_user(config, "\nBu talep baska bir oturumunuzda olusturuldugu icin yoneticinizin karari o oturuma iletilecek.")
+    return Command(update={"messages": [SystemMessage(content=completion_message)], "flight_completed": True, "failed_attempts": 0, "escalation_id": None, "approval_status": None}, goto="flight_agent")
+
 def manager_escalation_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "manager_escalation_node"]]:
-    
+
     # Send request to manager (with additional explanatory message) to purchase tickets that violate company policy
     try:
-        # Get the selected depart and return flight details from the state
-        selected_depart_flight = state["selected_depart_flight"]
-        selected_return_flight = state["selected_return_flight"]
-
-        # Get the escalation message from the state
-        escalation_message = state["escalation_message"]
-
-        # Invoke the manager escalation tool
-        result = manager_escalation_tool.invoke({"config": config, "depart_flight": selected_depart_flight, "return_flight": selected_return_flight, "escalation_message": escalation_message})
-
-        # Construct a system message to deliver back to flight_llm on the completion and details of the flight booking
-        completion_message = (f"This is a system message indicating that the user has completed their flight booking process." +
-                            f"\n\nBelow are the details of the trip and the tickets they've selected:" +
-                            f"\n- Trip information: {state['latest_tool_call']['args']}" +
-                            f"\n- Departure ticket: {selected_depart_flight}" +
-                            f"\n- Return ticket: {selected_return_flight}" +
-                            f"\n\nIf the user has additional travel plans and wishes to book more flights, continue assisting them accordingly.")
-
-        # Once it's complete, mark the flight pipeline as completed and route back to the flight agent node
-        return Command(update={"messages": [SystemMessage(content=completion_message)], "flight_completed": True}, goto="flight_agent")
-    
+        # Invoke the manager escalation tool with the selected flights and the escalation message from the state
+        escalation = manager_escalation_tool.invoke({"config": config, "depart_flight": state["selected_depart_flight"], "return_flight": state["selected_return_flight"], "escalation_message": state["escalation_message"]})
+
+        return manager_escalation_command(state, escalation, config)
+
+    except Exception as e:
+        manager_escalations.inc(status="failed")
+
+        # Try again after a backoff by routing back to this node, or give up once the retry budget is used up
+        command, delay = failed_attempt_command(state, config, "manager_escalation_node", e, ESCALATION_FAILURE)
+        time.sleep(delay)
+        return command
+
+async def amanager_escalation_node(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "manager_escalation_node"]]:
+
+    # Send request to manager (with additional explanatory message) to purchase tickets that violate company policy
+    try:
+        escalation = await manager_escalation_tool.ainvoke({"config": config, "depart_flight": state["selected_depart_flight"], "return_flight": state["selected_return_flight"], "escalation_message": state["escalation_message"]})
+
+        return manager_escalation_command(state, escalation, config)
+
     except Exception as e:
-        # Inform user
-        print(f"\nOnay talebi sirasinda bir hata olustu: {str(e)}. \nTekrar deneniyor...")
+        manager_escalations.inc(status="failed")
 
-        # And try again by routing back to this node with the same state
-        return Command(goto="manager_escalation_node")
+        # Try again after a backoff by routing back to this node, or give up once the retry budget is used up
+        command, delay = failed_attempt_command(state, config, "manager_escalation_node", e, ESCALATION_FAILURE)
+        await asyncio.sleep(delay)
+        return command
 # -----------------------------------------------------------------------------------
 
 
 # -----------------------------------------------------------------------------------
-def policy_control_node(state: FlightState) -> Command[Literal["ticket_purchase_node", "human_tool_reviewer"]]:
+# Interactive steps of the policy control node (run with the policy check results, see common/human_io.py for how the steps are driven)
+def policy_control_steps(state: FlightState, result_depart: dict[str, Any], result_return: Optional[dict[str, Any]], config: RunnableConfig):
     # Get the selected depart and return flight details from the state
     selected_depart_flight = state["selected_depart_flight"]
     selected_return_flight = state["selected_return_flight"]
 
-    # Check if the selected flights comply with the company policy
-    print("\nSectiginiz ucuslarin sirket politikasina uygunlugu kontrol ediliyor...")
-
     policy_violation = False
 
-    # Invoke the policy agent with the selected flight details and get the results of the policy check
-    result_depart = policy_llm.invoke({"input": selected_depart_flight})
+    # Count the result of every checked flight
+    for result in [result_depart] + ([result_return] if selected_return_flight is not None else []):
+        policy_checks.inc(result="pass" if result["complies"] else "fail")
+
+    # Inform the user about the results of the policy check
     if result_depart["complies"] == False:
         policy_violation = True
-        print("\n\nUzgunum, sectiginiz ucuslar sirket politikasina uygun degil.")
-        print(f"\nGidis ucusu \033[1m({selected_depart_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_depart['details']}")
-    
-    if selected_return_flight is not None:
-        result_return = policy_llm.invoke({"input": selected_return_flight})
+        notify_user(config, "\n\nUzgunum, sectiginiz ucuslar sirket politikasina uygun degil.")
+        notify_user(config, f"\nGidis ucusu \033[1m({selected_depart_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_depart['details']}")
 
+    if selected_return_flight is not None:
         if result_return["complies"] == False and policy_violation == True:
-            print(f"\nDonus ucusu \033[1m({selected_return_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_return['details']}")
+            notify_user(config, f"\nDonus ucusu \033[1m({selected_return_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_return['details']}")
         elif result_return["complies"] == False and policy_violation == False:
             policy_violation = True
-            print("\n\nUzgunum, sectiginiz ucuslar sirket politikasina uygun degil.")
-            print(f"\nDonus ucusu \033[1m({selected_return_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_return['details']}")
+            notify_user(config, "\n\nUzgunum, sectiginiz ucuslar sirket politikasina uygun degil.")
+            notify_user(config, f"\nDonus ucusu \033[1m({selected_return_flight['flight_code']})\033[0m asagidaki politikalara uymamaktadir:\n{result_return['details']}")
 
     # If the selected flights violate the policy
     if policy_violation:
         counter = 1
-        
+
         while True:
             if counter > 1:
-                print("\nGecersiz secim. Lutfen 1, 0 veya 2 tuslayin.")
+                notify_user(config, "\nGecersiz secim. Lutfen 1, 0 veya 2 tuslayin.")
 
             # Prompt the user to select one of the three possible option: escalate to manager, change selected flights, or search for new flights
             prompt_text = "\n\nYoneticinizden istisna onay sureci talebinde bulunmak icin 1, ucus secimlerinizi degistirmek icin 0, arama kriterlerinizi degistirmek ve baska ucuslar aramak icin 2 tuslayin: "
-            print(prompt_text)
-            user_choice = input()
+            user_choice = yield prompt_text
 
             # If the user wants to escalate to manager
             if user_choice == "1":
@@ -223,10 +359,10 @@ def policy_control_node(state: FlightState) -> Command[Literal["ticket_purchase_
                 # Generate a synthetic user message to convey the user's intention to search for new flights
                 synth_user_message = HumanMessage(content="Arama kriterlerimi degistirmek ve baska ucuslar aramak istiyorum.")
 
-                # Add this to the state messages to trigger the flight agent for a response
+                # Add this to the state messages to trigger the flight agent for a response (with the earlier search results compacted, see flight_assistant/compaction.py)
                 # Reset all retrieved and selected flights, set the next action to flight search,
                 # and route back to the flight agent node
-                return Command(update={"messages": [synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
+                return Command(update={"messages": [*compact_search_results(state["messages"]), synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
             # If the user entered an invalid choice
             else:
                 counter += 1
@@ -235,14 +371,67 @@ def policy_control_node(state: FlightState) -> Command[Literal["ticket_purchase_
     # If the selected flights comply with the policy
     else:
         # Route to the ticket purchase node to proceed with the ticket purchase process
-        print("\nSectiginiz ucuslar sirket politikasina uygundur. Bilet satin alma islemine devam ediliyor...")
+        notify_user(config, "\nSectiginiz ucuslar sirket politikasina uygundur. Bilet satin alma islemine devam ediliyor...")
         return Command(goto="ticket_purchase_node")
+
+def check_policy(state: FlightState, flight: dict[str, Any]) -> dict[str, Any]:
+    # The verdict prefetched while the user selected the flights (see flight_assistant/prefetch.py), or a policy check now
+    return prefetcher.take(state["latest_tool_call"]["id"], "policy", flight_key(flight)) or get_policy_llm().invoke({"input": flight})
+
+async def acheck_policy(state: FlightState, flight: dict[str, Any]) -> dict[str, Any]:
+    return await prefetcher.atake(state["latest_tool_call"]["id"], "policy", flight_key(flight)) or await get_policy_llm().ainvoke({"input": flight})
+
+def policy_control_node(state: FlightState, config: RunnableConfig) -> Command[Literal["ticket_purchase_node", "human_tool_reviewer", "flight_agent"]]:
+    # Check if the selected flights comply with the company policy
+    notify_user(config, "\nSectiginiz ucuslarin sirket politikasina uygunlugu kontrol ediliyor...")
+
+    # Invoke the policy agent with the selected flight details and get the results of the policy check
+    result_depart = check_policy(state, state["selected_depart_flight"])
+    result_return = check_policy(state, state["selected_return_flight"]) if state["selected_return_flight"] is not None else None
+
+    return run_interaction(policy_control_steps(state, result_depart, result_return, config), config)
+
+async def apolicy_control_node(state: FlightState, config: RunnableConfig) -> Command[Literal["ticket_purchase_node", "human_tool_reviewer", "flight_agent"]]:
+    # Check if the selected flights comply with the company policy
+    notify_user(config, "\nSectiginiz ucuslarin sirket politikasina uygunlugu kontrol ediliyor...")
+
+    # Check the depart and return flights concurrently
+    if state["selected_return_flight"] is not None:
+        result_depart, result_return = await asyncio.gather(acheck_policy(state, state["selected_depart_flight"]), acheck_policy(state, state["selected_return_flight"]))
+    else:
+        result_depart, result_return = await acheck_policy(state, state["selected_depart_flight"]), None
+
+    return await arun_interaction(policy_control_steps(state, result_depart, result_return, config), config)
 # -----------------------------------------------------------------------------------
 
 
 # -----------------------------------------------------------------------------------
-# Node to prompt the user to review and approve/reject the tool calls, and manage their routing
-def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "flight_search_node", "policy_control_node","ticket_purchase_node", "manager_escalation_node", "human_tool_reviewer"]]:
+# Texts of the review and selection prompts (for the results of both search tools)
+def search_cities_text(args: dict[str, Any], side: Literal["from", "to"]) -> str:
+    """Searched departure or arrival cities of a search tool call (a city, or the cities and the radius of a multi-route search)."""
+    if f"{side}_city" in args:
+        return args[f"{side}_city"]
+    text = ", ".join(args[f"{side}_cities"])
+    return text + (f" (ve {args['radius_km']:g} km cevresindeki sehirler)" if args.get("radius_km") else "")
+
+def flight_options_text(flights: List[dict[str, Any]]) -> str:
+    """Numbered lines of the flights the user selects from (with their routes, if they're the results of a multi-route search)."""
+    lines = []
+    for number, flight in enumerate(flights, start=1):
+        route = f"\033[1mGuzergah:\033[0m {flight['from_city']} - {flight['to_city']} | " if "from_city" in flight else ""
+        lines.append(f"\n{number}- {route}\033[1mHavayolu:\033[0m {flight['airline']} | \033[1mKalkis:\033[0m {flight['departure_time']} | \033[1mVaris:\033[0m {flight['arrival_time']} | \033[1mSure:\033[0m {flight['duration']} | \033[1mKabin:\033[0m {flight['class']} | \033[1mFiyat:\033[0m {flight['price']} TL | \033[1mKod:\033[0m {flight['flight_code']}")
+    return "".join(lines)
+
+def flight_choices_text(flights: List[dict[str, Any]]) -> str:
+    """Valid choices of a selection, e.g. "1, 2 veya 3"."""
+    numbers = [str(number) for number in range(1, len(flights) + 1)]
+    return numbers[0] if len(numbers) == 1 else f"{', '.join(numbers[:-1])} veya {numbers[-1]}"
+# -----------------------------------------------------------------------------------
+
+
+# -----------------------------------------------------------------------------------
+# Interactive steps to prompt the user to review and approve/reject the tool calls, and manage their routing (see common/human_io.py for how the steps are driven)
+def human_tool_review_steps(state: FlightState, config: RunnableConfig):
 
     # Get the next action to be taken from the state
     next_action = state["next_action"]
@@ -259,15 +448,19 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
         # Get the arguments of the tool call
         args = latest_tool_call["args"]
 
-        prompt_text = (f"\nBu bilgilerle ucus aramasi yapmami onayliyor musunuz?" + 
-        f"\n- \033[1mNereden:\033[0m {args['from_city']}" +
-        f"\n- \033[1mNereye:\033[0m {args['to_city']}" +
+        prompt_text = (f"\nBu bilgilerle ucus aramasi yapmami onayliyor musunuz?" +
+        f"\n- \033[1mNereden:\033[0m {search_cities_text(args, 'from')}" +
+        f"\n- \033[1mNereye:\033[0m {search_cities_text(args, 'to')}" +
         f"\n- \033[1mUcus tipi:\033[0m {'Gidis-Donus' if args['flight_type']=='two-way' else 'Tek yon'}" +
         f"\n- \033[1mGidis tarihi:\033[0m {args['depart_date']}" +
         f"\n- \033[1mDonus tarihi:\033[0m {args['return_date'] if args['flight_type']=='two-way' else '---'}" +
         f"\n\nOnaylamak icin 1, reddetmek icin 0 tuslayin: ")
-        print(prompt_text)
-        user_choice = input()
+
+        # Start the search while the user reviews the parameters (see flight_assistant/prefetch.py)
+        if SEARCH_PREFETCH_ENABLED:
+            prefetcher.start(latest_tool_call["id"], "search", speculative_search, {**latest_tool_call, "args": dict(args)})
+
+        user_choice = yield prompt_text
 
         # If the user approved the tool call
         if user_choice == "1":
@@ -276,8 +469,9 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             return Command(update={"latest_tool_call": latest_tool_call}, goto="flight_search_node")
         # If the user rejected the tool call
         elif user_choice == "0":
-            # Update the status of the tool call to "rejected"
+            # Update the status of the tool call to "rejected", and drop the results of its search if it was started
             latest_tool_call["status"] = "rejected"
+            prefetcher.discard(latest_tool_call["id"])
             # Construct a tool response to notify the flight agent that the tool call was rejected
             tool_response = ToolMessage(
                 tool_call_id=latest_tool_call["id"],
@@ -289,9 +483,9 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
         # If the user entered an invalid choice
         else:
             # Route back to this node to prompt the user again
-            print("\nGecersiz secim, lutfen 1 veya 0 tuslayin.")
+            notify_user(config, "\nGecersiz secim, lutfen 1 veya 0 tuslayin.")
             return Command(goto="human_tool_reviewer")
-        
+
     # If the next action is to select tickets
     elif next_action == "ticket_purchase":
         # If a depart flight is not selected yet
@@ -299,20 +493,13 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             # Get the retrieved flight details from the state
             retrieved_depart_flights = state["retrieved_depart_flights"]
 
-            # Get options for departure
-            depart1, depart2, depart3 = retrieved_depart_flights
-            
-            # Lutfen seciminizi tuslayin (1, 2 veya 3): """
-            prompt_text = (f"\nLutfen asagidaki gidis ucuslarindan birini secin:" +
-            f"\n1- \033[1mHavayolu:\033[0m {depart1['airline']} | \033[1mKalkis:\033[0m {depart1['departure_time']} | \033[1mVaris:\033[0m {depart1['arrival_time']} | \033[1mSure:\033[0m {depart1['duration']} | \033[1mKabin:\033[0m {depart1['class']} | \033[1mFiyat:\033[0m {depart1['price']} TL | \033[1mKod:\033[0m {depart1['flight_code']}" +
-            f"\n2- \033[1mHavayolu:\033[0m {depart2['airline']} | \033[1mKalkis:\033[0m {depart2['departure_time']} | \033[1mVaris:\033[0m {depart2['arrival_time']} | \033[1mSure:\033[0m {depart2['duration']} | \033[1mKabin:\033[0m {depart2['class']} | \033[1mFiyat:\033[0m {depart2['price']} TL | \033[1mKod:\033[0m {depart2['flight_code']}" +
-            f"\n3- \033[1mHavayolu:\033[0m {depart3['airline']} | \033[1mKalkis:\033[0m {depart3['departure_time']} | \033[1mVaris:\033[0m {depart3['arrival_time']} | \033[1mSure:\033[0m {depart3['duration']} | \033[1mKabin:\033[0m {depart3['class']} | \033[1mFiyat:\033[0m {depart3['price']} TL | \033[1mKod:\033[0m {depart3['flight_code']}" +
-            f"\n\nLutfen seciminizi tuslayin (1, 2 veya 3): ")
-            print(prompt_text)
-            user_choice = input()
+            # Prompt the user to select one of the options
+            prompt_text = (f"\nLutfen asagidaki gidis ucuslarindan birini secin:" + flight_options_text(retrieved_depart_flights) +
+            f"\n\nLutfen seciminizi tuslayin ({flight_choices_text(retrieved_depart_flights)}): ")
+            user_choice = yield prompt_text
 
             # If the user made a valid departure selection
-            if user_choice in ["1", "2", "3"]:
+            if user_choice in [str(number) for number in range(1, len(retrieved_depart_flights) + 1)]:
                 # Get the selected depart flight details
                 selected_depart_flight = retrieved_depart_flights[int(user_choice)-1]
                 # Update the state with the selected depart flight and route back to this node to prompt the user for return flight selection (if two-way trip)
@@ -320,28 +507,21 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             # If the user entered an invalid choice
             else:
                 # Route back to this node to prompt the user again
-                print("\nGecersiz secim. Lutfen 1, 2 veya 3 tuslayin.")
+                notify_user(config, f"\nGecersiz secim. Lutfen {flight_choices_text(retrieved_depart_flights)} tuslayin.")
                 return Command(goto="human_tool_reviewer")
-            
+
         # If it's a two-way tip and a depart flight is already selected, but a return flight is not selected yet
         elif len(state["retrieved_return_flights"]) > 0 and state["selected_return_flight"] is None:
             # Get the retrieved flight details from the state
             retrieved_return_flights = state["retrieved_return_flights"]
 
-            # Get options for return
-            return1, return2, return3 = retrieved_return_flights
-            
-            # Lutfen seciminizi tuslayin (1, 2 veya 3): """
-            prompt_text = (f"\nLutfen asagidaki donus ucuslarindan birini secin:" +
-            f"\n1- \033[1mHavayolu:\033[0m {return1['airline']} | \033[1mKalkis:\033[0m {return1['departure_time']} | \033[1mVaris:\033[0m {return1['arrival_time']} | \033[1mSure:\033[0m {return1['duration']} | \033[1mKabin:\033[0m {return1['class']} | \033[1mFiyat:\033[0m {return1['price']} TL | \033[1mKod:\033[0m {return1['flight_code']}" +
-            f"\n2- \033[1mHavayolu:\033[0m {return2['airline']} | \033[1mKalkis:\033[0m {return2['departure_time']} | \033[1mVaris:\033[0m {return2['arrival_time']} | \033[1mSure:\033[0m {return2['duration']} | \033[1mKabin:\033[0m {return2['class']} | \033[1mFiyat:\033[0m {return2['price']} TL | \033[1mKod:\033[0m {return2['flight_code']}" +
-            f"\n3- \033[1mHavayolu:\033[0m {return3['airline']} | \033[1mKalkis:\033[0m {return3['departure_time']} | \033[1mVaris:\033[0m {return3['arrival_time']} | \033[1mSure:\033[0m {return3['duration']} | \033[1mKabin:\033[0m {return3['class']} | \033[1mFiyat:\033[0m {return3['price']} TL | \033[1mKod:\033[0m {return3['flight_code']}" +
-            f"\n\nLutfen seciminizi tuslayin (1, 2 veya 3): ")
-            print(prompt_text)
-            user_choice = input()
+            # Prompt the user to select one of the options
+            prompt_text = (f"\nLutfen asagidaki donus ucuslarindan birini secin:" + flight_options_text(retrieved_return_flights) +
+            f"\n\nLutfen seciminizi tuslayin ({flight_choices_text(retrieved_return_flights)}): ")
+            user_choice = yield prompt_text
 
             # If the user made a valid return selection
-            if user_choice in ["1", "2", "3"]:
+            if user_choice in [str(number) for number in range(1, len(retrieved_return_flights) + 1)]:
                 # Get the selected depart flight details
                 selected_return_flight = retrieved_return_flights[int(user_choice)-1]
                 # Update the state with the selected return flight and route back to this node to prompt the user for final review before ticket purchase
@@ -349,9 +529,9 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             # If the user entered an invalid choice
             else:
                 # Route back to this node to prompt the user again
-                print("\nGecersiz secim. Lutfen 1, 2 veya 3 tuslayin.")
+                notify_user(config, f"\nGecersiz secim. Lutfen {flight_choices_text(retrieved_return_flights)} tuslayin.")
                 return Command(goto="human_tool_reviewer")
-        
+
         # If the user is done with selecting flights
         else:
             # Get the selected depart and return flight details from the state
@@ -365,8 +545,7 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             if selected_return_flight is not None:
                 prompt_text += f"\n- \033[1mUcus:\033[0m Donus | \033[1mKod:\033[0m {selected_return_flight['flight_code']}"
             prompt_text += "\n\nBu secimleri onayliyor musunuz?\nOnaylamak icin 1, ucus secimlerinizi degistirmek icin 0,  arama kriterlerinizi degistirmek ve baska ucuslar aramak icin 2 tuslayin: "
-            print(prompt_text)
-            user_choice = input()
+            user_choice = yield prompt_text
 
             # If the user approved the selected flights
             if user_choice == "1":
@@ -381,31 +560,31 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
                 # Generate a synthetic user message to convey the user's intention to search for new flights
                 synth_user_message = HumanMessage(content="Arama kriterlerimi degistirmek ve baska ucuslar aramak istiyorum.")
 
-                # Add this to the state messages to trigger the flight agent for a response
+                # Add this to the state messages to trigger the flight agent for a response (with the earlier search results compacted, see flight_assistant/compaction.py)
                 # Reset all retrieved and selected flights, set the next action to flight search,
                 # and route back to the flight agent node
-                return Command(update={"messages": [synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
+                return Command(update={"messages": [*compact_search_results(state["messages"]), synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
             # If the user entered an invalid choice
             else:
                 # Route back to this node to prompt the user again
-                print("\nGecersiz secim. Lutfen 1, 0 veya 2 tuslayin.")
+                notify_user(config, "\nGecersiz secim. Lutfen 1, 0 veya 2 tuslayin.")
                 return Command(goto="human_tool_reviewer")
-            
+
     # If the next action is to escalate to manager
     else:
         # Prompt the user to enter an additional message to the manager
         prompt_text = "\nIstisna onay surecinizle ilgili yoneticinize iletmek istediginiz ek bir mesaj varsa yaziniz (yoksa bos birakabilirsiniz): \n"
-        escalation_message = None if (user_input := input(prompt_text)).strip() == "" else user_input.strip()
+        user_input = yield prompt_text
+        escalation_message = None if user_input.strip() == "" else user_input.strip()
 
         counter = 1
         while True:
             if counter > 1:
-                print("\nGecersiz secim. Lutfen 1, 0, 2 veya 3 tuslayin.")
+                notify_user(config, "\nGecersiz secim. Lutfen 1, 0, 2 veya 3 tuslayin.")
 
             # Prompt the user to approve/reject the escalation
             prompt_text = f"\nTalebinizi yoneticinize gondermek icin 1, ucus secimlerinizi degistirmek icin 0,  arama kriterlerinizi degistirmek ve baska ucuslar aramak icin 2 tuslayin. {'Yoneticinize iletilecek mesajinizi degistirmek' if escalation_message else 'Yoneticinize gondermek uzere ek bir mesaj eklemek'} icin 3 tuslayin: "
-            print(prompt_text)
-            user_choice = input()
+            user_choice = yield prompt_text
 
             # If the user approved the escalation
             if user_choice == "1":
@@ -420,10 +599,10 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
                 # Generate a synthetic user message to convey the user's intention to search for new flights
                 synth_user_message = HumanMessage(content="Arama kriterlerimi degistirmek ve baska ucuslar aramak istiyorum.")
 
-                # Add this to the state messages to trigger the flight agent for a response
+                # Add this to the state messages to trigger the flight agent for a response (with the earlier search results compacted, see flight_assistant/compaction.py)
                 # Reset all retrieved and selected flights, set the next action to flight search,
                 # and route back to the flight agent node
-                return Command(update={"messages": [synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
+                return Command(update={"messages": [*compact_search_results(state["messages"]), synth_user_message], "retrieved_depart_flights": None, "retrieved_return_flights": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto="flight_agent")
             # If the user wants to change the escalation message
             elif user_choice == "3":
                 # Route back to the beginning of this node to prompt the user for a new escalation message
@@ -432,30 +611,45 @@ def human_tool_reviewer(state: FlightState) -> Command[Literal["flight_agent", "
             else:
                 counter += 1
                 continue
+
+# Node to prompt the user to review and approve/reject the tool calls, and manage their routing
+def human_tool_reviewer(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "flight_search_node", "policy_control_node","ticket_purchase_node", "manager_escalation_node", "human_tool_reviewer"]]:
+    return run_interaction(human_tool_review_steps(state, config), config)
+
+async def ahuman_tool_reviewer(state: FlightState, config: RunnableConfig) -> Command[Literal["flight_agent", "flight_search_node", "policy_control_node","ticket_purchase_node", "manager_escalation_node", "human_tool_reviewer"]]:
+    return await arun_interaction(human_tool_review_steps(state, config), config)
 # -----------------------------------------------------------------------------------
 
 
 # -----------------------------------------------------------------------------------
-# Main node of the flight agent pipeline that handles user interactions and tool calls
-def flight_agent(state: FlightState) -> Command[Literal["flight_agent", "human_tool_reviewer", END]]:
-    
+# Routing logic of the flight agent node (returns None when the llm should be invoked with the current state messages)
+def route_flight_agent(state: FlightState) -> Optional[Command[Literal["flight_agent", "human_tool_reviewer", "ticket_purchase_node", END]]]:
+
     # If the flight pipeline is completed, halt the pipeline (END --> until next user interaction)
     if state["flight_completed"]:
         return Command(goto=END)
 
+    # If the session was resumed with the manager's decision on the escalated flights (see approval_service.py)
+    if state["approval_status"] == "approved":
+        # Purchase the approved flights (if the user isn't there to select the seats, e.g. in a session resumed by the approval service, they're assigned by the purchase tool)
+        return Command(update={"approval_status": None}, goto="ticket_purchase_node")
+    elif state["approval_status"] == "rejected":
+        # Discard the selections and tell the user, who can search for other flights in the next turn
+        rejection_message = "Uzgunum, yoneticiniz sectiginiz ucuslar icin istisna talebinizi onaylamadi. Sirket politikasina uygun baska ucuslar aramak isterseniz yardimci olabilirim."
+        return Command(update={"messages": [AIMessage(content=rejection_message)], "approval_status": None, "selected_depart_flight": None, "selected_return_flight": None, "next_action": "flight_search"}, goto=END)
+
     # Retrieve the last message from the state
     last_message = state["messages"][-1]
 
     # If the last message is a system message
     if last_message.type == "system":
         return Command(goto=END)
-    
+
     # If the last message is a user, or tool message
     elif last_message.type in ["human", "tool"]:
-        # Then invoke the llm with the current state messages and return the updated state
-        response = flight_llm.invoke(state["messages"])
-        return Command(update={"messages": [response]}, goto="flight_agent")
-    
+        # Then the llm should be invoked with the current state messages
+        return None
+
     # If the last message is an ai message
     else:
         # Get the valid and invalid tool calls attributes of the last message
@@ -469,14 +663,14 @@ def flight_agent(state: FlightState) -> Command[Literal["flight_agent", "human_t
             # Get the tool call dictionary and associated tool name
             tool_call = tool_calls[0]
             tool_name = tool_call["name"]
-            # Flight agent is bound only to the flight search tool, so this should be the only possible tool call
-            assert tool_name == "search_flights"
+            # Flight agent is bound only to the flight search tools, so these should be the only possible tool calls
+            assert tool_name in search_tools
 
             # Route to the human tool reviewer node which requests human approval before calling the tool (human in the loop)
             # Also, add an additional status key to the tool call dictionary to track its status
             tool_call["status"] = "pending"
             return Command(update={"latest_tool_call": tool_call, "next_action": "flight_search"}, goto="human_tool_reviewer")
-    
+
         # If the last message is an invalid tool call (message type that llm can
         # handle by making further reasoning by itself)
         elif invalid_tool_calls:
@@ -484,49 +678,97 @@ def flight_agent(state: FlightState) -> Command[Literal["flight_agent", "human_t
             print("\n[Tool Error] Invalid tool call received:")
             pretty_print_object(invalid_tool_calls)
 
-            # Then invoke the llm with the current state messages and return the updated state
-            response = flight_llm.invoke(state["messages"])
-            return Command(update={"messages": [response]}, goto="flight_agent")
-    
+            # Count the invalid tool calls the llm made in a row, and stop invoking it once the retry budget is used up
+            invalid_in_a_row = 0
+            for message in reversed(state["messages"]):
+                if message.type != "ai" or not message.invalid_tool_calls:
+                    break
+                invalid_in_a_row += 1
+            if node_retry_policy.exhausted(invalid_in_a_row):
+                node_retries.inc(node="flight_agent", outcome="exhausted")
+                return Command(update={"messages": [AIMessage(content="Uzgunum, isteginizi su anda isleyemiyorum. Lutfen talebinizi tekrar yazar misiniz?")]}, goto=END)
+
+            # Then the llm should be invoked again with the current state messages
+            node_retries.inc(node="flight_agent", outcome="retried")
+            return None
+
         else:
             # Then the last message is assistant/ai type (which already is a response from the llm)
             # So there is no need for invocation, return the current state with no changes and halt the pipeline (END --> until next user interaction)
             return Command(goto=END)
+
+# Main node of the flight agent pipeline that handles user interactions and tool calls
+def flight_agent(state: FlightState) -> Command[Literal["flight_agent", "human_tool_reviewer", "ticket_purchase_node", END]]:
+    command = route_flight_agent(state)
+    if command is not None:
+        return command
+
+    # Invoke the llm with the current state messages (trimmed to the context budget, with today's date after the static prompt) and return the updated state
+    response = get_flight_llm().invoke(with_dynamic_context(get_flight_context().trim(state["messages"]), date_context()))
+    return Command(update={"messages": [response]}, goto="flight_agent")
+
+async def aflight_agent(state: FlightState) -> Command[Literal["flight_agent", "human_tool_reviewer", "ticket_purchase_node", END]]:
+    command = route_flight_agent(state)
+    if command is not None:
+        return command
+
+    # Invoke the llm with the current state messages (trimmed to the context budget, with today's date after the static prompt) and return the updated state
+    response = await get_flight_llm().ainvoke(with_dynamic_context(await get_flight_context().atrim(state["messages"]), date_context()))
+    return Command(update={"messages": [response]}, goto="flight_agent")
 # -----------------------------------------------------------------------------------
 
 
 
- # Build the graph
+ # Build the graph (every node has a sync and an async implementation, so the graph can be run with both invoke/stream and ainvoke/astream)
 builder = StateGraph(FlightState)
-builder.add_node("flight_agent", flight_agent)
-builder.add_node("flight_search_node", flight_search_node)
-builder.add_node("ticket_purchase_node", ticket_purchase_node)
-builder.add_node("manager_escalation_node", manager_escalation_node)
-builder.add_node("policy_control_node", policy_control_node)
-builder.add_node("human_tool_reviewer", human_tool_reviewer)
+add_dual_node(builder, flight_agent, aflight_agent)
+add_dual_node(builder, flight_search_node, aflight_search_node)
+add_dual_node(builder, ticket_purchase_node, aticket_purchase_node)
+add_dual_node(builder, manager_escalation_node, amanager_escalation_node)
+add_dual_node(builder, policy_control_node, apolicy_control_node)
+add_dual_node(builder, human_tool_reviewer, ahuman_tool_reviewer)
 builder.add_edge(START, "flight_agent")
 
-# Create memory and compile the graph with the memory
-checkpointer = MemorySaver()
-flight_graph = builder.compile(checkpointer=checkpointer)
+
+def compile_flight_graph():
+    """Creates the checkpointer (SQLite or in-memory, see common/checkpoints.py) and compiles the graph with it."""
+    checkpointer = tracer.trace_checkpointer(create_checkpointer("flight"))
+    checkpoint_store_bytes.set_function(lambda: checkpoint_store_size(checkpointer), graph="flight")
+    return builder.compile(checkpointer=checkpointer)
+
+
+# The graph is compiled on first use, so that importing the module doesn't open the checkpoint database
+_flight_graph = None
+_flight_graph_lock = threading.Lock()
+
+def get_flight_graph():
+    global _flight_graph
+    with _flight_graph_lock:
+        if _flight_graph is None:
+            _flight_graph = compile_flight_graph()
+    return _flight_graph
 
 
 if __name__ == "__main__":
 
-    try:
+    parser = argparse.ArgumentParser(description="Runs a flight booking conversation in the terminal.")
+    parser.add_argument("--draw-graph", action="store_true", help="Render the graph image (flight_graph.png) if the graph has changed, and exit")
+    args = parser.parse_args()
+
+    flight_graph = get_flight_graph()
+    if args.draw_graph:
         # Generate the graph image and save it to the current file's directory
-        image_path = os.path.join(os.path.dirname(__file__), "flight_graph.png")
-        flight_graph.get_graph().draw_mermaid_png(output_file_path=image_path)
-    except Exception:
-        pass
+        draw_graph_image(flight_graph, os.path.join(os.path.dirname(__file__), "flight_graph.png"))
+        sys.exit()
 
 
     # Create a config object with a unique thread_id for memory tracking, and other runtime information (user/session etc.)
+    # (the checkpoints are kept on disk by default, so every run starts a new conversation)
     manager_info = {"name": "Ali", "id":12345678910, "email": "ali@langgraph.com"}
     user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager": manager_info}
     config = {
         "configurable": {
-            "thread_id": 1,
+            "thread_id": uuid.uuid4().hex,
             "user": user_info,
         }
     }
@@ -544,6 +786,9 @@ if __name__ == "__main__":
         "purchased_depart_ticket": None,
         "purchased_return_ticket": None,
         "flight_completed": False,
+        "failed_attempts": 0,
+        "escalation_id": None,
+        "approval_status": None,
     }
     
     # Invoke graph once to initialize the state
@@ -0,0 +1,164 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+
+from common.latency import LatencyDistribution
+from common.tracing import tracer
+from flight_assistant.booking_ledger import get_booking_ledger
+
+
+# -----------------------------------------------------------------------------------
+# Gateways to the external systems used by the tools: the airline's booking system (seat reservation) and the company's
+# systems (employee directory, mail). The tools only talk to these interfaces, so that the local stubs below can be
+# replaced with real clients. The interfaces are abstract, so a client that misses an operation fails when it's created
+# instead of in the middle of a purchase.
+#
+# The stubs simulate the calls with non-blocking waits whose durations are drawn from latency distributions
+# (see common/latency.py), configured per operation:
+#   GATEWAY_LATENCY_GET_USER, GATEWAY_LATENCY_GET_MANAGER, GATEWAY_LATENCY_SELECT_SEAT,
+#   GATEWAY_LATENCY_COMPLETE_RESERVATION, GATEWAY_LATENCY_SEND_MAIL   e.g. "constant:4", "lognormal:3,0.4", "none"
+#   GATEWAY_LATENCY_SEED   seed of the latency samples
+# and all of them are multiplied by SIMULATED_DELAY_SCALE (e.g. 0 to run tests and benchmarks without them).
+
+SIMULATED_DELAY_SCALE = float(os.getenv("SIMULATED_DELAY_SCALE", 1))
+
+# Default latencies of the operations in seconds (the delays the tools used to simulate)
+DEFAULT_LATENCIES = {
+    "get_user": "constant:2",
+    "get_manager": "constant:2",
+    "select_seat": "constant:4",
+    "complete_reservation": "constant:4",
+    "send_mail": "constant:4",
+}
+
+
+def generate_pnr_number():
+    """Returns a new 6 character booking reference (PNR) that never collides with an earlier one (see flight_assistant/booking_ledger.py)."""
+    return get_booking_ledger().next_pnr()
+
+def run_sync(coroutine):
+    """Runs a gateway call from sync code (the sync graph runs its nodes in threads without an event loop)."""
+    return asyncio.run(coroutine)
+
+
+class AirlineGateway(ABC):
+    """Interface of the airline's booking system."""
+
+    @abstractmethod
+    async def reserve_seat(self, flight, passenger, seat_number):
+        """Reserves the seat on the flight for the passenger and returns {"seat_number", "pnr_number"}."""
+
+
+class CorporateGateway(ABC):
+    """Interface of the company's systems (employee directory and mail)."""
+
+    @abstractmethod
+    async def get_user(self, user_info):
+        """Returns the directory record of the user."""
+
+    @abstractmethod
+    async def get_manager(self, user_info):
+        """Returns the directory record of the user's manager."""
+
+    @abstractmethod
+    async def send_mail(self, sender, recipient, subject, body):
+        """Sends a mail and returns True once it's accepted."""
+
+
+class SimulatedLatency:
+    """Latency distributions of the simulated operations of a stub."""
+
+    def __init__(self, operations, latencies=None, scale=SIMULATED_DELAY_SCALE, seed=None):
+        latencies = latencies or {}
+        seed = seed if seed is not None else os.getenv("GATEWAY_LATENCY_SEED")
+        self.scale = scale
+        self.distributions = {
+            operation: LatencyDistribution(
+                latencies.get(operation, os.getenv(f"GATEWAY_LATENCY_{operation.upper()}", DEFAULT_LATENCIES[operation])),
+                int(seed) + index if seed is not None else None)
+            for index, operation in enumerate(operations)
+        }
+        self._lock = threading.Lock()
+
+    async def wait(self, operation):
+        with self._lock:
+            delay = self.distributions[operation].sample() * self.scale
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class LocalAirlineGateway(AirlineGateway):
+    """Stub of the airline's booking system that answers locally after a simulated latency."""
+
+    def __init__(self, latencies=None, scale=SIMULATED_DELAY_SCALE, seed=None):
+        self.latency = SimulatedLatency(["select_seat", "complete_reservation"], latencies, scale, seed)
+
+    async def reserve_seat(self, flight, passenger, seat_number):
+        with tracer.span("airline.select_seat", "external", flight_code=flight["flight_code"]):
+            await self.latency.wait("select_seat")
+        with tracer.span("airline.complete_reservation", "external", flight_code=flight["flight_code"]):
+            await self.latency.wait("complete_reservation")
+        return {"seat_number": seat_number, "pnr_number": generate_pnr_number()}
+
+
+class LocalCorporateGateway(CorporateGateway):
+    """Stub of the company's systems: the directory records come from the user info of the session."""
+
+    def __init__(self, latencies=None, scale=SIMULATED_DELAY_SCALE, seed=None):
+        self.latency = SimulatedLatency(["get_user", "get_manager", "send_mail"], latencies, scale, seed)
+
+    async def get_user(self, user_info):
+        with tracer.span("directory.get_user", "external"):
+            await self.latency.wait("get_user")
+        return user_info
+
+    async def get_manager(self, user_info):
+        with tracer.span("directory.get_manager", "external"):
+            await self.latency.wait("get_manager")
+        return user_info["manager"]
+
+    async def send_mail(self, sender, recipient, subject, body):
+        with tracer.span("mail.send", "external"):
+            await self.latency.wait("send_mail")
+        return True
+# -----------------------------------------------------------------------------------
+
+
+# Gateways shared by the tools (created on first use)
+_airline_gateway = None
+_corporate_gateway = None
+
+def get_airline_gateway():
+    global _airline_gateway
+    if _airline_gateway is None:
+        _airline_gateway = LocalAirlineGateway()
+    return _airline_gateway
+
+def get_corporate_gateway():
+    global _corporate_gateway
+    if _corporate_gateway is None:
+        _corporate_gateway = LocalCorporateGateway()
+    return _corporate_gateway
+
+
+
+
+if __name__ == "__main__":
+
+    # Reserve both legs of a trip concurrently with a load-test like latency
+    import time
+
+    gateway = LocalAirlineGateway(latencies={"select_seat": "lognormal:0.3,0.4", "complete_reservation": "lognormal:0.3,0.4"}, scale=1, seed=1)
+    passenger = {"name": "Kaan", "id": 10987654321, "email": "kaan@langgraph.com"}
+    depart_flight = {"airline": "THY", "flight_code": "TK802"}
+    return_flight = {"airline": "THY", "flight_code": "TK801"}
+
+    async def main():
+        start_time = time.perf_counter()
+        reservations = await asyncio.gather(gateway.reserve_seat(depart_flight, passenger, 25), gateway.reserve_seat(return_flight, passenger, 30))
+        print(reservations, f"{time.perf_counter() - start_time:.2f} s")
+
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from common.metrics import prefetches
+
+
+# -----------------------------------------------------------------------------------
+# Speculative work during the user's think time.
+#
+# The flight search only runs once the user approves the search parameters, and the policy check only once they select
+# their flights, while both only depend on what the user is shown at that point. So the work is started in a background
+# pool as soon as the user is prompted, keyed by the id of the search tool call, and taken by the node that would
+# otherwise do it: on approval, the search results are usually there already (or the node waits for the search that's
+# running), and if the user rejects the parameters, the prefetched results are discarded.
+#   SEARCH_PREFETCH_ENABLED   start the flight search while the user reviews its parameters
+#   POLICY_PREFETCH_ENABLED   check all retrieved flights against the policy while the user selects (one policy llm call
+#                             per retrieved flight instead of per selected flight, so it's off by default)
+#   PREFETCH_WORKERS          threads of the background pool
+#   PREFETCH_TTL              seconds a result is kept for (e.g. a session whose user never answers)
+#   PREFETCH_MAX_ENTRIES      results kept at most (the oldest are dropped first)
+
+SEARCH_PREFETCH_ENABLED = os.getenv("SEARCH_PREFETCH_ENABLED", "1") == "1"
+POLICY_PREFETCH_ENABLED = os.getenv("POLICY_PREFETCH_ENABLED", "0") == "1"
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", 300))
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", 1024))
+
+
+def flight_key(flight):
+    """Identity of a flight offered to the user (for the policy verdicts)."""
+    return (flight["flight_code"], flight.get("date"), flight["class"], flight["price"])
+
+
+class Prefetcher:
+    """Runs speculative work in a background pool, and hands over its results by (tool call id, kind, item).
+
+    The work runs in a copy of the caller's context, so its spans and callback runs belong to the node that started it.
+    A result of None, or an exception, means that the work is done again by the node that takes it.
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS, ttl=PREFETCH_TTL, max_entries=PREFETCH_MAX_ENTRIES):
+        self.workers = workers
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Created on first use
+        self._executor = None
+        # (tool call id, kind, item) --> (future, start time), in the order they were started
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        """Drops the expired results, and the oldest ones beyond the limit (called with the lock held)."""
+        for key, (future, start_time) in list(self._entries.items()):
+            if now - start_time > self.ttl or len(self._entries) > self.max_entries:
+                del self._entries[key]
+                future.cancel()
+                prefetches.inc(kind=key[1], outcome="expired")
+
+    def start(self, tool_call_id, kind, func, *args, item=None):
+        """Starts func(*args) in the background, unless it was already started for the key."""
+        key = (tool_call_id, kind, item)
+        context = contextvars.copy_context()
+        with self._lock:
+            if key in self._entries:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prefetch")
+            now = time.monotonic()
+            self._entries[key] = (self._executor.submit(context.run, func, *args), now)
+            self._evict(now)
+        prefetches.inc(kind=kind, outcome="started")
+
+    def _pop(self, tool_call_id, kind, item):
+        with self._lock:
+            entry = self._entries.pop((tool_call_id, kind, item), None)
+        if entry is None:
+            return None
+        future, start_time = entry
+        if time.monotonic() - start_time > self.ttl:
+            future.cancel()
+            prefetches.inc(kind=kind, outcome="expired")
+            return None
+        return future
+
+    def _result(self, kind, future):
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+        prefetches.inc(kind=kind, outcome="used" if result is not None else "failed")
+        return result
+
+    def take(self, tool_call_id, kind, item=None):
+        """Returns the result of the work started for the key (waiting for it if it's still running), or None."""
+        future = self._pop(tool_call_id, kind, item)
+        if future is None:
+            return None
+        return self._result(kind, future)
+
+    async def atake(self, tool_call_id, kind, item=None):
+        """Async counterpart of take (waits without blocking the event loop)."""
+        future = self._pop(tool_call_id, kind, item)
+        if future is None:
+            return None
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            pass
+        return self._result(kind, future)
+
+    def discard(self, tool_call_id):
+        """Drops all the results started for the tool call (e.g. the user rejected it)."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == tool_call_id]
+            entries = [self._entries.pop(key) for key in keys]
+        for key, (future, _) in zip(keys, entries):
+            future.cancel()
+            prefetches.inc(kind=key[1], outcome="discarded")
+
+
+# Prefetcher shared by the flight graph's nodes
+prefetcher = Prefetcher()
+# -----------------------------------------------------------------------------------
+
+
+
+
+if __name__ == "__main__":
+
+    # Time to the search results after the user approves, with 0.3 s of think time, with and without the prefetch
+    from flight_assistant.tools.flight_search import FlightSearchTool
+
+    tool = FlightSearchTool()
+    tool_call = {"name": "search_flights", "args": {"from_city": "Istanbul", "to_city": "Izmir", "flight_type": "two-way", "depart_date": "2025-07-14", "return_date": "2025-07-18"}, "id": "call_demo", "type": "tool_call"}
+
+    # Warm up the database connection and the tool with another search
+    tool.invoke({**tool_call, "args": {**tool_call["args"], "depart_date": "2025-07-10"}})
+
+    start_time = time.perf_counter()
+    response = tool.invoke(tool_call)
+    print(f"Without prefetch: results {1000 * (time.perf_counter() - start_time):.2f} ms after the approval ({response.status})")
+
+    tool_call = {**tool_call, "args": {**tool_call["args"], "depart_date": "2025-07-15"}}
+    prefetcher.start(tool_call["id"], "search", tool.invoke, tool_call)
+    time.sleep(0.3)
+    start_time = time.perf_counter()
+    response = prefetcher.take(tool_call["id"], "search")
+    print(f"With prefetch:    results {1000 * (time.perf_counter() - start_time):.2f} ms after the approval ({response.status})")
@@ -0,0 +1,264 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import time
+import sqlite3
+import threading
+
+from typing import List
+from typing_extensions import TypedDict
+
+from common.tracing import tracer
+from common.metrics import seat_holds
+
+
+# -----------------------------------------------------------------------------------
+# Seat inventory of the flights, keyed by flight code + date and stored in SQLite:
+#   - seat_inventory: one row per flight with a bitmap of the reserved seats (1 bit per seat) and a version number.
+#     A reservation reads the bitmap, sets the seat's bit and writes it back only if the version is unchanged
+#     (compare-and-set), so concurrent bookings never overwrite each other and no lock is held while the user decides.
+#   - seat_holds: seats held for a user while they complete the purchase, expiring after SEAT_HOLD_TTL seconds.
+#     A held seat can't be held or reserved by anyone else until the hold is released or it expires.
+#
+# Each thread uses its own connection, and the database runs in WAL mode so that the seat map reads don't wait for
+# the writes of other bookings.
+#   SEAT_INVENTORY_PATH   path of the database (created on first use)
+#   SEAT_HOLD_TTL         lifetime of a seat hold in seconds
+
+SEAT_INVENTORY_PATH = os.getenv("SEAT_INVENTORY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db", "seat_inventory.db"))
+SEAT_HOLD_TTL = float(os.getenv("SEAT_HOLD_TTL", 600))
+
+# Seat numbers that can be selected on the flights
+FIRST_SEAT = 20
+LAST_SEAT = 100
+BITMAP_SIZE = (LAST_SEAT - FIRST_SEAT) // 8 + 1
+
+
+class SeatMap(TypedDict):
+    flight_code: str
+    date: str
+    free: List[int]
+    held: List[int]
+    reserved: List[int]
+
+
+class SeatUnavailableError(Exception):
+    """Raised when a selected seat was taken by another booking before it could be reserved."""
+
+
+def seat_bit(seat_number):
+    """Returns (byte index, bit mask) of the seat in the bitmap."""
+    index = seat_number - FIRST_SEAT
+    return index // 8, 1 << (index % 8)
+
+def is_reserved(bitmap, seat_number):
+    byte_index, mask = seat_bit(seat_number)
+    return bool(bitmap[byte_index] & mask)
+
+def format_seat_ranges(seat_numbers):
+    """Formats the seat numbers as ranges, e.g. [20, 21, 22, 25] -> "20-22, 25"."""
+    ranges = []
+    for seat_number in sorted(seat_numbers):
+        if ranges and ranges[-1][1] == seat_number - 1:
+            ranges[-1][1] = seat_number
+        else:
+            ranges.append([seat_number, seat_number])
+    return ", ".join(f"{first}-{last}" if first != last else f"{first}" for first, last in ranges)
+
+
+class SeatInventory:
+    """Seat reservations and holds of the flights (see the notes above)."""
+
+    def __init__(self, database_path=SEAT_INVENTORY_PATH, hold_ttl=SEAT_HOLD_TTL):
+        self.database_path = database_path
+        self.hold_ttl = hold_ttl
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode: every statement is its own atomic transaction
+            connection = sqlite3.connect(self.database_path, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        directory = os.path.dirname(self.database_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS seat_inventory (
+                flight_code TEXT NOT NULL,
+                date TEXT NOT NULL,
+                reserved BLOB NOT NULL,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (flight_code, date)
+            ) WITHOUT ROWID
+        """)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS seat_holds (
+                flight_code TEXT NOT NULL,
+                date TEXT NOT NULL,
+                seat_number INTEGER NOT NULL,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (flight_code, date, seat_number)
+            ) WITHOUT ROWID
+        """)
+
+    def _check_seat_number(self, seat_number):
+        if not FIRST_SEAT <= seat_number <= LAST_SEAT:
+            raise ValueError(f"Seat number must be between {FIRST_SEAT} and {LAST_SEAT}, got {seat_number}")
+
+    def _read_bitmap(self, connection, flight_code, date):
+        """Returns (bitmap, version) of the flight, creating its row on first use."""
+        row = connection.execute("SELECT reserved, version FROM seat_inventory WHERE flight_code = ? AND date = ?", (flight_code, date)).fetchone()
+        if row is None:
+            connection.execute("INSERT OR IGNORE INTO seat_inventory (flight_code, date, reserved, version) VALUES (?, ?, ?, 0)", (flight_code, date, bytes(BITMAP_SIZE)))
+            row = connection.execute("SELECT reserved, version FROM seat_inventory WHERE flight_code = ? AND date = ?", (flight_code, date)).fetchone()
+        return bytearray(row[0]), row[1]
+
+    def _compare_and_set(self, flight_code, date, seat_number, reserve, holder=None):
+        """Sets (or clears) the seat's bit if no one else changed the bitmap meanwhile, retrying on concurrent updates.
+
+        Returns False if the seat is already in the requested state or (when reserving) held by someone other than `holder`.
+        """
+        connection = self._connection()
+        byte_index, mask = seat_bit(seat_number)
+        while True:
+            bitmap, version = self._read_bitmap(connection, flight_code, date)
+            if bool(bitmap[byte_index] & mask) == reserve:
+                return False
+            bitmap[byte_index] ^= mask
+
+            # The hold check is part of the same statement, so a seat held by someone else can't slip in between
+            cursor = connection.execute("""
+                UPDATE seat_inventory SET reserved = ?, version = version + 1
+                WHERE flight_code = ? AND date = ? AND version = ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM seat_holds
+                    WHERE flight_code = ? AND date = ? AND seat_number = ? AND holder != ? AND expires_at > ?
+                )
+            """, (bytes(bitmap), flight_code, date, version, flight_code, date, seat_number, holder if reserve else "", time.time() if reserve else float("inf")))
+            if cursor.rowcount == 1:
+                return True
+
+            # Either the version changed (another seat of the flight was booked meanwhile, so try again) or the seat is held by someone else
+            if self._read_bitmap(connection, flight_code, date)[1] == version:
+                return False
+
+    @tracer.traced("seat_inventory.hold", kind="db")
+    def hold_seat(self, flight_code, date, seat_number, holder, ttl=None):
+        """Holds the seat for the holder (or extends their hold). Returns False if the seat is reserved or held by someone else."""
+        self._check_seat_number(seat_number)
+        connection = self._connection()
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.hold_ttl)
+
+        # Take the hold unless someone else holds the seat and their hold hasn't expired
+        cursor = connection.execute("""
+            INSERT INTO seat_holds (flight_code, date, seat_number, holder, expires_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (flight_code, date, seat_number) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE seat_holds.holder = excluded.holder OR seat_holds.expires_at <= ?
+        """, (flight_code, date, seat_number, holder, expires_at, now))
+        if cursor.rowcount != 1:
+            seat_holds.inc(result="taken")
+            return False
+
+        # A reservation can't be made while the hold exists, so it's enough to check the bitmap once after taking it
+        bitmap, _ = self._read_bitmap(connection, flight_code, date)
+        if is_reserved(bitmap, seat_number):
+            self.release_seat(flight_code, date, seat_number, holder)
+            seat_holds.inc(result="taken")
+            return False
+
+        seat_holds.inc(result="held")
+        return True
+
+    def release_seat(self, flight_code, date, seat_number, holder):
+        """Releases the holder's hold of the seat (if they still hold it)."""
+        self._connection().execute("DELETE FROM seat_holds WHERE flight_code = ? AND date = ? AND seat_number = ? AND holder = ?", (flight_code, date, seat_number, holder))
+
+    @tracer.traced("seat_inventory.reserve", kind="db")
+    def reserve_seat(self, flight_code, date, seat_number, holder):
+        """Reserves the seat for the holder and releases their hold. Returns False if it's reserved or held by someone else."""
+        self._check_seat_number(seat_number)
+        reserved = self._compare_and_set(flight_code, date, seat_number, True, holder)
+        if reserved:
+            self.release_seat(flight_code, date, seat_number, holder)
+        return reserved
+
+    def cancel_reservation(self, flight_code, date, seat_number):
+        """Makes a reserved seat free again (e.g. when the booking fails at the airline)."""
+        self._check_seat_number(seat_number)
+        return self._compare_and_set(flight_code, date, seat_number, False)
+
+    def seat_map(self, flight_code, date) -> SeatMap:
+        """Returns the free, held and reserved seats of the flight."""
+        connection = self._connection()
+        bitmap, _ = self._read_bitmap(connection, flight_code, date)
+        held = {row[0] for row in connection.execute("SELECT seat_number FROM seat_holds WHERE flight_code = ? AND date = ? AND expires_at > ?", (flight_code, date, time.time()))}
+
+        seat_map = {"flight_code": flight_code, "date": date, "free": [], "held": [], "reserved": []}
+        for seat_number in range(FIRST_SEAT, LAST_SEAT + 1):
+            if is_reserved(bitmap, seat_number):
+                seat_map["reserved"].append(seat_number)
+            elif seat_number in held:
+                seat_map["held"].append(seat_number)
+            else:
+                seat_map["free"].append(seat_number)
+        return seat_map
+
+    def purge_expired_holds(self):
+        """Deletes the expired holds and returns their number (they are already ignored, this only reclaims space)."""
+        return self._connection().execute("DELETE FROM seat_holds WHERE expires_at <= ?", (time.time(),)).rowcount
+# -----------------------------------------------------------------------------------
+
+
+# Seat inventory shared by the tools (created on first use)
+_seat_inventory = None
+_seat_inventory_lock = threading.Lock()
+
+def get_seat_inventory():
+    global _seat_inventory
+    with _seat_inventory_lock:
+        if _seat_inventory is None:
+            _seat_inventory = SeatInventory()
+    return _seat_inventory
+
+
+
+
+if __name__ == "__main__":
+
+    # Book the seats of a flight from many threads at the same time: every seat must be reserved exactly once
+    import random
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as directory:
+        inventory = SeatInventory(os.path.join(directory, "seat_inventory.db"))
+        seat_numbers = list(range(FIRST_SEAT, LAST_SEAT + 1))
+
+        def book(index):
+            user = f"user-{index}"
+            booked = []
+            for seat_number in random.Random(index).sample(seat_numbers, len(seat_numbers)):
+                if inventory.hold_seat("TK802", "2025-06-10", seat_number, user) and inventory.reserve_seat("TK802", "2025-06-10", seat_number, user):
+                    booked.append(seat_number)
+            return booked
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            bookings = list(executor.map(book, range(16)))
+        elapsed = time.perf_counter() - start_time
+
+        booked_seats = sorted(seat_number for booked in bookings for seat_number in booked)
+        print(f"Booked {len(booked_seats)} of {len(seat_numbers)} seats in {elapsed:.2f} s, double bookings: {len(booked_seats) - len(set(booked_seats))}")
+        print(f"Seats per user: {[len(booked) for booked in bookings]}")
+        seat_map = inventory.seat_map("TK802", "2025-06-10")
+        print(f"Free: {format_seat_ranges(seat_map['free']) or '---'} | Reserved: {format_seat_ranges(seat_map['reserved'])}")
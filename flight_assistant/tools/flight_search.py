@@ -4,24 +4,48 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__f
 
 from datetime import datetime
 import sqlite3
+import itertools
 
-from typing import Type, Optional, List, Dict, Any, Union, Annotated
+from typing import Type, Optional, List, Dict, Any, Tuple
 from pydantic import BaseModel, Field, field_validator
 
-from langchain_core.tools import BaseTool, InjectedToolArg
+from langchain_core.tools import BaseTool, ToolException
 from langchain_core.tools.base import ArgsSchema
-from langchain_core.messages import ToolMessage
 
-from flight_assistant.data.setup_mock_flight_data import normalize_city_name
+from flight_assistant.data.setup_mock_flight_data import normalize_city_name, nearby_cities
 from flight_assistant.utils import pretty_print_object
+from common.tracing import tracer
+from common.metrics import flight_searches
+from common.retry import circuit_breaker
 
 
+# Path to the database file (can be overridden, e.g. with the small fixed-seed database of the benchmarks)
+DATABASE_PATH = os.getenv("FLIGHT_DATABASE_PATH", os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "db", "flight_database.db")))
+
+
+# Multi-route searches (search_flights_multi, e.g. "from Istanbul, Kocaeli or Sakarya to Izmir or any city within 100 km"):
+#   MULTI_SEARCH_MAX_CITIES   departure (and arrival) cities searched at most, the given cities first, then the closest neighbours
+#   MULTI_SEARCH_RESULTS      flights offered to the user per leg, the best ones of all the routes
+MULTI_SEARCH_MAX_CITIES = int(os.getenv("MULTI_SEARCH_MAX_CITIES", 8))
+MULTI_SEARCH_RESULTS = int(os.getenv("MULTI_SEARCH_RESULTS", 5))
+
+
+# Columns of the flight tables in the content of the tool messages (name in the table, key of the flight dictionary)
+TABLE_COLUMNS = [("code", "flight_code"), ("airline", "airline"), ("dep", "departure_time"), ("arr", "arrival_time"), ("duration", "duration"), ("class", "class"), ("price_TL", "price")]
+# The flights of a multi-route search also carry their route
+MULTI_TABLE_COLUMNS = [("from", "from_city"), ("to", "to_city")] + TABLE_COLUMNS
+
+
+def format_flight_table(label, flights, from_city, to_city, date, columns=TABLE_COLUMNS):
+    """A list of flights as a compact table: a header line, then one numbered row per flight (in the order the user is shown them)."""
+    header = "|".join(["no"] + [name for name, _ in columns])
+    rows = ["|".join([str(number)] + [str(flight[key]) for _, key in columns]) for number, flight in enumerate(flights, start=1)]
+    return "\n".join([f"{label} flights {from_city} -> {to_city} on {date}:", header, *rows])
+
 
 # Schema for the input to the flight search tool
 class FlightSearchInput(BaseModel):
     # Ellipsis (...) indicates that the field is required (but a default value is not specified)
-    # InjectedToolArg --> There are cases where certain arguments need to be passed to a tool at runtime but should not be generated by the model itself. For this, we use the InjectedToolArg annotation, which allows certain parameters to be hidden from the tool's schema. (source: langchain docs)
-    tool_call_id: Annotated[str, InjectedToolArg] = Field(..., description="Unique identifier for the tool call")
     from_city: str = Field(..., description="Departure city")
     to_city: str = Field(..., description="Arrival city")
     flight_type: str = Field(..., description='Trip type: must be "one-way" or "two-way"')
@@ -54,33 +78,43 @@ class FlightSearchInput(BaseModel):
 
 
 class FlightSearchTool(BaseTool):
+    """Searches the flights of a trip.
+
+    The tool message sent to the flight llm (and kept in the conversation for the rest of the session) holds the flights
+    as compact tables, and the structured results ({"depart_flights": [...], "return_flights": [...]}) are returned as
+    the message's artifact, which the flight graph reads. Unsuccessful searches raise a ToolException, which becomes a
+    tool message with the error status.
+    """
+
     name: str = "search_flights"
     description: str = "Finds available flights based on flight information provided by user."
     args_schema: Type[BaseModel] = FlightSearchInput
-    # response_format: str = "content_and_artifact"
+    response_format: str = "content_and_artifact"
+    handle_tool_error: bool = True
+    database_path: str = DATABASE_PATH
 
+    @tracer.traced("sqlite.query", kind="db")
     def _query_database(self, query: str, params: tuple) -> List[Dict[str, Any]]:
         """Executes a SQL query and fetches results."""
 
-        # Path to the database file
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        database_path = os.path.abspath(os.path.join(current_dir, "..", "data", "db", "flight_database.db"))
-
-        # Establish a connection to the database
-        connection = sqlite3.connect(database_path)  # Connect to the database
-        cursor = connection.cursor()
+        # The queries fail right away while the database keeps failing (see common/retry.py)
+        with circuit_breaker("flight_db").guard():
+            # Establish a connection to the database
+            connection = sqlite3.connect(self.database_path)  # Connect to the database
+            cursor = connection.cursor()
 
-        # Execute the query, fetch results, and close the connection
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        connection.close()
+            # Execute the query, fetch results, and close the connection
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            connection.close()
 
         # print(type(rows))
         # print(rows)
 
         # Convert query results to structured output
         flights = [
-            {"airline": row[4], 
+            {"date": row[1],
+             "airline": row[4], 
              "departure_time": row[5], 
              "arrival_time": row[6], 
              "duration": row[7],
@@ -95,13 +129,12 @@ class FlightSearchTool(BaseTool):
 
     def _run(
         self,
-        tool_call_id,
         from_city,
         to_city,
         flight_type,
         depart_date,
         return_date = None,
-    ) -> Union[ Dict[str, List[Dict[str, Any]]], ToolMessage]:
+    ) -> Tuple[str, Dict[str, List[Dict[str, Any]]]]:
         """Retrieve structured flight details from the database."""
 
         # Initialize the dictionary to store the retieved flight details
@@ -122,61 +155,187 @@ class FlightSearchTool(BaseTool):
 
         try:
             # Query the database for depart flights and store the results
-            depart_flights = self._query_database(query, (depart_date, from_city, to_city))
-            results["depart_flights"] = depart_flights
+            results["depart_flights"] = self._query_database(query, (depart_date, from_city, to_city))
 
             # Query return flights if it's a two-way trip
             if flight_type == "two-way" and return_date is not None:
-                return_flights = self._query_database(query, (return_date, to_city, from_city))
-                results["return_flights"] = return_flights
-
-            
-            # --- ERROR HANDLING ---
-            # Case 1: No depart flights found
-            if len(depart_flights) == 0:
-                # Return a tool response message indicating that no flights are available
-                content = f"""No flights could be retrieved for the given user input. Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call)."""
-                return ToolMessage(
-                    tool_call_id=tool_call_id,
-                    content=content,
-                    status="error",
-                )
-            
-            # Case 2: Return flights are requested but not found
-            if flight_type == "two-way" and len(return_flights) == 0:
-                # Return a tool response message indicating that no return flights are available
-                content = f"""Even though depart flights could be retrieved, no return flights could be retrieved for the given user input. Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call)."""
-                return ToolMessage(
-                    tool_call_id=tool_call_id,
-                    content=content,
-                    status="error",
-                )
-            
-            # Default case where flights are successfully retrieved (no error)
-            return results
-
+                results["return_flights"] = self._query_database(query, (return_date, to_city, from_city))
 
         except Exception as e:
             # In case of code execution errors that are unrelated to the system logic (e.g. failed to connect to the database, api server didn't respond etc.)
-            content = f"""An error occurred while trying to retrieve flight information. The error message is: {str(e)}. Problem may disappear if tried again; but if it still persists, contacting the system administrator might be necessary. Please continue assisting the user appropriately."""
-            return ToolMessage(
-                tool_call_id=tool_call_id,
-                content=content,
-                status="error",
-            )
+            flight_searches.inc(trip_type=flight_type, outcome="error")
+            raise ToolException(f"""An error occurred while trying to retrieve flight information. The error message is: {str(e)}. Problem may disappear if tried again; but if it still persists, contacting the system administrator might be necessary. Please continue assisting the user appropriately.""") from e
+
+
+        # --- ERROR HANDLING ---
+        # Case 1: No depart flights found
+        if len(results["depart_flights"]) == 0:
+            flight_searches.inc(trip_type=flight_type, outcome="empty")
+            # Respond with a tool message indicating that no flights are available
+            raise ToolException(f"""No flights could be retrieved for the given user input. Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call).""")
+
+        # Case 2: Return flights are requested but not found
+        if flight_type == "two-way" and len(results["return_flights"]) == 0:
+            flight_searches.inc(trip_type=flight_type, outcome="empty")
+            # Respond with a tool message indicating that no return flights are available
+            raise ToolException(f"""Even though depart flights could be retrieved, no return flights could be retrieved for the given user input. Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call).""")
+
+        # Default case where flights are successfully retrieved (no error)
+        flight_searches.inc(trip_type=flight_type, outcome="found")
+
+        # Compact tables for the llm, and the structured results as the artifact
+        tables = [format_flight_table("depart", results["depart_flights"], from_city.capitalize(), to_city.capitalize(), depart_date)]
+        if results["return_flights"]:
+            tables.append(format_flight_table("return", results["return_flights"], to_city.capitalize(), from_city.capitalize(), return_date))
+        return "\n\n".join(tables), results
+
+
+
+# Schema for the input to the multi-route flight search tool
+class MultiFlightSearchInput(BaseModel):
+    from_cities: List[str] = Field(..., description="Departure cities (one or more)")
+    to_cities: List[str] = Field(..., description="Arrival cities (one or more)")
+    flight_type: str = Field(..., description='Trip type: must be "one-way" or "two-way"')
+    depart_date: str = Field(..., description="Depart date in YYYY-MM-DD format")
+    return_date: Optional[str] = Field(None, description="Return date in YYYY-MM-DD format (if two-way trip), or None")
+    radius_km: Optional[float] = Field(None, description="Also search from/to the cities within this distance (in km) of the given cities (e.g. when the user says any nearby city is fine), or None")
+    sort_by: str = Field("price", description='Ranking of the flights: "price" (cheapest first) or "time" (earliest departure first)')
+
+    @field_validator("from_cities", "to_cities", mode="after")
+    def validate_cities(cls, value):
+        if len(value) == 0:
+            raise ValueError("At least one city must be given")
+
+        return value
+
+    @field_validator("sort_by", mode="plain")
+    def validate_sort_by(cls, value):
+        if value not in {"price", "time"}:
+            raise ValueError('sort_by must be either "price" or "time"')
+
+        return value
+
+    # Same validators as the single-route search
+    validate_flight_type = field_validator("flight_type", mode="plain")(FlightSearchInput.validate_flight_type.__func__)
+    validate_date_format = field_validator("depart_date", "return_date", mode="after")(FlightSearchInput.validate_date_format.__func__)
+
+
+
+def search_cities(cities, radius_km):
+    """The normalized names of the cities to search: the given ones, then (with a radius) their neighbours by distance, at
+    most MULTI_SEARCH_MAX_CITIES."""
+    candidates = [normalize_city_name(city) for city in cities]
+    if radius_km:
+        # Take the neighbours in rounds (the closest neighbour of every given city first), so that each given city gets its closest neighbours within the limit
+        neighbours = [nearby_cities(city, radius_km)[1:] for city in candidates]
+        for round_ in itertools.zip_longest(*neighbours):
+            candidates += [city for city in round_ if city is not None]
+
+    return list(dict.fromkeys(candidates))[:MULTI_SEARCH_MAX_CITIES]
+
+def rank_flights(flights, sort_by):
+    """Flights of several routes ranked by price (then departure time), or by departure time (then price)."""
+    if sort_by == "time":
+        return sorted(flights, key=lambda flight: (flight["departure_time"], flight["price"]))
+    return sorted(flights, key=lambda flight: (flight["price"], flight["departure_time"]))
+
+
+
+class MultiFlightSearchTool(FlightSearchTool):
+    """Searches the flights of a trip between several departure and arrival cities.
+
+    All the routes of both legs are queried in one SQL statement, and the flights are merged and ranked, so the user is
+    offered the best MULTI_SEARCH_RESULTS flights of each leg (with their routes) after a single tool call. The results
+    have the same form as those of the single-route search, with the route in every flight.
+    """
+
+    name: str = "search_flights_multi"
+    description: str = "Finds available flights between several departure and arrival cities at once (e.g. when the user can fly from or to any of a few cities, or any city near a city), ranked by price or departure time."
+    args_schema: Type[BaseModel] = MultiFlightSearchInput
+
+    @tracer.traced("sqlite.query", kind="db")
+    def _query_routes(self, legs: List[Tuple[str, str, List[str], List[str]]]) -> Dict[str, List[Dict[str, Any]]]:
+        """Queries the flights of all the routes of the legs ((leg, date, from cities, to cities)) in one statement."""
+        selects, params = [], []
+        for leg, date, from_cities, to_cities in legs:
+            selects.append(f"SELECT ? AS leg, * FROM flights WHERE date = ? AND from_city IN ({', '.join('?' * len(from_cities))}) AND to_city IN ({', '.join('?' * len(to_cities))})")
+            params += [leg, date, *from_cities, *to_cities]
+
+        with circuit_breaker("flight_db").guard():
+            connection = sqlite3.connect(self.database_path)
+            rows = connection.execute(" UNION ALL ".join(selects), params).fetchall()
+            connection.close()
+
+        # Same structure as the single-route results (the columns are shifted by the leg), with the route
+        flights = {leg: [] for leg, _, _, _ in legs}
+        for row in rows:
+            flights[row[0]].append({"date": row[2],
+                                    "from_city": row[3].capitalize(),
+                                    "to_city": row[4].capitalize(),
+                                    "airline": row[5],
+                                    "departure_time": row[6],
+                                    "arrival_time": row[7],
+                                    "duration": row[8],
+                                    "class": row[9],
+                                    "price": row[10],
+                                    "flight_code": row[11]})
+        return flights
+
+
+    def _run(
+        self,
+        from_cities,
+        to_cities,
+        flight_type,
+        depart_date,
+        return_date = None,
+        radius_km = None,
+        sort_by = "price",
+    ) -> Tuple[str, Dict[str, List[Dict[str, Any]]]]:
+        """Retrieve the best flights of all the routes from the database."""
+
+        from_cities = search_cities(from_cities, radius_km)
+        to_cities = search_cities(to_cities, radius_km)
+
+        legs = [("depart", depart_date, from_cities, to_cities)]
+        if flight_type == "two-way" and return_date is not None:
+            legs.append(("return", return_date, to_cities, from_cities))
+
+        try:
+            flights = self._query_routes(legs)
+        except Exception as e:
+            flight_searches.inc(trip_type=flight_type, outcome="error")
+            raise ToolException(f"""An error occurred while trying to retrieve flight information. The error message is: {str(e)}. Problem may disappear if tried again; but if it still persists, contacting the system administrator might be necessary. Please continue assisting the user appropriately.""") from e
+
+        # Same error cases as the single-route search
+        if len(flights["depart"]) == 0:
+            flight_searches.inc(trip_type=flight_type, outcome="empty")
+            raise ToolException(f"""No flights could be retrieved for the given user input (searched departure cities: {from_cities}, arrival cities: {to_cities}). Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call).""")
+
+        if flight_type == "two-way" and len(flights.get("return", [])) == 0:
+            flight_searches.inc(trip_type=flight_type, outcome="empty")
+            raise ToolException(f"""Even though depart flights could be retrieved, no return flights could be retrieved for the given user input (searched departure cities: {from_cities}, arrival cities: {to_cities}). Note that the system is only capable of searching for domestic flights within Turkey until the end of 2025 calendar year (2025-12-31), and continue assisting the user also by taking the system capabilities into account (if that seems as the cause of the unsuccessful tool call).""")
+
+        flight_searches.inc(trip_type=flight_type, outcome="found")
+
+        # The best flights of each leg, and the tables with the number of flights and routes they were ranked among
+        results = {"depart_flights": rank_flights(flights["depart"], sort_by)[:MULTI_SEARCH_RESULTS], "return_flights": rank_flights(flights.get("return", []), sort_by)[:MULTI_SEARCH_RESULTS]}
+        tables = []
+        for leg, date, leg_from, leg_to in legs:
+            found = flights[leg]
+            routes = len({(flight["from_city"], flight["to_city"]) for flight in found})
+            label = f"{leg} (best {len(results[leg + '_flights'])} of {len(found)} by {sort_by}, {routes} routes)"
+            tables.append(format_flight_table(label, results[leg + "_flights"], "/".join(city.capitalize() for city in leg_from), "/".join(city.capitalize() for city in leg_to), date, columns=MULTI_TABLE_COLUMNS))
+        return "\n\n".join(tables), results
 
 
 
 if __name__ == "__main__":
-    
-    flight_search_tool = FlightSearchTool()
 
-    # output = flight_search_tool.invoke({
-    #     "name": "search_flights",
-    #     "args": {"from_city": "Istanbul", "to_city": "İzmir", "flight_type": "two-way", "depart_date": "2025-05-19", "return_date": "2025-10-10"},
-    #     "id": "123",  # required
-    #     "type": "tool_call",  # required
-    # })
+    from common.context_manager import count_text_tokens
+    from common.serialization import dumps
+
+    flight_search_tool = FlightSearchTool()
 
     tool_call = {
         "name": "search_flights",
@@ -185,25 +344,26 @@ if __name__ == "__main__":
         "type": "tool_call",
     }
 
-    tool_call["status"] = "approved"
-
-    tool_call["args"] = {"tool_call_id": tool_call["id"], **tool_call["args"]}
-    # tool_call["args"] = {**tool_call["args"], "tool_call_id": tool_call["id"]}
-
-    args = tool_call["args"]
-    args = {"tool_call_id": tool_call["id"], **args}
-
-    print(tool_call)
-
     output = flight_search_tool.invoke(tool_call)
 
     print("---------------------------------------")
-    print(f"Output type:\n\n {type(output)}\n\n")
-    print(f"Content type:\n\n {type(output.content)}\n\n")
+    print(f"Status: {output.status}\n")
+    print(f"Content:\n\n{output.content}\n")
     print("---------------------------------------")
-    print(f"Output:\n\n {output}\n\n")
-    print(f"Status:\n\n {output.status}\n\n")
-    # pretty_print_object(output)
-    # print("\n")
+    # Tokens of the content against the results as json (the content before the tables)
+    if output.artifact is not None:
+        print(f"Content tokens: {count_text_tokens(output.content)} (as json: {count_text_tokens(dumps(output.artifact).decode())})")
+
+    # The same trip from Istanbul, Kocaeli or Sakarya (or any city within 100 km) to Izmir, in a single multi-route search
+    multi_tool_call = {
+        "name": "search_flights_multi",
+        "args": {"from_cities": ["Istanbul", "Kocaeli", "Sakarya"], "to_cities": ["Izmir"], "radius_km": 100, "flight_type": "two-way", "depart_date": "2025-09-18", "return_date": "2025-11-10"},
+        "id": "124",
+        "type": "tool_call",
+    }
+
+    output = MultiFlightSearchTool().invoke(multi_tool_call)
+
     print("---------------------------------------")
-    print(f"Output instance variables:\n\n {output.__dict__.keys()}\n\n")
\ No newline at end of file
+    print(f"Status: {output.status}\n")
+    print(f"Content:\n\n{output.content}\n")
@@ -9,7 +9,15 @@ from langchain_core.tools import BaseTool
 from langchain_core.tools.base import ArgsSchema
 from langchain_core.runnables import RunnableConfig
 
-from time import sleep
+from common.human_io import notify_user
+from flight_assistant.escalation_outbox import get_escalation_outbox, Escalation
+
+# What the user is told about a request for the same flights that is still in flight (by its state in the outbox)
+IN_FLIGHT_STATUS_TEXT = {
+    "pending": "henuz yoneticinize iletilmedi, iletilmek uzere sirada bekliyor",
+    "sending": "yoneticinize iletiliyor",
+    "delivered": "yoneticinize iletildi, yoneticinizin kararini bekliyor",
+}
 
 # Schema for the input to the manager escalation tool
 class ManagerEscalationInput(BaseModel):
@@ -24,6 +32,16 @@ class ManagerEscalationTool(BaseTool):
     description: str = "Carries out the manager escalation process for the user."
     args_schema: Type[BaseModel] = ManagerEscalationInput
     # response_format: str = "content_and_artifact"
+    # Outbox the escalation mails are queued in and delivered from in the background (see flight_assistant/escalation_outbox.py)
+    outbox: Any = Field(default_factory=get_escalation_outbox)
+
+    def _notify_escalation(self, config, user_info, manager_info, subject, escalation_message):
+        """Shows the escalation mail that is sent to the manager."""
+        notify_user(config, "\n\nTalebiniz yoneticinize iletiliyor...")
+        notify_user(config, f"\n\033[1mFrom:\033[0m {user_info['name']}({user_info['email']})")
+        notify_user(config, f"\n\033[1mTo:\033[0m {manager_info['name']}({manager_info['email']})")
+        notify_user(config, f"\n\033[1mSubject:\033[0m {subject}")
+        notify_user(config, f"\n\033[1mMessage:\033[0m {escalation_message if escalation_message else '-'}")
 
     def _run(
         self,
@@ -31,31 +49,35 @@ class ManagerEscalationTool(BaseTool):
         depart_flight,
         return_flight=None,
         escalation_message=None
-    ) -> bool:
-        """Send mail (with additional explanatory message) to the manager on behalf of the user, for requesting the purchase of flights that violate company policy."""
+    ) -> Escalation:
+        """Queue a mail (with additional explanatory message) to the manager on behalf of the user, for requesting the purchase of flights that violate company policy."""
 
-        # Retrieve user information from the configuration dictionary
-        print("\nKullanici bilgileri aliniyor...")
-        sleep(2)
+        # The user's record in the session carries their manager, so nothing has to be fetched before queueing the mail
         user_info = config["configurable"]["user"]
-        print(f"\n\033[1mIsim:\033[0m {user_info['name']}\n\033[1mE-posta:\033[0m {user_info['email']}")
-
-        # Retrieve manager information from the configuration dictionary
-        print("\n\nYonetici bilgileri aliniyor...")
-        sleep(2)
         manager_info = user_info["manager"]
-        print(f"\n\033[1mIsim:\033[0m {manager_info['name']}\n\033[1mE-posta:\033[0m {manager_info['email']}")
 
-        # Simulate the escalation process
-        print("\n\nTalebiniz yoneticinize iletiliyor...")
-        print(f"\n\033[1mFrom:\033[0m {user_info['name']}({user_info['email']})")
-        print(f"\n\033[1mTo:\033[0m {manager_info['name']}({manager_info['email']})")
-        print(f"\n\033[1mSubject:\033[0m {depart_flight['flight_code']}{' ve ' if return_flight else ''}{return_flight['flight_code'] if return_flight else ''} kodlu ucus{'lar' if return_flight else ''} icin onay talebi")
-        print(f"\n\033[1mMessage:\033[0m {escalation_message if escalation_message else '-'}")
-        sleep(4)
-        print("\n\nIstisna talebiniz yoneticinize iletilmistir. Onay gelmesi halinde e-mail ile bilgilendirileceksiniz.")
+        subject = f"{depart_flight['flight_code']}{' ve ' if return_flight else ''}{return_flight['flight_code'] if return_flight else ''} kodlu ucus{'lar' if return_flight else ''} icin onay talebi"
+        # The session's thread_id is stored with the request, so that the session can be resumed once the manager decides
+        escalation, created = self.outbox.enqueue(user_info, manager_info, depart_flight, return_flight, subject, escalation_message or "-", config["configurable"].get("thread_id"))
+
+        if created:
+            self._notify_escalation(config, user_info, manager_info, subject, escalation_message)
+            notify_user(config, f"\n\nIstisna talebiniz yoneticinize iletilmek uzere kaydedildi (talep no: {escalation['escalation_id']}). Onay gelmesi halinde e-mail ile bilgilendirileceksiniz.")
+        else:
+            # Only a request that's still in flight is returned for the same flights, so no new mail is sent
+            notify_user(config, f"\n\nBu ucuslar icin daha once olusturdugunuz istisna talebi (talep no: {escalation['escalation_id']}) {IN_FLIGHT_STATUS_TEXT.get(escalation['status'], escalation['status'])}. Yeni bir talep gonderilmedi; karar verildiginde bilgilendirileceksiniz.")
+
+        return escalation
 
-        return True
+    async def _arun(
+        self,
+        config,
+        depart_flight,
+        return_flight=None,
+        escalation_message=None
+    ) -> Escalation:
+        """Queue the escalation mail to the manager (a single local insert, so it doesn't hold up the event loop)."""
+        return self._run(config, depart_flight, return_flight, escalation_message)
 
 
 if __name__ == "__main__":
@@ -63,11 +85,11 @@ if __name__ == "__main__":
     manager_escalation_tool = ManagerEscalationTool()
 
     manager_info = {"name": "Ali", "id":12345678910, "email": "ali@langgraph.com"}
-    user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager_info": manager_info}
-    config = config = {"configurable": {"thread_id": "1", "user_info" : user_info}}
+    user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager": manager_info}
+    config = config = {"configurable": {"thread_id": "1", "user" : user_info}}
 
-    depart_flight = {"airline": "THY", "departure_time": "05:30", "arrival_time": "07:15", "duration": "1h 45m", "class": "Business", "price": 5000, "flight_code": "TK802"}
-    return_flight = {"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500, "flight_code": "TK801"}
+    depart_flight = {"airline": "THY", "departure_time": "05:30", "arrival_time": "07:15", "duration": "1h 45m", "class": "Business", "price": 5000, "flight_code": "TK802", "date": "2025-06-10"}
+    return_flight = {"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500, "flight_code": "TK801", "date": "2025-06-14"}
 
     escalation_message = "Bacagim kirildi. Ekstra bacak mesafesine ihtiyacim var. O yuzden business class ucus almaliyim."
 
@@ -9,7 +9,14 @@ from langchain_core.tools import BaseTool
 from langchain_core.tools.base import ArgsSchema
 from langchain_core.runnables import RunnableConfig
 
-from time import sleep
+import uuid
+import asyncio
+
+from common.human_io import notify_user, user_attached, run_interaction, arun_interaction
+from common.retry import circuit_breaker
+from flight_assistant.gateway import get_airline_gateway, get_corporate_gateway, run_sync
+from flight_assistant.booking_ledger import get_booking_ledger
+from flight_assistant.seat_inventory import get_seat_inventory, format_seat_ranges, SeatUnavailableError, FIRST_SEAT, LAST_SEAT
 
 
 # Schema for the input to the ticket purchase tool
@@ -17,105 +24,213 @@ class TicketPurchaseInput(BaseModel):
     config: RunnableConfig = Field(..., description="Configuration dictionary with additional runtime information")
     depart_flight: dict[str, Any] = Field(..., description="Departure flight details")
     return_flight: Optional[dict[str, Any]] = Field(None, description="Return flight details (if two-way trip)")
+    tool_call_id: Optional[str] = Field(None, description="Id of the tool call the tickets are purchased for, the idempotency key of the bookings (retries with the same id don't book again)")
     
 
+# Interactive steps to prompt the user for a free seat on the given flight and hold it for them (see common/human_io.py for how the steps are driven)
+def seat_selection_steps(config, flight, leg, seat_inventory, holder):
+    while True:
+        # Show the seats that are still free on the flight
+        free_seats = seat_inventory.seat_map(flight["flight_code"], flight["date"])["free"]
+        if not free_seats:
+            raise SeatUnavailableError(f"No free seats are left on flight {flight['flight_code']} ({flight['date']})")
+
+        # Prompt the user to select a seat for the flight
+        prompt_text = f"\nLutfen \033[1m({flight['flight_code']})\033[0m kodlu {leg} ucusunuz icin koltuk secimi yapin ({FIRST_SEAT}-{LAST_SEAT}, bos koltuklar: {format_seat_ranges(free_seats)}): "
+        user_choice = yield prompt_text
+
+        try:
+            seat_number = int(user_choice)
+        except ValueError:
+            seat_number = None
+
+        if seat_number is None or not FIRST_SEAT <= seat_number <= LAST_SEAT:
+            notify_user(config, f"\nGecersiz secim. Lutfen {FIRST_SEAT}-{LAST_SEAT} arasi bir koltuk numarasi girin.")
+            continue
+
+        # Hold the seat until the purchase is completed, unless another user got it first
+        if seat_inventory.hold_seat(flight["flight_code"], flight["date"], seat_number, holder):
+            return seat_number
+        notify_user(config, f"\n{seat_number} numarali koltuk dolu. Lutfen bos koltuklardan birini secin.")
+
+# Interactive steps to select (and hold) the seats of all legs of the trip before any of them is reserved
+def legs_seat_selection_steps(config, legs, seat_inventory, holder):
+    seat_numbers = []
+    for flight, _, leg, header, _ in legs:
+        notify_user(config, f"\n-------------------------{header}-------------------------------")
+        seat_number = yield from seat_selection_steps(config, flight, leg, seat_inventory, holder)
+        seat_numbers.append(seat_number)
+    return seat_numbers
+
+# Holds the first free seat of every leg, for a purchase that runs without the user (e.g. resumed after a manager's approval)
+def assign_seats(config, legs, seat_inventory, holder):
+    seat_numbers = []
+    for flight, _, leg, _, _ in legs:
+        # Another booking may take a free seat before it's held, so try the next one
+        for seat_number in seat_inventory.seat_map(flight["flight_code"], flight["date"])["free"]:
+            if seat_inventory.hold_seat(flight["flight_code"], flight["date"], seat_number, holder):
+                break
+        else:
+            raise SeatUnavailableError(f"No free seats are left on flight {flight['flight_code']} ({flight['date']})")
+
+        notify_user(config, f"\n\033[1m({flight['flight_code']})\033[0m kodlu {leg} ucusunuz icin {seat_number} numarali koltuk atandi.")
+        seat_numbers.append(seat_number)
+    return seat_numbers
+
+
 class TicketPurchaseTool(BaseTool):
     name: str = "purchase_tickets"
     description: str = "Carries out the ticket purchase process for the user."
     args_schema: Type[BaseModel] = TicketPurchaseInput
     # response_format: str = "content_and_artifact"
+    # External systems the tickets are booked through (local stubs by default, see flight_assistant/gateway.py)
+    airline_gateway: Any = Field(default_factory=get_airline_gateway)
+    corporate_gateway: Any = Field(default_factory=get_corporate_gateway)
+    # Seat reservations and holds shared by all sessions (see flight_assistant/seat_inventory.py)
+    seat_inventory: Any = Field(default_factory=get_seat_inventory)
+    # Append-only record of the issued tickets (see flight_assistant/booking_ledger.py)
+    booking_ledger: Any = Field(default_factory=get_booking_ledger)
+
+    def _get_legs(self, depart_flight, return_flight):
+        """Returns (flight, ledger key, leg name, header, ticket label) of the legs of the trip."""
+        legs = [(depart_flight, "depart", "gidis", "GIDIS", "Bilet bilgileri --> ")]
+        if return_flight is not None:
+            legs.append((return_flight, "return", "donus", "DONUS", ""))
+        return legs
+
+    def _show_user_info(self, config, user_info):
+        """Shows the user information the tickets are booked for."""
+        notify_user(config, f"""\nKullanici bilgileri alindi. Asagidaki kullanici icin bilet rezervasyonu yapiliyor:
+              \033[1mIsim:\033[0m {user_info['name']}
+              \033[1mTCKN:\033[0m {user_info['id']}""")
+
+    def _holder(self, config):
+        """Returns the id the seats of the session are held under."""
+        return str(config["configurable"].get("thread_id", "default"))
+
+    async def _get_user(self, config):
+        """Retrieves the user information from the company directory (failing right away while it keeps failing, see common/retry.py)."""
+        with circuit_breaker("corporate").guard():
+            return await self.corporate_gateway.get_user(config["configurable"]["user"])
+
+    async def _reserve_at_airline(self, flight, user_info, seat_number):
+        """Reserves a seat at the airline (failing right away while the airline's system keeps failing, see common/retry.py)."""
+        with circuit_breaker("airline").guard():
+            return await self.airline_gateway.reserve_seat(flight, user_info, seat_number)
+
+    async def _reserve_legs(self, config, user_info, legs, seat_numbers, idempotency_key):
+        """Reserves the held seats of the legs in the seat inventory, then at the airline (both legs of a two-way trip at the same time),
+        and records every leg booked at the airline in the booking ledger right away."""
+        notify_user(config, "\nKoltuk secimi isleniyor, rezervasyon tamamlaniyor...")
+        holder = self._holder(config)
+
+        # Reserve the seats in the inventory first, the held seats can only be lost if the holds expired meanwhile
+        reserved = []
+        recorded = set()
+        try:
+            for (flight, key, _, _, _), seat_number in zip(legs, seat_numbers):
+                if not self.seat_inventory.reserve_seat(flight["flight_code"], flight["date"], seat_number, holder):
+                    raise SeatUnavailableError(f"Seat {seat_number} on flight {flight['flight_code']} was taken by another booking")
+                reserved.append((flight, key, seat_number))
+
+            # A leg that fails doesn't cancel the other one: the booked leg is recorded, so that a retry only books the failed leg
+            results = await asyncio.gather(*(self._reserve_at_airline(flight, user_info, seat_number) for flight, _, seat_number in reserved), return_exceptions=True)
+            for (flight, key, _), result in zip(reserved, results):
+                if not isinstance(result, BaseException):
+                    self.booking_ledger.record_booking(idempotency_key, key, user_info["id"], {**flight, "seat_number": result["seat_number"], "pnr_number": result["pnr_number"]})
+                    recorded.add(key)
+
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                raise errors[0]
+        except BaseException:
+            # Free the seats of the legs that weren't booked, so that they can be selected on the next attempt
+            for flight, key, seat_number in reserved:
+                if key not in recorded:
+                    self.seat_inventory.cancel_reservation(flight["flight_code"], flight["date"], seat_number)
+            for (flight, _, _, _, _), seat_number in zip(legs, seat_numbers):
+                self.seat_inventory.release_seat(flight["flight_code"], flight["date"], seat_number, holder)
+            raise
+
+    def _issue_tickets(self, config, user_info, legs, bookings) -> dict[str, Optional[dict[str, Any]]]:
+        """Shows the details of the booked tickets to the user and returns them."""
+        tickets = []
+        notify_user(config, "\nRezervasyonunuz tamamlandi. Biletiniz basariyla olusturuldu:")
+        for _, key, _, _, label in legs:
+            ticket = bookings[key]["ticket"]
+            ticket_str = f"\033[1mIsim:\033[0m {user_info['name']} | \033[1mUcus Kodu:\033[0m {ticket['flight_code']} | \033[1mKoltuk Numarasi:\033[0m {ticket['seat_number']} | \033[1mPNR No:\033[0m {ticket['pnr_number']}"
+            notify_user(config, f"\n{label}{ticket_str}")
+            tickets.append(ticket)
+        notify_user(config, f"\nBilet detaylariniz e-posta adresinize gonderildi: {user_info['email']}")
+
+        return {"depart_ticket": tickets[0], "return_ticket": tickets[1] if len(tickets) > 1 else None}
+
+    def _pending_legs(self, legs, idempotency_key):
+        """Returns the legs that aren't booked under the idempotency key yet (all of them on the first attempt)."""
+        booked = self.booking_ledger.get_bookings(idempotency_key)
+        return [leg for leg in legs if leg[1] not in booked]
 
     def _run(
         self,
         config,
         depart_flight,
-        return_flight=None
+        return_flight=None,
+        tool_call_id=None
     ) -> dict[str, Optional[str]]:
         """Purchase tickets for the user based on the provided flight details."""
-        
-        depart_ticket = None
-        return_ticket = None
-
-        # Retrieve user information from the configuration dictionary
-        print("\nKullanici bilgileri aliniyor...")
-        sleep(2)
-        user_info = config["configurable"]["user"]
-        print(f"""\nKullanici bilgileri alindi. Asagidaki kullanici icin bilet rezervasyonu yapiliyor:
-              \033[1mIsim:\033[0m {user_info['name']}
-              \033[1mTCKN:\033[0m {user_info['id']}""")
-        
-        # Simulate the ticket purchase process
-        print("\n-------------------------GIDIS-------------------------------")
-        counter = 1
-        while True:
-            if counter > 1:
-                print("\nGecersiz secim. Lutfen 20-100 arasi bir koltuk numarasi girin.")
-
-            # Prompt the user to select a seat for the departure flight
-            prompt_text = f"\nLutfen \033[1m({depart_flight['flight_code']})\033[0m kodlu gidis ucusunuz icin koltuk secimi yapin (20-100): "
-            user_choice = input(prompt_text)
-
-            try:
-                # Simulate request and response flow from the airline's system
-                if int(user_choice) >= 20 and int(user_choice) <= 100:
-                    print("\nKoltuk secimi isleniyor...")
-                    sleep(4)
-                    print("\nRezervasyon tamamlaniyor...")
-                    sleep(4)
-                    print("\nRezervasyonunuz tamamlandi. Biletiniz basariyla olusturuldu:")
-                    depart_ticket_str = f"\033[1mIsim:\033[0m {user_info['name']} | \033[1mUcus Kodu:\033[0m {depart_flight['flight_code']} | \033[1mKoltuk Numarasi:\033[0m {user_choice} | \033[1mPNR No:\033[0m X36Q9C"
-                    print(f"\nBilet bilgileri --> {depart_ticket_str}")
-                    print(f"\nBilet detaylariniz e-posta adresinize gonderildi: {user_info['email']}")
-
-                    depart_ticket = {**depart_flight, "seat_number": int(user_choice), "pnr_number": "X36Q9C"}
-                    
-                    break
-                else:
-                    counter += 1
-                    continue
-
-            except:
-                counter += 1
-                continue
-
-        # Repeat for the return flight if it exists
-        if return_flight is not None:
-            print("\n-------------------------DONUS-------------------------------")
-            counter = 1
-            while True:
-                if counter > 1:
-                    print("\nGecersiz secim. Lutfen 20-100 arasi bir koltuk numarasi girin.")
-
-                # Prompt the user to select a seat for the departure flight
-                prompt_text = f"\nLutfen \033[1m({return_flight['flight_code']})\033[0m kodlu donus ucusunuz icin koltuk secimi yapin (20-100): "
-                user_choice = input(prompt_text)
-
-                try:
-                    # Simulate request and response flow from the airline's system
-                    if int(user_choice) >= 20 and int(user_choice) <= 100:
-                        print("\nKoltuk secimi isleniyor...")
-                        sleep(4)
-                        print("\nRezervasyon tamamlaniyor...")
-                        sleep(4)
-                        print("\nRezervasyonunuz tamamlandi. Biletiniz basariyla olusturuldu:")
-                        return_ticket_str = f"\033[1mIsim:\033[0m {user_info['name']} | \033[1mUcus Kodu:\033[0m {return_flight['flight_code']} | \033[1mKoltuk Numarasi:\033[0m {user_choice} | \033[1mPNR No:\033[0m H62Y8A"
-                        print(f"\n{return_ticket_str}")
-                        print(f"\nBilet detaylariniz e-posta adresinize gonderildi: {user_info['email']}")
-
-                        return_ticket = {**return_flight, "seat_number": int(user_choice), "pnr_number": "H62Y8A"}
-                        
-                        break
-                    else:
-                        counter += 1
-                        continue
-
-                except:
-                    counter += 1
-                    continue
-
-        purchased_tickets = {"depart_ticket": depart_ticket, "return_ticket": return_ticket}
-
-        return purchased_tickets
+
+        legs = self._get_legs(depart_flight, return_flight)
+        idempotency_key = tool_call_id or str(uuid.uuid4())
+
+        # Retrieve user information from the company directory
+        notify_user(config, "\nKullanici bilgileri aliniyor...")
+        user_info = run_sync(self._get_user(config))
+        self._show_user_info(config, user_info)
+
+        # Legs booked by an earlier attempt of the same purchase are not booked again
+        pending_legs = self._pending_legs(legs, idempotency_key)
+        if pending_legs:
+            # Prompt the user to select the seats of the flights (or assign them if the user isn't there)
+            if user_attached(config):
+                seat_numbers = run_interaction(legs_seat_selection_steps(config, pending_legs, self.seat_inventory, self._holder(config)), config)
+            else:
+                seat_numbers = assign_seats(config, pending_legs, self.seat_inventory, self._holder(config))
+
+            # Reserve the seats in the airline's system
+            run_sync(self._reserve_legs(config, user_info, pending_legs, seat_numbers, idempotency_key))
+
+        return self._issue_tickets(config, user_info, legs, self.booking_ledger.get_bookings(idempotency_key))
+
+    async def _arun(
+        self,
+        config,
+        depart_flight,
+        return_flight=None,
+        tool_call_id=None
+    ) -> dict[str, Optional[str]]:
+        """Purchase tickets for the user based on the provided flight details, without blocking the event loop."""
+
+        legs = self._get_legs(depart_flight, return_flight)
+        idempotency_key = tool_call_id or str(uuid.uuid4())
+
+        # Retrieve user information from the company directory
+        notify_user(config, "\nKullanici bilgileri aliniyor...")
+        user_info = await self._get_user(config)
+        self._show_user_info(config, user_info)
+
+        # Legs booked by an earlier attempt of the same purchase are not booked again
+        pending_legs = self._pending_legs(legs, idempotency_key)
+        if pending_legs:
+            # Prompt the user to select the seats of the flights (or assign them if the user isn't there)
+            if user_attached(config):
+                seat_numbers = await arun_interaction(legs_seat_selection_steps(config, pending_legs, self.seat_inventory, self._holder(config)), config)
+            else:
+                seat_numbers = assign_seats(config, pending_legs, self.seat_inventory, self._holder(config))
+
+            # Reserve the seats in the airline's system
+            await self._reserve_legs(config, user_info, pending_legs, seat_numbers, idempotency_key)
+
+        return self._issue_tickets(config, user_info, legs, self.booking_ledger.get_bookings(idempotency_key))
 
 
 if __name__ == "__main__":
@@ -124,12 +239,12 @@ if __name__ == "__main__":
 
     manager_info = {"name": "Ali", "id":12345678910, "email": "ali@langgraph.com"}
 
-    user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager_info": manager_info}
+    user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager": manager_info}
 
-    config = config = {"configurable": {"thread_id": "1", "user_info" : user_info}}
+    config = config = {"configurable": {"thread_id": "1", "user" : user_info}}
 
-    depart_flight = {"airline": "THY", "departure_time": "05:30", "arrival_time": "07:15", "duration": "1h 45m", "class": "Business", "price": 5000, "flight_code": "TK802"}
-    return_flight = {"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500, "flight_code": "TK801"}
+    depart_flight = {"airline": "THY", "departure_time": "05:30", "arrival_time": "07:15", "duration": "1h 45m", "class": "Business", "price": 5000, "flight_code": "TK802", "date": "2025-06-10"}
+    return_flight = {"airline": "THY", "departure_time": "09:00", "arrival_time": "10:20", "duration": "1h 20m", "class": "Economy", "price": 1500, "flight_code": "TK801", "date": "2025-06-14"}
 
     # output = ticket_purchase_tool.invoke({"config":config, "depart_flight":depart_flight, "return_flight":return_flight})
     # output = ticket_purchase_tool.invoke({"config":config, "depart_flight":depart_flight, "return_flight":None})
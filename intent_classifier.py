@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+from collections import Counter, defaultdict
+
+
+# -----------------------------------------------------------------------------------
+# Local intent classifier used as a fast path in front of travel_llm.
+#
+# Clear requests like "Istanbul'dan Ankara'ya ucak bileti" are routed to the right assistant without an llm call.
+# Anything else (chit-chat, mixed or negated requests, past bookings and thanks, low confidence) is left to travel_llm.
+# It runs in shadow mode by default: travel_llm still decides every turn and the classifier's predictions are only
+# compared against it, until the measured precision (get_stats / evaluate) is good enough to let it route.
+
+# Label of the inputs that aren't a clear request for one of the assistants
+CHAT_LABEL = "chat"
+INTENTS = ("flight", "car", "hotel")
+
+# Minimum confidence to route an input without calling the llm
+CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", 0.85))
+# Labeled turns (jsonl with "text" and "label" fields) to train the statistical model on, optional
+TRAINING_DATA_PATH = os.getenv("INTENT_TRAINING_DATA")
+# If set, travel_llm's decisions on user turns are appended to this jsonl file (to be used as training data later)
+TURN_LOG_PATH = os.getenv("INTENT_TURN_LOG")
+# In shadow mode the llm is still called on every turn and its decision is used, the classifier's predictions are only compared against it (to measure precision)
+SHADOW_MODE = os.getenv("INTENT_CLASSIFIER_SHADOW", "1") == "1"
+# The classifier can be disabled entirely
+ENABLED = os.getenv("INTENT_CLASSIFIER_ENABLED", "1") == "1"
+
+
+def normalize_text(text):
+    """Lowercases the text (with Turkish casing rules) and replaces Turkish characters with their ASCII counterparts."""
+    text = text.replace("I", "ı").replace("İ", "i").lower()
+    return text.translate(str.maketrans("çğıöşüâîû", "cgiosuaiu"))
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", normalize_text(text))
+
+
+# Keyword rules (matched against the normalized text, word stems so that the Turkish suffixes also match)
+KEYWORD_RULES = {
+    "flight": [r"\bucak", r"\bucus", r"\buc(mak|acag|acam|arim|alim)", r"\bhavayolu", r"\bhavaliman", r"\bflight", r"\bfly(ing)?\b", r"\bplane\b"],
+    "car": [r"\barac", r"\baraba", r"\botomobil", r"\brent ?a ?car", r"\bkiralik (arac|araba)", r"\bcar\b"],
+    "hotel": [r"\botel", r"\bkonaklama", r"\bpansiyon", r"\boda (ayirt|rezerv|tut)", r"\bhotel", r"\bhostel"],
+}
+# A request for the intent also needs an action word, or a trip detail (cities, dates) for flights, to be confident
+ACTION_PATTERNS = [r"\bbilet", r"\brezerv", r"\bayirt", r"\bkirala", r"\btut(mak|mam|alim|ar)", r"\bara(mak|yorum|r misin|lim)?\b", r"\bbak(mak|ar misin|alim)", r"\bistiyorum", r"\bisterim", r"\blazim", r"\bgerek", r"\bbook", r"\brent\b", r"\bneed\b", r"\bwant\b"]
+TRIP_DETAIL_PATTERNS = [r"\w+(dan|den|tan|ten)\b.*\w+(a|e|ya|ye)\b", r"\b(yarin|haftaya|pazartesi|sali|carsamba|persembe|cuma|cumartesi|pazar)\b", r"\b\d{1,2}[./]\d{1,2}\b", r"\b(ocak|subat|mart|nisan|mayis|haziran|temmuz|agustos|eylul|ekim|kasim|aralik)\b", r"\b(tek yon|gidis|donus)"]
+# Negations and questions about the service itself are left to the llm ("ucak bileti istemiyorum", "otel var mi?")
+NEGATION_PATTERNS = [r"\bistemiyorum", r"\bistemem", r"\bdegil\b", r"\bhayir\b", r"\bvazgec", r"\biptal", r"\bgerek yok", r"\bdon'?t\b", r"\bnot\b", r"\bno\b"]
+# Past bookings and thanks aren't requests either ("ucak biletimi aldim, tesekkurler")
+PAST_TENSE_PATTERNS = [r"\baldi(m|k|n|niz)\b", r"\bayirtti(m|k)", r"\bkiraladi(m|k)", r"\byapti(m|k)\b", r"\btuttu(m|k)\b", r"\buctu(m|k)\b", r"\bbooked\b", r"\brented\b"]
+GRATITUDE_PATTERNS = [r"\btesekkur", r"\bsagol", r"\bsag ol", r"\beyvallah", r"\bthank"]
+QUESTION_PATTERNS = [r"\bvar mi", r"\bnasil\b", r"\bne kadar", r"\bmisiniz\b.*\?$", r"\?$"]
+
+
+class NaiveBayesIntentModel:
+    """Small multinomial naive bayes text classifier with a scikit-learn style interface (fit / predict_proba / predict)."""
+
+    def __init__(self, alpha=1.0):
+        # Additive (Laplace) smoothing of the word counts
+        self.alpha = alpha
+        self.classes_ = []
+        self._log_priors = {}
+        self._word_counts = {}
+        self._total_counts = {}
+        self._vocabulary = set()
+
+    def fit(self, texts, labels):
+        class_counts = Counter(labels)
+        self.classes_ = sorted(class_counts)
+        self._word_counts = defaultdict(Counter)
+        for text, label in zip(texts, labels):
+            self._word_counts[label].update(tokenize(text))
+
+        self._vocabulary = set(word for counts in self._word_counts.values() for word in counts)
+        self._total_counts = {label: sum(self._word_counts[label].values()) for label in self.classes_}
+        self._log_priors = {label: math.log(class_counts[label] / len(labels)) for label in self.classes_}
+
+        return self
+
+    def predict_proba(self, texts):
+        """Returns a list of {label: probability} dictionaries."""
+        probabilities = []
+        for text in texts:
+            # Words that weren't seen during training carry no information
+            words = [word for word in tokenize(text) if word in self._vocabulary]
+            log_scores = {}
+            for label in self.classes_:
+                denominator = self._total_counts[label] + self.alpha * len(self._vocabulary)
+                log_scores[label] = self._log_priors[label] + sum(math.log((self._word_counts[label][word] + self.alpha) / denominator) for word in words)
+
+            # Softmax over the log scores
+            max_score = max(log_scores.values())
+            exp_scores = {label: math.exp(score - max_score) for label, score in log_scores.items()}
+            total = sum(exp_scores.values())
+            probabilities.append({label: score / total for label, score in exp_scores.items()})
+
+        return probabilities
+
+    def predict(self, texts):
+        return [max(probability, key=probability.get) for probability in self.predict_proba(texts)]
+
+    @classmethod
+    def from_jsonl(cls, path, **kwargs):
+        """Trains a model on the labeled turns in a jsonl file ({"text": ..., "label": "flight" | "car" | "hotel" | "chat"} per line)."""
+        texts, labels = [], []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    turn = json.loads(line)
+                    texts.append(turn["text"])
+                    labels.append(turn["label"])
+
+        return cls(**kwargs).fit(texts, labels)
+
+
+class IntentClassifier:
+    """Decides the intent of a user input locally, and tells whether it's confident enough to skip the llm."""
+
+    def __init__(self, threshold=CONFIDENCE_THRESHOLD, model=None):
+        self.threshold = threshold
+        # Optional statistical model, consulted when the keyword rules don't decide
+        self.model = model
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.stats = {"calls": 0, "fast_path": 0, "llm_fallbacks": 0, "latency_total": 0.0, "shadow_compared": 0, "shadow_agreed": 0}
+
+    def _match_any(self, patterns, text):
+        return any(re.search(pattern, text) for pattern in patterns)
+
+    def _rule_prediction(self, text):
+        """Returns (label, confidence) from the keyword rules, or None if the rules don't decide."""
+        normalized = normalize_text(text).strip()
+        matched_intents = [intent for intent, patterns in KEYWORD_RULES.items() if self._match_any(patterns, normalized)]
+
+        # No keyword, or several services mentioned together (e.g. "ucak ve otel") -> the llm decides
+        if len(matched_intents) != 1:
+            return None
+        # Negated requests, past bookings, thanks and questions about the service -> the llm decides
+        if any(self._match_any(patterns, normalized) for patterns in (NEGATION_PATTERNS, PAST_TENSE_PATTERNS, GRATITUDE_PATTERNS, QUESTION_PATTERNS)):
+            return None
+
+        intent = matched_intents[0]
+        has_action = self._match_any(ACTION_PATTERNS, normalized)
+        has_trip_detail = intent == "flight" and self._match_any(TRIP_DETAIL_PATTERNS, normalized)
+        if has_action or has_trip_detail:
+            return intent, 0.95
+        # A bare keyword ("otel") is most likely a request too, but less certain
+        return intent, 0.8
+
+    def predict(self, text):
+        """Returns (label, confidence) for the text (label is one of the intents or "chat")."""
+        prediction = self._rule_prediction(text)
+
+        if self.model is not None:
+            probabilities = self.model.predict_proba([text])[0]
+            label = max(probabilities, key=probabilities.get)
+            # The model overrides the rules only when it's more confident
+            if prediction is None or probabilities[label] > prediction[1]:
+                prediction = (label, probabilities[label])
+
+        return prediction or (CHAT_LABEL, 0.0)
+
+    def classify(self, text):
+        """Returns the intent to route the input to without the llm, or None if the llm should decide."""
+        start_time = time.perf_counter()
+        label, confidence = self.predict(text)
+        intent = label if label in INTENTS and confidence >= self.threshold else None
+
+        self._record(calls=1, latency_total=time.perf_counter() - start_time, fast_path=int(intent is not None and not SHADOW_MODE), llm_fallbacks=int(intent is None or SHADOW_MODE))
+        return intent
+
+    def record_llm_decision(self, text, predicted_intent, llm_output):
+        """Records the llm's decision on a user turn (compared with the classifier's prediction in shadow mode, and logged as training data)."""
+        llm_label = llm_output.get("travel_output", {}).get("intent", CHAT_LABEL)
+
+        if SHADOW_MODE and predicted_intent is not None:
+            self._record(shadow_compared=1, shadow_agreed=int(predicted_intent == llm_label))
+
+        if TURN_LOG_PATH:
+            with self._lock, open(TURN_LOG_PATH, "a", encoding="utf-8") as file:
+                file.write(json.dumps({"text": text, "label": llm_label}, ensure_ascii=False) + "\n")
+
+    def _record(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def get_stats(self):
+        """Returns a snapshot of the metrics, with the fast path rate, mean latency and the shadow mode precision."""
+        with self._lock:
+            stats = dict(self.stats)
+
+        stats["fast_path_rate"] = stats["fast_path"] / stats["calls"] if stats["calls"] else None
+        stats["latency_mean_ms"] = 1000 * stats["latency_total"] / stats["calls"] if stats["calls"] else None
+        stats["shadow_precision"] = stats["shadow_agreed"] / stats["shadow_compared"] if stats["shadow_compared"] else None
+        return stats
+
+    def evaluate(self, texts, labels):
+        """Measures the classifier on labeled turns: precision and coverage of the fast path, and mean latency per input."""
+        start_time = time.perf_counter()
+        routed = correct = 0
+        for text, label in zip(texts, labels):
+            predicted, confidence = self.predict(text)
+            if predicted in INTENTS and confidence >= self.threshold:
+                routed += 1
+                correct += int(predicted == label)
+
+        return {
+            "turns": len(texts),
+            "routed": routed,
+            "precision": correct / routed if routed else None,
+            "coverage": routed / len(texts) if texts else None,
+            "latency_mean_ms": 1000 * (time.perf_counter() - start_time) / len(texts) if texts else None,
+        }
+# -----------------------------------------------------------------------------------
+
+
+intent_classifier = IntentClassifier(model=NaiveBayesIntentModel.from_jsonl(TRAINING_DATA_PATH) if TRAINING_DATA_PATH else None)
+
+
+
+
+if __name__ == "__main__":
+
+    # Evaluate on a labeled jsonl file if given (python intent_classifier.py turns.jsonl), otherwise on a few examples
+    import sys
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as file:
+            turns = [json.loads(line) for line in file if line.strip()]
+    else:
+        turns = [
+            {"text": "İstanbul'dan Ankara'ya uçak bileti", "label": "flight"},
+            {"text": "Yarın İzmir'e uçmak istiyorum", "label": "flight"},
+            {"text": "Antalya'da otel rezervasyonu yapmak istiyorum", "label": "hotel"},
+            {"text": "Araç kiralamak istiyorum", "label": "car"},
+            {"text": "Merhaba, nasılsın?", "label": "chat"},
+            {"text": "Uçak bileti istemiyorum, otel bakıyorum", "label": "hotel"},
+            {"text": "Uçak ve otel ayarlamam lazım", "label": "chat"},
+            {"text": "Otel var mı?", "label": "chat"},
+            {"text": "Uçak biletimi aldım, teşekkürler", "label": "chat"},
+            {"text": "Oteli ayırttım, sağol", "label": "chat"},
+        ]
+
+    for turn in turns:
+        print(f"{turn['text']!r} -> {intent_classifier.predict(turn['text'])} (fast path: {intent_classifier.classify(turn['text'])})")
+
+    print(intent_classifier.evaluate([turn["text"] for turn in turns], [turn["label"] for turn in turns]))
@@ -1,6 +1,15 @@
 import os
+import sys
+import uuid
+import asyncio
 from langchain_core.messages import HumanMessage
-from travel_graph import travel_graph
+from travel_graph import get_travel_graph, get_initial_state
+from common.human_io import console_io
+from common.graph_utils import draw_graph_image
+from common.streaming import ResponseStreamer, streaming_stats
+from common.tracing import tracer
+from common.metrics import registry, active_sessions, metrics_callbacks
+from flight_assistant.escalation_outbox import get_escalation_outbox
 
 class TravelAssistant:
     def __init__(self, travel_graph, config):
@@ -8,27 +17,19 @@ class TravelAssistant:
         self.config = config
 
     def generate_graph_image(self):
+        # Generate the graph image and save it to the current file's directory (only rendered again once the graph changes)
+        image_path = os.path.join(os.path.dirname(__file__), "travel_graph.png")
         try:
-            # Generate the graph image and save it to the current file's directory
-            image_path = os.path.join(os.path.dirname(__file__), "travel_graph.png")
-            self.travel_graph.get_graph().draw_mermaid_png(output_file_path=image_path)
-        except Exception:
-            pass
+            rendered = draw_graph_image(self.travel_graph, image_path)
+            print(f"Graph image {'written to' if rendered else 'is up to date:'} {image_path}")
+        except Exception as e:
+            print(f"Couldn't render the graph image: {e}")
         
 
     def start_chat(self):
 
-        self.generate_graph_image()
-
         # Create initial state
-        initial_state = {
-            "messages": [],
-            "travel_messages": [],
-            "intent": None,
-            "flight_state": None,
-            "initial": True,
-            "new": True
-        }
+        initial_state = get_initial_state()
 
         # Enter the conversation loop
         initialization = True
@@ -46,45 +47,203 @@ class TravelAssistant:
                 initialization = False
             # At later steps
             else:
+                # Merge the checkpointed state over the initial values (fields set to None aren't restored from the checkpoint,
+                # so they must fall back to None instead of keeping their values from previous steps)
                 graph_state = self.travel_graph.get_state(self.config).values
-                state = {**state, **graph_state}
+                state = {**initial_state, **graph_state}
 
 
-            # Invoke the graph with the user input and get the stream of responses
+            # Invoke the graph with the user input and get the stream of llm tokens (messages) and node updates
             stream = self.travel_graph.stream(
                 input={**state, "messages": [HumanMessage(content=user_input)]},
                 config=self.config,
-                stream_mode="updates"
+                stream_mode=["messages", "updates"]
             )
 
-            # For every step (a node's execution and its corresponding updates in the state) in the stream
-            for step in stream:
-
+            # Print the responses token by token as they are generated
+            streamer = ResponseStreamer()
+            streaming_response = False
+            for mode, payload in stream:
+
+                # A chunk of an llm output
+                if mode == "messages":
+                    chunk, metadata = payload
+                    text = streamer.feed(chunk, metadata)
+                    if text is not None:
+                        if not streaming_response:
+                            print("\nAssistant: ", end="")
+                            streaming_response = True
+                        print(text, end="", flush=True)
+                    continue
+
+                # A step (a node's execution and its corresponding updates in the state)
                 # For every state dictionary delta (dictionary of updated fields and update values)
-                for state_delta in step.values():
+                for state_delta in payload.values():
 
                     # If there is an update to the messages field in the state
                     if (state_delta is not None) and ("messages" in state_delta):
                         # For every message in the list of message updates
                         for message in state_delta["messages"]:
-                            # If the message is an ai response and contains content (not a tool call), print it back to the user
+                            # If the message is an ai response and contains content (not a tool call), print it back to the user (unless it was already streamed)
                             if message.type == "ai" and message.content != "":
-                                print(f"\nAssistant: {message.content}")
+                                if streamer.is_streamed(message.content):
+                                    print()
+                                    streaming_response = False
+                                else:
+                                    print(f"\nAssistant: {message.content}")
+
+            streaming_stats.record(streamer)
+
+
+
+
+class AsyncTravelAssistant:
+    """Asyncio host that serves many chat sessions (keyed by thread_id) concurrently over the same travel graph.
+
+    Each session has its own config (user info and the channel to talk to the user) and runs one turn at a time,
+    while the turns of different sessions interleave on the event loop.
+    """
+
+    def __init__(self, travel_graph):
+        self.travel_graph = travel_graph
+        # Sessions keyed by thread_id
+        self.sessions = {}
+
+    def create_session(self, thread_id, user_info, session_io=None, metadata=None):
+        # Create a config object with the session's thread_id for memory tracking, and other runtime information (user and the channel to talk to the user)
+        config = {
+            "configurable": {
+                "thread_id": thread_id,
+                "user": user_info,
+                "session_io": session_io or console_io,
+            },
+            # Recorded in the metadata of every checkpoint of the conversation (e.g. the hash of its session token, see server.py)
+            "metadata": metadata or {},
+            # Tracing and metrics callbacks, inherited by the flight subgraph, llm calls and tools
+            "callbacks": [*tracer.callbacks(), *metrics_callbacks()],
+        }
+        self.sessions[thread_id] = {"config": config, "lock": asyncio.Lock()}
+        active_sessions.set(len(self.sessions))
+
+        return config
+
+    async def athread_metadata(self, thread_id):
+        """Returns the metadata of the conversation's latest checkpoint, or None if the conversation has no checkpoints yet."""
+        snapshot = await self.travel_graph.aget_state({"configurable": {"thread_id": thread_id}})
+        if snapshot.created_at is None:
+            return None
+        return snapshot.metadata or {}
+
+    def close_session(self, thread_id):
+        self.sessions.pop(thread_id, None)
+        active_sessions.set(len(self.sessions))
+
+    async def stream_turn(self, thread_id, user_input):
+        """Runs one turn of the session's conversation and yields the assistant responses as they are produced.
+
+        Yields (kind, text) tuples: ("token", new text of a response being generated), ("streamed_message", complete
+        text of a response whose tokens were yielded) and ("message", complete text of a response that wasn't streamed).
+        """
+        session = self.sessions[thread_id]
+
+        # Turns of the same session run one at a time
+        async with session["lock"]:
+            # Merge the checkpointed state over the initial values (same as the sync chat loop). A new conversation has no
+            # checkpoints yet and starts from the initial state, while a reopened one (e.g. parked until a manager's approval)
+            # continues from where it was left
+            graph_state = (await self.travel_graph.aget_state(session["config"])).values
+            state = {**get_initial_state(), **graph_state}
+
+            # Run the graph asynchronously with the user input and get the stream of llm tokens (messages) and node updates
+            stream = self.travel_graph.astream(
+                input={**state, "messages": [HumanMessage(content=user_input)]},
+                config=session["config"],
+                stream_mode=["messages", "updates"]
+            )
+
+            streamer = ResponseStreamer()
+            async for mode, payload in stream:
+
+                # A chunk of an llm output, yield the new text of the response being generated
+                if mode == "messages":
+                    text = streamer.feed(*payload)
+                    if text is not None:
+                        yield "token", text
+                    continue
+
+                # A step (a node's execution and its corresponding updates in the state)
+                for state_delta in payload.values():
+                    # If there is an update to the messages field in the state
+                    if (state_delta is not None) and ("messages" in state_delta):
+                        for message in state_delta["messages"]:
+                            # If the message is an ai response and contains content (not a tool call), yield it back to the user
+                            if message.type == "ai" and message.content != "":
+                                yield ("streamed_message" if streamer.is_streamed(message.content) else "message"), message.content
+
+            streaming_stats.record(streamer)
+
+    async def send_message(self, thread_id, user_input):
+        """Runs one turn of the session's conversation and returns the assistant responses."""
+        return [text async for kind, text in self.stream_turn(thread_id, user_input) if kind != "token"]
+
+    async def start_chat(self, thread_id, user_info):
+        """Terminal chat loop for a single session, running on the async host."""
+        self.create_session(thread_id, user_info)
+
+        while True:
+            user_input = (await asyncio.to_thread(input, "\nUser: ")).strip()
+            if user_input.lower() in ["exit", "quit"]:
+                print("Goodbye!")
+                break
+
+            streaming_response = False
+            async for kind, text in self.stream_turn(thread_id, user_input):
+                if kind == "token":
+                    if not streaming_response:
+                        print("\nAssistant: ", end="")
+                        streaming_response = True
+                    print(text, end="", flush=True)
+                elif kind == "streamed_message":
+                    print()
+                    streaming_response = False
+                else:
+                    print(f"\nAssistant: {text}")
+
+        self.close_session(thread_id)
 
 
 
 if __name__ == "__main__":
 
     # Create a config object with a unique thread_id for memory tracking, and other runtime information (user/session etc.)
+    # (the checkpoints are kept on disk by default, so every run starts a new conversation)
     manager_info = {"name": "Ali", "id":12345678910, "email": "ali@langgraph.com"}
     user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager": manager_info}
     config = {
         "configurable": {
-            "thread_id": 1,
+            "thread_id": uuid.uuid4().hex,
             "user": user_info,
-        }
+        },
+        "callbacks": [*tracer.callbacks(), *metrics_callbacks()],
     }
 
-    travel_assistant = TravelAssistant(travel_graph, config)
+    travel_graph = get_travel_graph()
+
+    # Render the graph image with "--draw-graph" and exit (it needs network access to mermaid.ink, so it isn't done on every start)
+    if "--draw-graph" in sys.argv:
+        TravelAssistant(travel_graph, config).generate_graph_image()
+        sys.exit()
+
+    # Write the metrics to a file periodically if METRICS_DUMP_PATH is set
+    registry.start_file_dump()
+    # Deliver the manager escalations in the background (including the ones left over by an earlier run)
+    get_escalation_outbox().start_dispatcher()
+
+    # Run the chat on the async host with "--async"
+    if "--async" in sys.argv:
+        async_travel_assistant = AsyncTravelAssistant(travel_graph)
+        asyncio.run(async_travel_assistant.start_chat(config["configurable"]["thread_id"], user_info))
+    else:
+        travel_assistant = TravelAssistant(travel_graph, config)
 
-    travel_assistant.start_chat()
\ No newline at end of file
+        travel_assistant.start_chat()
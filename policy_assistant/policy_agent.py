@@ -1,36 +1,22 @@
 import os
-# import sys
-# sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
-from dotenv import load_dotenv
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import threading
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
+from common.llm_provider import get_chat_model
+from common.prompts import register_prompt
+
 from typing import Optional
 from typing_extensions import Annotated, TypedDict
 
-# Load api key from .env file
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-
-# Initialize gpt-4o-mini model
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.1,
-    max_tokens=500,
-    timeout=None,
-    max_retries=2,
-    openai_api_key=openai_api_key
-    )
-
 class PolicyReport(TypedDict):
     """Result of checking user-provided flight information against company policy."""
 
     complies: Annotated[bool, ..., "Whether the flight information complies with the company policy (True), or violates it (False)."]
     details: Annotated[Optional[str], None, "Further explanation (strictly in Turkish) on the exact aspect(s) of the company policy that the flight information violates."]
 
-structured_llm = llm.with_structured_output(PolicyReport)
-
 system_message = """You are a policy checking assistant. Your sole responsibility is to check if the flight information provided by the user complies with the company policy, or if it violates any of the policy rules.
 
 The current policy of the company comprises of 2 rules, which are as follows:
@@ -76,12 +62,43 @@ user_input: {{"airline": "AJet", "departure_time": "18:15", "arrival_time": "19:
 assistant_output: {{"complies": False, "details": "- 2000 TL'den pahali ucuslar secilemez, izin verilen en yuksek fiyat 2000 TL'dir.\n- 'Business' class ucuslar secilemez, sadece 'Economy' class ucuslar secilebilir."}}
 """
 
+# The long few-shot block is part of the static prefix, only the flight information of the human message changes between the calls
+policy_prefix = register_prompt("policy", 1, system_message)
+
 prompt = ChatPromptTemplate.from_messages([
     ("system", system_message), 
     ("human", "{input}")
     ])
 
-policy_llm = prompt | structured_llm
+
+# -----------------------------------------------------------------------------------
+# The model and the chain are created on first use (see travel_agent.py)
+
+def create_policy_llm():
+    """Creates the policy checking chain, which outputs a PolicyReport."""
+    # Initialize gpt-4o-mini model (or the fake model of the configured llm provider)
+    llm = get_chat_model(
+        "policy",
+        model="gpt-4o-mini",
+        temperature=0.1,
+        max_tokens=500,
+        max_retries=2,
+        openai_api_key=os.getenv("OPENAI_API_KEY")
+        )
+
+    return (prompt | llm.with_structured_output(PolicyReport)).with_config(metadata=policy_prefix.metadata)
+
+
+_policy_llm = None
+_policy_llm_lock = threading.Lock()
+
+def get_policy_llm():
+    global _policy_llm
+    with _policy_llm_lock:
+        if _policy_llm is None:
+            _policy_llm = create_policy_llm()
+    return _policy_llm
+# -----------------------------------------------------------------------------------
 
 
 
@@ -94,6 +111,7 @@ if __name__ == "__main__":
 
     print("\n---------------------------------------\n")
 
+    policy_llm = get_policy_llm()
     for example in examples:
         policy_result = policy_llm.invoke({"input":example})
         print(f"User input:\n{example}\n\nPolicy result:\n{policy_result}\n\nPolicy result type:\n{type(policy_result)}\n\nPolicy result details:\n{(policy_result["details"])}\n\n---------------------------------------\n\n")
@@ -0,0 +1,411 @@
+import os
+import sys
+import hmac
+import json
+import uuid
+import hashlib
+import secrets
+import asyncio
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from main import AsyncTravelAssistant
+from approval_service import ApprovalService
+from travel_graph import get_travel_graph
+from common.human_io import QueueIO
+from common.metrics import registry
+from flight_assistant.escalation_outbox import get_escalation_outbox
+
+
+# -----------------------------------------------------------------------------------
+# HTTP front-end that serves many chat sessions from one process (stdlib asyncio, no web framework needed).
+#
+# Endpoints (request and response bodies are JSON):
+#   POST   /sessions                      {"user": {...}}     -> {"thread_id": ..., "session_token": ...}  (with "thread_id" in the body, reopens an
+#                                                              earlier conversation from its checkpoints)
+#   POST   /sessions/<thread_id>/messages {"message": "..."}  -> stream of events until the turn ends or asks the user a question
+#   POST   /sessions/<thread_id>/answer   {"answer": "..."}   -> delivers the answer to the pending question and streams the rest of the turn
+#   GET    /sessions/<thread_id>/events                        -> streams the remaining events of the turn (e.g. after the client was disconnected)
+#   DELETE /sessions/<thread_id>                               -> closes the session
+#   GET    /health                                             -> server load
+#   GET    /metrics                                            -> metrics in the Prometheus text format
+#   GET    /escalations/<id>                                   -> manager escalation and its delivery / decision state
+#   POST   /escalations/<id>/decision {"approved": true/false, "note": "..."} -> records the manager's decision on a delivered escalation,
+#                                                              and resumes the parked session in the background (see approval_service.py)
+# The /sessions/<thread_id> endpoints, and reopening a conversation, need "Authorization: Bearer <session_token>" with the
+# random token returned when the session was created (only its hash is kept, in the conversation's checkpoints).
+# The escalation endpoints need "Authorization: Bearer <token>" with the decision token of the escalation (sent to the
+# manager in the mail, see flight_assistant/escalation_outbox.py) or the admin token APPROVAL_API_TOKEN.
+#
+# Streamed responses use chunked transfer encoding with one JSON event per line (NDJSON):
+#   {"type": "notice", "text": ...}    status text (searching flights, purchasing ticket etc.)
+#   {"type": "token", "text": ...}     next piece of an assistant response being generated (followed by the complete "message")
+#   {"type": "message", "text": ...}   assistant response
+#   {"type": "question", "text": ...}  the turn is paused until the user answers it with the answer endpoint
+#   {"type": "done"}                   the turn is finished
+#   {"type": "error", "text": ...}     the turn failed
+
+# Maximum number of turns running at the same time (turns waiting for the user's answer count as running)
+MAX_CONCURRENT_TURNS = int(os.getenv("SERVER_MAX_CONCURRENT_TURNS", 32))
+# Maximum number of turns waiting for a free slot, further requests are rejected with 503 (backpressure)
+MAX_QUEUED_TURNS = int(os.getenv("SERVER_MAX_QUEUED_TURNS", 64))
+# Maximum number of seconds a turn waits in the queue for a free slot before it's rejected
+QUEUE_TIMEOUT = float(os.getenv("SERVER_QUEUE_TIMEOUT", 30))
+# Maximum duration of a turn (including waiting for the user's answers), after which it's cancelled and its slot is freed
+TURN_TIMEOUT = float(os.getenv("SERVER_TURN_TIMEOUT", 900))
+# Maximum number of open sessions
+MAX_SESSIONS = int(os.getenv("SERVER_MAX_SESSIONS", 1000))
+# Maximum size of a request body in bytes
+MAX_BODY_SIZE = 64 * 1024
+# Admin token that can read and decide on any escalation (unset: only the decision tokens of the escalations are accepted)
+APPROVAL_API_TOKEN = os.getenv("APPROVAL_API_TOKEN")
+# -----------------------------------------------------------------------------------
+
+
+class HTTPError(Exception):
+    """Error that is returned to the client with the given status code."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def bearer_token(headers):
+    """Returns the token of the request's "Authorization: Bearer <token>" header, or None."""
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def public_escalation(escalation):
+    """An escalation as it's returned by the server (without its decision token)."""
+    return {key: value for key, value in escalation.items() if key != "decision_token"}
+
+
+class TravelAssistantServer:
+    """Serves the travel assistant to many users over HTTP, running their sessions concurrently on one event loop."""
+
+    def __init__(self, travel_graph, max_concurrent_turns=MAX_CONCURRENT_TURNS, max_queued_turns=MAX_QUEUED_TURNS):
+        self.assistant = AsyncTravelAssistant(travel_graph)
+        # The running turn (task) of each session, keyed by thread_id
+        self.turns = {}
+        # Limits the number of running turns, and the number of turns waiting for a slot
+        self.turn_slots = asyncio.Semaphore(max_concurrent_turns)
+        self.max_queued_turns = max_queued_turns
+        self.queued_turns = 0
+        # Resumes the sessions parked by manager escalations once the managers decide
+        self.approvals = ApprovalService(travel_graph, assistant=self.assistant)
+
+    # -------------------------------------------------------------------------------
+    # Sessions and turns
+
+    async def create_session(self, user_info, thread_id=None, token=None):
+        """Opens a session and returns (thread_id, session token). A conversation that has checkpoints can only be reopened
+        with its session token, which it keeps."""
+        if len(self.assistant.sessions) >= MAX_SESSIONS:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many open sessions")
+        if thread_id in self.assistant.sessions:
+            raise HTTPError(HTTPStatus.CONFLICT, f"The session is already open: {thread_id}")
+
+        # A closed session can be reopened with its thread_id, and continues from its checkpoints (their metadata keeps
+        # the hash of the session token; conversations whose checkpoints don't can't be reopened)
+        session_token = None
+        if thread_id is not None:
+            metadata = await self.assistant.athread_metadata(thread_id)
+            if metadata is not None:
+                expected = metadata.get("session_token_hash")
+                if token is None or not expected or not hmac.compare_digest(token_hash(token), expected):
+                    raise HTTPError(HTTPStatus.FORBIDDEN, "A valid session token is required to reopen the conversation")
+                session_token = token
+            # Another request may have opened the session while the checkpoints were read
+            if thread_id in self.assistant.sessions:
+                raise HTTPError(HTTPStatus.CONFLICT, f"The session is already open: {thread_id}")
+
+        # Every session talks to its user through its own queue of events
+        thread_id = thread_id or uuid.uuid4().hex
+        session_token = session_token or secrets.token_urlsafe(32)
+        self.assistant.create_session(thread_id, user_info, session_io=QueueIO(), metadata={"session_token_hash": token_hash(session_token)})
+
+        return thread_id, session_token
+
+    def get_session(self, thread_id):
+        if thread_id not in self.assistant.sessions:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown session: {thread_id}")
+        return self.assistant.sessions[thread_id]
+
+    def authorize_session(self, thread_id, headers):
+        """Raises 404 if the session isn't open, or 403 unless the request carries its session token."""
+        expected = self.get_session(thread_id)["config"]["metadata"]["session_token_hash"]
+        token = bearer_token(headers)
+        if token is None or not hmac.compare_digest(token_hash(token), expected):
+            raise HTTPError(HTTPStatus.FORBIDDEN, "A valid session token is required for the session")
+
+    def get_session_io(self, thread_id):
+        return self.get_session(thread_id)["config"]["configurable"]["session_io"]
+
+    def close_session(self, thread_id):
+        # Stop the running turn (and the node waiting for the user's answer, if any)
+        self.get_session_io(thread_id).cancel()
+        turn = self.turns.pop(thread_id, None)
+        if turn is not None:
+            turn.cancel()
+        self.assistant.close_session(thread_id)
+
+    async def acquire_turn_slot(self):
+        """Waits for a free turn slot, or raises 503 if too many turns are already waiting (backpressure)."""
+        if self.turn_slots.locked() and self.queued_turns >= self.max_queued_turns:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is busy, try again later")
+
+        self.queued_turns += 1
+        try:
+            await asyncio.wait_for(self.turn_slots.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is busy, try again later")
+        finally:
+            self.queued_turns -= 1
+
+    async def run_turn(self, thread_id, user_input):
+        """Runs one turn of the session in the background, sending its responses to the session's queue."""
+        session_io = self.get_session_io(thread_id)
+
+        async def consume():
+            async for kind, text in self.assistant.stream_turn(thread_id, user_input):
+                if kind == "token":
+                    session_io.send_token(text)
+                else:
+                    session_io.send_message(text)
+
+        try:
+            await asyncio.wait_for(consume(), TURN_TIMEOUT)
+            session_io.events.put_nowait(("done", None))
+        except asyncio.TimeoutError:
+            session_io.cancel()
+            session_io.events.put_nowait(("error", "The turn timed out"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            session_io.events.put_nowait(("error", f"{type(e).__name__}: {e}"))
+
+    def finish_turn(self, thread_id, task):
+        """Frees the slot of a turn once its task is done (finished, failed or cancelled)."""
+        self.turn_slots.release()
+        if self.turns.get(thread_id) is task:
+            del self.turns[thread_id]
+
+    async def start_turn(self, thread_id, user_input):
+        session_io = self.get_session_io(thread_id)
+        # A session runs one turn at a time
+        if thread_id in self.turns:
+            raise HTTPError(HTTPStatus.CONFLICT, "The previous message of the session is still being processed")
+
+        await self.acquire_turn_slot()
+        # The session may have been closed while this message was waiting for a slot
+        if thread_id not in self.assistant.sessions:
+            self.turn_slots.release()
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown session: {thread_id}")
+        # Another message of the session may have started a turn while this one was waiting for a slot
+        if thread_id in self.turns:
+            self.turn_slots.release()
+            raise HTTPError(HTTPStatus.CONFLICT, "The previous message of the session is still being processed")
+        # Events of the previous turn that its client didn't read anymore are dropped
+        session_io.clear()
+        task = asyncio.create_task(self.run_turn(thread_id, user_input))
+        self.turns[thread_id] = task
+        # The slot is freed by a callback of the task rather than by run_turn, so that it's also freed when the task is
+        # cancelled before it starts running (e.g. the session is closed right after the message)
+        task.add_done_callback(lambda task: self.finish_turn(thread_id, task))
+
+    def answer_question(self, thread_id, answer):
+        session_io = self.get_session_io(thread_id)
+        if not session_io.answer(answer):
+            raise HTTPError(HTTPStatus.CONFLICT, "The session has no question waiting for an answer")
+    # -------------------------------------------------------------------------------
+
+
+    # -------------------------------------------------------------------------------
+    # HTTP handling
+
+    async def handle_connection(self, reader, writer):
+        """Handles one HTTP request per connection."""
+        try:
+            try:
+                method, path, headers, body = await self.read_request(reader)
+                await self.route(method, path, headers, body, writer)
+            except HTTPError as e:
+                await self.send_json(writer, e.status, {"error": e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away, the running turn continues and its remaining events can be streamed with the events endpoint
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Reads the request line, headers and body of an HTTP request."""
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request")
+        method, target, _ = request_line
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        content_length = int(headers.get("content-length", 0) or 0)
+        if content_length > MAX_BODY_SIZE:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body is too large")
+
+        body = {}
+        if content_length:
+            try:
+                body = json.loads(await reader.readexactly(content_length))
+            except json.JSONDecodeError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Request body must be JSON")
+            if not isinstance(body, dict):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object")
+
+        return method.upper(), urlsplit(target).path, headers, body
+
+    def authorize_escalation(self, escalation, headers):
+        """Raises 403 unless the request carries the escalation's decision token or the admin token."""
+        token = bearer_token(headers)
+        tokens = [escalation["decision_token"], APPROVAL_API_TOKEN]
+        if token is None or not any(expected and hmac.compare_digest(token, expected) for expected in tokens):
+            raise HTTPError(HTTPStatus.FORBIDDEN, "A valid decision token is required for the escalation")
+
+    async def route(self, method, path, headers, body, writer):
+        parts = [part for part in path.split("/") if part]
+
+        if method == "GET" and parts == ["health"]:
+            await self.send_json(writer, HTTPStatus.OK, {
+                "sessions": len(self.assistant.sessions),
+                "running_turns": len(self.turns),
+                "queued_turns": self.queued_turns,
+            })
+
+        elif method == "GET" and parts == ["metrics"]:
+            body = registry.render().encode()
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+
+        elif method == "POST" and parts == ["sessions"]:
+            user_info = body.get("user")
+            if not isinstance(user_info, dict) or not all(key in user_info for key in ("name", "id", "email")):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'user' must contain 'name', 'id' and 'email'")
+            thread_id = body.get("thread_id")
+            if not (thread_id is None or (isinstance(thread_id, str) and thread_id)):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'thread_id' must be a non-empty string")
+            thread_id, session_token = await self.create_session(user_info, thread_id, bearer_token(headers))
+            await self.send_json(writer, HTTPStatus.CREATED, {"thread_id": thread_id, "session_token": session_token})
+
+        elif method == "DELETE" and len(parts) == 2 and parts[0] == "sessions":
+            self.authorize_session(parts[1], headers)
+            self.close_session(parts[1])
+            await self.send_json(writer, HTTPStatus.OK, {"thread_id": parts[1]})
+
+        elif method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+            message = body.get("message")
+            if not isinstance(message, str) or not message.strip():
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'message' must be a non-empty string")
+            self.authorize_session(parts[1], headers)
+            await self.start_turn(parts[1], message.strip())
+            await self.stream_events(writer, parts[1])
+
+        elif method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "answer":
+            answer = body.get("answer")
+            if not isinstance(answer, str):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'answer' must be a string")
+            self.authorize_session(parts[1], headers)
+            self.answer_question(parts[1], answer.strip())
+            await self.stream_events(writer, parts[1])
+
+        elif method == "GET" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "events":
+            self.authorize_session(parts[1], headers)
+            session_io = self.get_session_io(parts[1])
+            if parts[1] not in self.turns and session_io.events.empty():
+                raise HTTPError(HTTPStatus.CONFLICT, "The session has no running turn")
+            await self.stream_events(writer, parts[1])
+
+        elif method == "GET" and len(parts) == 2 and parts[0] == "escalations" and parts[1].isdigit():
+            escalation = get_escalation_outbox().get(int(parts[1]))
+            if escalation is None:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"Escalation {parts[1]} not found")
+            self.authorize_escalation(escalation, headers)
+            await self.send_json(writer, HTTPStatus.OK, public_escalation(escalation))
+
+        elif method == "POST" and len(parts) == 3 and parts[0] == "escalations" and parts[1].isdigit() and parts[2] == "decision":
+            approved = body.get("approved")
+            note = body.get("note")
+            if not isinstance(approved, bool) or not (note is None or isinstance(note, str)):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'approved' must be a boolean and 'note' a string")
+            outbox = get_escalation_outbox()
+            escalation = outbox.get(int(parts[1]))
+            if escalation is None:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"Escalation {parts[1]} not found")
+            self.authorize_escalation(escalation, headers)
+            escalation = outbox.record_decision(int(parts[1]), approved, note)
+            if escalation is None:
+                raise HTTPError(HTTPStatus.CONFLICT, "The escalation isn't waiting for a decision")
+            # Resume the parked session with the decision
+            self.approvals.wake.set()
+            await self.send_json(writer, HTTPStatus.OK, public_escalation(escalation))
+
+        else:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No endpoint for {method} {path}")
+
+    async def stream_events(self, writer, thread_id):
+        """Streams the session's events to the client until the turn ends or pauses for the user's answer."""
+        events = self.get_session_io(thread_id).events
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        while True:
+            kind, text = await events.get()
+            event = {"type": kind} if text is None else {"type": kind, "text": text}
+            chunk = json.dumps(event, ensure_ascii=False).encode() + b"\n"
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            # Wait for slow clients to read before producing more (backpressure on the socket buffer)
+            await writer.drain()
+
+            if kind in ("question", "done", "error"):
+                break
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def send_json(self, writer, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    # -------------------------------------------------------------------------------
+
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        # Resume the parked sessions whose escalations are decided (including the ones decided while the server was down)
+        self.approval_task = asyncio.create_task(self.approvals.run())
+        self.approvals.wake.set()
+        print(f"Travel assistant server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+
+if __name__ == "__main__":
+
+    host = os.getenv("SERVER_HOST", "127.0.0.1")
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("SERVER_PORT", 8000))
+
+    server = TravelAssistantServer(get_travel_graph())
+    registry.start_file_dump()
+    get_escalation_outbox().start_dispatcher()
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
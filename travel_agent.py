@@ -1,29 +1,20 @@
 import os
-from dotenv import load_dotenv
+import threading
 
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 
 from typing import Optional, Literal, Union
 from typing_extensions import Annotated, TypedDict
 
+from common.llm_provider import get_chat_model
+from common.context_manager import ContextManager, get_context_budget, make_llm_summarizer, make_async_llm_summarizer
+from common.streaming import STREAM_TRAVEL_OUTPUT_TAG
+from common.llm_cache import with_response_cache
+from common.prompts import register_prompt
+
 # import sys
 # sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
 
-# Load api key from .env file
-load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-
-# Initialize gpt-4o-mini model
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.1,
-    max_tokens=500,
-    timeout=None,
-    max_retries=2,
-    openai_api_key=openai_api_key
-    )
-
 class UserIntent(TypedDict):
     """Intent of the user showing which action to take next about planning their trip."""
 
@@ -40,9 +31,6 @@ class TravelOutput(TypedDict):
     travel_output: Annotated[Union[ChatResponse, UserIntent], ..., "Output of the travel assistant to the user input as a normal response or a specific intent."]
 
 
-structured_llm = llm.with_structured_output(TravelOutput)
-
-
 system_message = """You are a travel assistant at the entry point of a system that is capable of helping users with their flight bookings, car rentals and hotel reservations. Your main responsibility is to understand the user's intent and guide them to the appropriate part of the system, where further assistance on the specific needs of the user will be provided. You should keep a normal, human-like conversation until you understand the user's intent. Once the user's intent is clear and you're confident about guiding them to the right part of the system, you should output a structured response that is one of the 3 string literals:
 1. "flight": If the user wants to proceed with flight booking.
 2. "car": If the user wants to proceed with car rental.
@@ -55,12 +43,59 @@ Besides your main responsibility, you should also follow these guidelines:
 - Assume the users are Turkish. So please give your conversational responses in Turkish.
 """
 
+travel_prefix = register_prompt("travel", 1, system_message)
+
 prompt = ChatPromptTemplate.from_messages([
     ("system", system_message), 
     ("placeholder", "{messages}")
     ])
 
-travel_llm = prompt | structured_llm
+
+
+# -----------------------------------------------------------------------------------
+# The model, the chain and the context manager are created on first use rather than at import, since constructing the
+# model client imports the provider's sdk (see common/llm_provider.py) and slows down the start of every entry point that
+# only imports the graph
+
+def create_travel_agent():
+    """Creates the travel llm chain and its context manager."""
+    # Initialize gpt-4o-mini model (or the fake model of the configured llm provider)
+    llm = get_chat_model(
+        "travel",
+        model="gpt-4o-mini",
+        temperature=0.1,
+        max_tokens=500,
+        max_retries=2,
+        openai_api_key=os.getenv("OPENAI_API_KEY")
+        )
+
+    # Tagged so that the "response" field of its structured output is streamed to the user token by token
+    travel_llm = (prompt | llm.with_structured_output(TravelOutput)).with_config(tags=[STREAM_TRAVEL_OUTPUT_TAG], metadata=travel_prefix.metadata)
+    # Serve repeated inputs from the response cache if enabled (the system prompt isn't part of the input messages, so its hash is part of the cache key)
+    travel_llm = with_response_cache(travel_llm, namespace="travel", params={"model": llm.model_name, "temperature": llm.temperature, "max_tokens": llm.max_tokens, "prompt": travel_prefix.hash})
+
+    # Context manager that keeps the travel message history sent to travel_llm within the token budget (older turns are replaced with a rolling summary)
+    travel_context = ContextManager(name="travel", max_tokens=get_context_budget("travel", 3000), summarizer=make_llm_summarizer(llm), asummarizer=make_async_llm_summarizer(llm))
+
+    return travel_llm, travel_context
+
+
+_travel_agent = None
+_travel_agent_lock = threading.Lock()
+
+def _get_travel_agent():
+    global _travel_agent
+    with _travel_agent_lock:
+        if _travel_agent is None:
+            _travel_agent = create_travel_agent()
+    return _travel_agent
+
+def get_travel_llm():
+    return _get_travel_agent()[0]
+
+def get_travel_context():
+    return _get_travel_agent()[1]
+# -----------------------------------------------------------------------------------
 
 
 
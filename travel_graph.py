@@ -1,4 +1,8 @@
 import os
+import sys
+import uuid
+import argparse
+import threading
 
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_core.runnables.config import RunnableConfig
@@ -8,13 +12,18 @@ from typing_extensions import TypedDict, Literal
 
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.types import Command
 
 from flight_assistant.flight_agent import flight_prompt
-from flight_assistant.flight_graph import FlightState, flight_graph
-from flight_assistant.utils import pretty_print_object
-from travel_agent import travel_llm
+from flight_assistant.flight_graph import FlightState, get_flight_graph
+from flight_assistant.compaction import compact_completed_booking
+from flight_assistant.utils import dump_state, pretty_print_object
+from travel_agent import get_travel_llm, get_travel_context
+from intent_classifier import intent_classifier, ENABLED as INTENT_CLASSIFIER_ENABLED, SHADOW_MODE as INTENT_SHADOW_MODE
+from common.graph_utils import add_dual_node, draw_graph_image
+from common.tracing import tracer
+from common.metrics import checkpoint_store_bytes
+from common.checkpoints import create_checkpointer, checkpoint_store_size
 
 
 class TravelState(TypedDict):
@@ -25,98 +34,164 @@ class TravelState(TypedDict):
     initial: bool
     new: bool
 
-def travel_node(state: TravelState) -> Command[Literal["flight_node", "car_node", "hotel_node", "travel_node", END]]:
+def get_initial_state() -> TravelState:
+    # Initial state of a new conversation with the travel assistant
+    return {
+        "messages": [],
+        "travel_messages": [],
+        "intent": None,
+        "flight_state": None,
+        "initial": True,
+        "new": True
+    }
+
+
+# Returns the travel-specific message history to invoke the travel llm with, or None if the travel llm shouldn't be invoked for the current state
+def travel_llm_input(state: TravelState) -> Optional[list]:
+
+    # The travel llm is only invoked during an ongoing conversation with the travel assistant (intent is None)
+    if state["intent"] is not None:
+        return None
+
+    # Retrieve the last message from the state
+    last_message = state["messages"][-1]
+
+    # If the last message is a user message, or a system message from other nodes as an additional context or a directive
+    # (e.g. car rental/hotel reservation is not available, flight booking completed etc.)
+    if last_message.type in ["human", "system"]:
+        # Add it to travel-specific history to keep travel_llm context separate from flight_graph's context
+        return state["travel_messages"] + [last_message]
+
+    return None
+
+# Routing logic of the travel node when the travel llm isn't invoked
+def route_travel_node(state: TravelState) -> Command[Literal["flight_node", "car_node", "hotel_node", END]]:
 
     # If the intent is None (ongoing conversation with travel assistant)
     if state["intent"] is None:
         # Retrieve the last message from the state
         last_message = state["messages"][-1]
 
-        # If the last message is a user message
-        if last_message.type == "human":
-            # # Add the user input to travel-specific history to keep travel_llm context separate from flight_graph's context
-            input_travel_messages = state["travel_messages"] + [last_message]
-    
-            # Then invoke the travel llm with this meesage history
-            output = travel_llm.invoke({"messages": input_travel_messages})
-            # print(type(output))
-            # print(output)
-            # print(output["travel_output"])
-
-            # Even tough I configured the travel_llm to give a structured output in the TravelOutput format, it sometimes gives a simple string response
-            # In that case, I manually wrap the response in a TravelOutput structure to handle it in the same way in the rest of the code and avoid errors
-            if "travel_output" not in output:
-                output_response = output.get("response", output["response"])
-                output = {"travel_output": {"response": output_response}}
-            travel_output = output["travel_output"]
-
-            # If the output includes the user intent
-            if "intent" in travel_output:
-                # Create a synthetic ai message that tells the user that they're being forwarded to the appropriate agent based on their intent
-                intended_agent = {"flight": "ucus arama", "car": "arac kiralama", "hotel": "otel rezervasyonu"}[travel_output["intent"]]
-                ai_response = AIMessage(content=f"Sizi {intended_agent} asistanina yonlendiriyorum.")
-                travel_response = AIMessage(content=f"{output}")
-
-                # Update the state
-                return Command(update={"messages": [ai_response],"travel_messages": [last_message, travel_response], "intent": travel_output["intent"], "new": True}, goto="travel_node")
-
-            # If the output is a chat response
-            else:
-                # Assert that the response is a chat response
-                assert "response" in travel_output
-
-                # Construct the response into an ai message
-                ai_response = AIMessage(content=travel_output["response"])
-                # print(ai_response)
-                travel_response = AIMessage(content=f"{output}")
-                
-                # Update the state
-                return Command(update={"messages": [ai_response], "travel_messages": [last_message, travel_response]}, goto=END)
-
-        # If the last message is a system message
-        elif last_message.type == "system":
-            # Travel node can receive a system message from other nodes as an additional context or a directive
-            # (e.g. car rental/hotel reservation is not available, flight booking completed etc.)
-            # In that case, invoke the travel_llm to make it produce an appropriate ai message that conveys the situation to the user
-            input_travel_messages = state["travel_messages"] + [last_message]
-            output = travel_llm.invoke({"messages": input_travel_messages})
-            travel_output = output["travel_output"]
-
-            # We expect the output after a system message to be a chat response, not an intent decision
-            assert "response" in travel_output
-            ai_response = AIMessage(content=travel_output["response"])
-            travel_response = AIMessage(content=f"{output}")
-
-            # Update the state
-            return Command(update={"messages": [ai_response], "travel_messages": [last_message, travel_response]}, goto=END)
-
         # If the last message is an ai message
-        elif last_message.type == "ai":
+        if last_message.type == "ai":
             # Then the travel node should halt the pipeline (END --> until next user interaction)
             return Command(goto=END)
-        
+
         # If the last message is a tool message
         else:
             # This should never happen as the travel node is not bound to any tool
             # Print current state and raise an exception
-            print("\nUNEXPECTED TOOL MESSAGE IN TRAVEL NODE!\nSTATE DURING EXCEPTION:\n")
-            pretty_print_object(state)
+            dump_state("UNEXPECTED TOOL MESSAGE IN TRAVEL NODE!", state)
             raise Exception("Tool message type in travel node")
 
     # If the intent is "flight"
     elif state["intent"] == "flight":
         return Command(goto="flight_node")
-    
+
     # If the intent is "car"
     elif state["intent"] == "car":
         return Command(goto="car_node")
-    
+
     # If the intent is "hotel"
     else:
         return Command(goto="hotel_node")
 
+# Handles the output of the travel llm
+def travel_output_command(state: TravelState, output: dict) -> Command[Literal["travel_node", END]]:
+    # Retrieve the last message (user or system message that the travel llm responded to) from the state
+    last_message = state["messages"][-1]
+
+    # If the last message is a user message
+    if last_message.type == "human":
+        # Even tough I configured the travel_llm to give a structured output in the TravelOutput format, it sometimes gives a simple string response
+        # In that case, I manually wrap the response in a TravelOutput structure to handle it in the same way in the rest of the code and avoid errors
+        if "travel_output" not in output:
+            output_response = output.get("response", output["response"])
+            output = {"travel_output": {"response": output_response}}
+        travel_output = output["travel_output"]
+
+        # If the output includes the user intent
+        if "intent" in travel_output:
+            # Create a synthetic ai message that tells the user that they're being forwarded to the appropriate agent based on their intent
+            intended_agent = {"flight": "ucus arama", "car": "arac kiralama", "hotel": "otel rezervasyonu"}[travel_output["intent"]]
+            ai_response = AIMessage(content=f"Sizi {intended_agent} asistanina yonlendiriyorum.")
+            travel_response = AIMessage(content=f"{output}")
 
-def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["travel_node", "flight_node", END]]:
+            # Update the state
+            return Command(update={"messages": [ai_response],"travel_messages": [last_message, travel_response], "intent": travel_output["intent"], "new": True}, goto="travel_node")
+
+        # If the output is a chat response
+        else:
+            # Assert that the response is a chat response
+            assert "response" in travel_output
+
+            # Construct the response into an ai message
+            ai_response = AIMessage(content=travel_output["response"])
+            travel_response = AIMessage(content=f"{output}")
+
+            # Update the state
+            return Command(update={"messages": [ai_response], "travel_messages": [last_message, travel_response]}, goto=END)
+
+    # If the last message is a system message
+    else:
+        travel_output = output["travel_output"]
+
+        # We expect the output after a system message to be a chat response, not an intent decision
+        assert "response" in travel_output
+        ai_response = AIMessage(content=travel_output["response"])
+        travel_response = AIMessage(content=f"{output}")
+
+        # Update the state
+        return Command(update={"messages": [ai_response], "travel_messages": [last_message, travel_response]}, goto=END)
+
+# Returns the intent of the user input decided by the local classifier (fast path), or None if the travel llm should decide
+def classify_travel_input(state: TravelState) -> Optional[str]:
+    last_message = state["messages"][-1]
+    # Only user inputs are classified (system messages from other nodes always need an llm response)
+    if not INTENT_CLASSIFIER_ENABLED or last_message.type != "human":
+        return None
+    return intent_classifier.classify(last_message.content)
+
+# Records the travel llm's decision on a user input (to measure the local classifier and collect training data)
+def record_travel_output(state: TravelState, predicted_intent: Optional[str], output: dict) -> None:
+    last_message = state["messages"][-1]
+    if INTENT_CLASSIFIER_ENABLED and last_message.type == "human":
+        intent_classifier.record_llm_decision(last_message.content, predicted_intent, output)
+
+def travel_node(state: TravelState) -> Command[Literal["flight_node", "car_node", "hotel_node", "travel_node", END]]:
+    input_travel_messages = travel_llm_input(state)
+    if input_travel_messages is None:
+        return route_travel_node(state)
+
+    # If the user input is a clear request for one of the assistants, route it without calling the travel llm
+    predicted_intent = classify_travel_input(state)
+    if predicted_intent is not None and not INTENT_SHADOW_MODE:
+        return travel_output_command(state, {"travel_output": {"intent": predicted_intent}})
+
+    # Invoke the travel llm with this meesage history (trimmed to the context budget)
+    output = get_travel_llm().invoke({"messages": get_travel_context().trim(input_travel_messages)})
+    record_travel_output(state, predicted_intent, output)
+    return travel_output_command(state, output)
+
+async def atravel_node(state: TravelState) -> Command[Literal["flight_node", "car_node", "hotel_node", "travel_node", END]]:
+    input_travel_messages = travel_llm_input(state)
+    if input_travel_messages is None:
+        return route_travel_node(state)
+
+    # If the user input is a clear request for one of the assistants, route it without calling the travel llm
+    predicted_intent = classify_travel_input(state)
+    if predicted_intent is not None and not INTENT_SHADOW_MODE:
+        return travel_output_command(state, {"travel_output": {"intent": predicted_intent}})
+
+    # Invoke the travel llm with this meesage history (trimmed to the context budget)
+    output = await get_travel_llm().ainvoke({"messages": await get_travel_context().atrim(input_travel_messages)})
+    record_travel_output(state, predicted_intent, output)
+    return travel_output_command(state, output)
+
+
+# Prepares the input to invoke the flight graph with for the current state
+# Returns a tuple of (flight graph input, None), or (None, command) if the flight graph shouldn't be invoked
+def flight_graph_input(state: TravelState, config: RunnableConfig) -> tuple[Optional[FlightState], Optional[Command[Literal["travel_node", END]]]]:
 
     # If this is the initial entry to the flight node during the whole run of the travel graph
     if state["initial"]:
@@ -137,19 +212,13 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
             "purchased_depart_ticket": None,
             "purchased_return_ticket": None,
             "flight_completed": False,
+            "failed_attempts": 0,
+            "escalation_id": None,
+            "approval_status": None,
         }
 
-        # Invoke the flight graph with the initial state
-        flight_state = flight_graph.invoke(input=initial_state, config=config)
-
-        # Get the last message from the flight state
-        last_message = flight_state["messages"][-1]
-        # We expect the last message to be an ai message that greets the user
-        assert last_message.type == "ai"
+        return initial_state, None
 
-        # Update the state and halt execution (END --> until next user interaction)
-        return Command(update={"messages": [last_message], "flight_state": flight_state, "initial": False, "new": False}, goto=END)
-    
     # If it's not the initial entry to the flight node, but a new round of conversation with the flight assistant
     elif state["initial"] == False and state["new"]:
         # Get the current flight state
@@ -168,20 +237,13 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
             "purchased_depart_ticket": None,
             "purchased_return_ticket": None,
             "flight_completed": False,
+            "failed_attempts": 0,
+            "escalation_id": None,
+            "approval_status": None,
         }
 
+        return new_state, None
 
-        # Invoke the flight graph with the new state
-        flight_state = flight_graph.invoke(new_state, config=config)
-
-        # Get the last message from the flight state
-        last_message = flight_state["messages"][-1]
-        # We expect the last message to be an ai message that greets the user
-        assert last_message.type == "ai"
-
-        # Update the state and halt execution (END --> until next user interaction)
-        return Command(update={"messages": [last_message], "flight_state": flight_state, "new": False}, goto=END)
-    
     # If it's an ongoing conversation with the flight assistant
     else:
         # Get the current flight state
@@ -190,7 +252,7 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
         # If the flight assistant pipeline has been completed
         # It either completes as a result of successful ticket purchase or manager escalation
         if flight_state["flight_completed"]:
-            
+
             # If it's completed with ticket purchase
             if flight_state["purchased_depart_ticket"] is not None:
                 # Assert that the latest tool call was completed
@@ -207,9 +269,9 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
                                   f"\n- Departure ticket: {purchased_depart_ticket}" +
                                   f"\n- Return ticket: {purchased_return_ticket if purchased_return_ticket else 'None'}" +
                                   f"\n\nPlease generate a message that welcomes the user back to the travel assistant. Also, while providing further assistance, take user's trip and ticket details into account. For example, if the user is interested in booking a hotel or renting a car, they may want to align it with their flight dates and destinations.")
-                
-                # Update state and hand the user back to the travel assistant
-                return Command(update={"messages": [SystemMessage(content=handover_message)], "intent": None, "new": True}, goto="travel_node")
+
+                # Update state and hand the user back to the travel assistant (with the booking's conversation compacted into a summary, see flight_assistant/compaction.py)
+                return None, Command(update={"messages": [SystemMessage(content=handover_message)], "flight_state": compact_completed_booking(flight_state, config), "intent": None, "new": True}, goto="travel_node")
 
             # If it's completed with manager escalation
             elif flight_state["selected_depart_flight"] is not None:
@@ -228,13 +290,18 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
                                   f"\n- Departure flight: {selected_depart_flight}" +
                                   f"\n- Return flight: {selected_return_flight if selected_return_flight else 'None'}" +
                                   f"\n\nPlease generate a message that welcomes the user back to the travel assistant. Also, while providing further assistance, take user's trip and selected flight details into account. For example, if the user is interested in booking a hotel or renting a car, they may want to align it with their flight dates and destinations.")
-                
-                # Update state and hand the user back to the travel assistant
-                return Command(update={"messages": [SystemMessage(content=handover_message)], "intent": None, "new": True}, goto="travel_node")
-        
+
+                # Update state and hand the user back to the travel assistant (with the booking's conversation compacted into a summary, see flight_assistant/compaction.py)
+                return None, Command(update={"messages": [SystemMessage(content=handover_message)], "flight_state": compact_completed_booking(flight_state, config), "intent": None, "new": True}, goto="travel_node")
+
         # If the flight assistant pipeline is still ongoing
         else:
-            
+
+            # If the session was resumed with the manager's decision on the escalated flights (see approval_service.py)
+            if flight_state["approval_status"] in ["approved", "rejected"]:
+                # Invoke the flight graph to act on the decision (purchase the tickets or tell the user)
+                return flight_state, None
+
             # Get the last message from the state
             last_message = state["messages"][-1]
 
@@ -244,31 +311,63 @@ def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["
                 flight_state["messages"].append(last_message)
 
                 # Invoke the flight graph with the user input
-                flight_state = flight_graph.invoke(input= flight_state, config=config)
-
-                # Get the last message from the flight state
-                last_flight_message = flight_state["messages"][-1]
-                
-                # If it's an ai response to the user input
-                if last_flight_message.type == "ai":
-                    # Update the state with the ai response and route back to the flight node
-                    return Command(update={"messages": [last_flight_message], "flight_state": flight_state,}, goto="flight_node")
-                else:
-                    # Just update the flight state and route back to the flight node
-                    return Command(update={"flight_state": flight_state}, goto="flight_node")
-                
+                return flight_state, None
+
             # If the last message is an ai message
             elif last_message.type == "ai":
                 # Just halt execution without any updates to state, until the next user input
-                return Command(goto=END)
+                return None, Command(goto=END)
 
             else:
                 # There shouldn't be an entry with a message type other than "human" or "ai" (system, tool) during an ongoing conversation with the flight assistant
                 # Print the current state and raise an exception
-                print(f"\nUNEXPECTED MESSAGE TYPE IN FLIGHT NODE ({last_message.type} -> should only be 'human' or 'ai') DURING ONGOING CONVERSATION!\nSTATE DURING EXCEPTION:\n")
-                pretty_print_object(state)
+                dump_state(f"UNEXPECTED MESSAGE TYPE IN FLIGHT NODE ({last_message.type} -> should only be 'human' or 'ai') DURING ONGOING CONVERSATION!", state)
                 raise Exception(f"Unexpected message type {last_message.type} in flight node")
 
+# Handles the flight state returned by the flight graph
+def flight_graph_output_command(state: TravelState, flight_state: FlightState) -> Command[Literal["flight_node", END]]:
+
+    # If it was a new round of conversation with the flight assistant (initial entry or re-entry)
+    if state["new"]:
+        # Get the last message from the flight state
+        last_message = flight_state["messages"][-1]
+        # We expect the last message to be an ai message that greets the user
+        assert last_message.type == "ai"
+
+        # Update the state and halt execution (END --> until next user interaction)
+        return Command(update={"messages": [last_message], "flight_state": flight_state, "initial": False, "new": False}, goto=END)
+
+    # If it's an ongoing conversation with the flight assistant
+    else:
+        # Get the last message from the flight state
+        last_flight_message = flight_state["messages"][-1]
+
+        # If it's an ai response to the user input
+        if last_flight_message.type == "ai":
+            # Update the state with the ai response and route back to the flight node
+            return Command(update={"messages": [last_flight_message], "flight_state": flight_state,}, goto="flight_node")
+        else:
+            # Just update the flight state and route back to the flight node
+            return Command(update={"flight_state": flight_state}, goto="flight_node")
+
+def flight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["travel_node", "flight_node", END]]:
+    flight_input, command = flight_graph_input(state, config)
+    if command is not None:
+        return command
+
+    # Invoke the flight graph with the prepared state
+    flight_state = get_flight_graph().invoke(input=flight_input, config=config)
+    return flight_graph_output_command(state, flight_state)
+
+async def aflight_node(state: TravelState, config: RunnableConfig) -> Command[Literal["travel_node", "flight_node", END]]:
+    flight_input, command = flight_graph_input(state, config)
+    if command is not None:
+        return command
+
+    # Invoke the flight graph with the prepared state
+    flight_state = await get_flight_graph().ainvoke(input=flight_input, config=config)
+    return flight_graph_output_command(state, flight_state)
+
 
 def car_node(state: TravelState) -> Command[Literal["travel_node"]]:
 
@@ -293,47 +392,58 @@ def hotel_node(state: TravelState) -> Command[Literal["travel_node"]]:
 
 
 
-# Build the graph
+# Build the graph (travel and flight nodes have a sync and an async implementation, so the graph can be run with both invoke/stream and ainvoke/astream)
 builder = StateGraph(TravelState)
-builder.add_node("travel_node", travel_node)
-builder.add_node("flight_node", flight_node)
+add_dual_node(builder, travel_node, atravel_node)
+add_dual_node(builder, flight_node, aflight_node)
 builder.add_node("car_node", car_node)
 builder.add_node("hotel_node", hotel_node)
 builder.add_edge(START, "travel_node")
 
-# Create memory
-checkpointer = MemorySaver()
-travel_graph = builder.compile(checkpointer=checkpointer)
+def compile_travel_graph():
+    """Creates the checkpointer (SQLite or in-memory, see common/checkpoints.py) and compiles the graph with it."""
+    checkpointer = tracer.trace_checkpointer(create_checkpointer("travel"))
+    checkpoint_store_bytes.set_function(lambda: checkpoint_store_size(checkpointer), graph="travel")
+    return builder.compile(checkpointer=checkpointer)
+
+
+# The graph is compiled on first use, so that importing the module doesn't open the checkpoint database
+_travel_graph = None
+_travel_graph_lock = threading.Lock()
+
+def get_travel_graph():
+    global _travel_graph
+    with _travel_graph_lock:
+        if _travel_graph is None:
+            _travel_graph = compile_travel_graph()
+    return _travel_graph
 
 if __name__ == "__main__":
 
-    try:
+    parser = argparse.ArgumentParser(description="Runs a travel assistant conversation in the terminal.")
+    parser.add_argument("--draw-graph", action="store_true", help="Render the graph image (travel_graph.png) if the graph has changed, and exit")
+    args = parser.parse_args()
+
+    travel_graph = get_travel_graph()
+    if args.draw_graph:
         # Generate the graph image and save it to the current file's directory
-        image_path = os.path.join(os.path.dirname(__file__), "travel_graph.png")
-        travel_graph.get_graph().draw_mermaid_png(output_file_path=image_path)
-    except Exception:
-        pass
+        draw_graph_image(travel_graph, os.path.join(os.path.dirname(__file__), "travel_graph.png"))
+        sys.exit()
 
 
     # Create a config object with a unique thread_id for memory tracking, and other runtime information (user/session etc.)
+    # (the checkpoints are kept on disk by default, so every run starts a new conversation)
     manager_info = {"name": "Ali", "id":12345678910, "email": "ali@langgraph.com"}
     user_info = {"name": "Kaan", "id":10987654321, "email": "kaan@langgraph.com", "manager": manager_info}
     config = {
         "configurable": {
-            "thread_id": 1,
+            "thread_id": uuid.uuid4().hex,
             "user": user_info,
         }
     }
 
     # Create initial state
-    initial_state = {
-        "messages": [],
-        "travel_messages": [],
-        "intent": None,
-        "flight_state": None,
-        "initial": True,
-        "new": True
-    }
+    initial_state = get_initial_state()
 
     # Enter the conversation loop
     initialization = True
@@ -352,7 +462,7 @@ if __name__ == "__main__":
         # At later steps
         else:
             graph_state = travel_graph.get_state(config).values
-            state = {**state, **graph_state}
+            state = {**initial_state, **graph_state}
 
         
         # print("\nSTATE BEFORE NEXT STREAM CALL:\n")